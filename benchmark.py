@@ -0,0 +1,492 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import random
+import threading
+from time import sleep, time
+
+import requests
+from werkzeug.serving import make_server
+
+import fakeDrive
+import googleDrive
+
+RPC_P50_TARGET_MS = 20
+RPC_P99_TARGET_MS = 100
+
+
+def measure(name, count, func):
+    """
+    执行方法并输出总耗时和每次操作的平均耗时
+    :param name: 测试名
+    :param count: 操作次数
+    :param func: 执行的方法
+    :return: 每次操作的平均微秒数
+    """
+    start_time = time()
+    func()
+    seconds = time() - start_time
+    microseconds = seconds * 1000000 / count
+    print('  %-24s %10d次 %8.3fs %8.3fus/次' % (name, count, seconds, microseconds))
+    return microseconds
+
+
+def benchmark_work_registry(counts=(10000, 1000000)):
+    """
+    工作登记表的入队、查重、取消、取出和完成，队列规模变大时每次操作的耗时应该保持不变
+    """
+    print('benchmark_work_registry')
+    for count in counts:
+        print(' 队列规模', count)
+        registry = googleDrive.WorkRegistry()
+        paths = ['/data/%d' % i for i in range(count)]
+
+        def enqueue():
+            for path in paths:
+                registry.add_wait_work(False, path, 'folder')
+
+        def dedup():
+            for path in paths:
+                registry.add_wait_work(False, path, 'folder')
+
+        def cancel():
+            for path in paths[::2]:
+                registry.remove_wait_work(False, path, 'folder')
+
+        def start_and_finish():
+            registry.lock.acquire()
+            try:
+                works = [registry.start_wait_work_locked() for i in range(len(registry.wait_works))]
+            finally:
+                registry.lock.release()
+            for work in works:
+                registry.finish_doing_work(work)
+
+        measure('enqueue', count, enqueue)
+        measure('dedup', count, dedup)
+        measure('cancel', count // 2, cancel)
+        measure('start_and_finish', count - count // 2, start_and_finish)
+
+
+def benchmark_work_store(counts=(100000, 1000000), hot_count=10000):
+    """
+    工作存储里有大量历史工作时，入队、开始、完成和启动恢复的耗时应该保持不变
+    """
+    print('benchmark_work_store')
+    for count in counts:
+        print(' 历史工作数', count)
+        folder_path = tempfile.mkdtemp()
+        try:
+            store = googleDrive.WorkStore(os.path.join(folder_path, googleDrive.WORK_STORE_FILE_NAME))
+
+            def fill():
+                for start in range(0, count, 100000):
+                    for i in range(start, min(start + 100000, count)):
+                        store.put(googleDrive.Work(False, '/history/%d' % i, 'folder'), 'done')
+                    store.flush()
+
+            measure('fill_history', count, fill)
+            registry = googleDrive.WorkRegistry(store)
+            paths = ['/data/%d' % i for i in range(hot_count)]
+
+            def enqueue():
+                for path in paths:
+                    registry.add_wait_work(False, path, 'folder')
+
+            def start_and_finish():
+                registry.lock.acquire()
+                try:
+                    works = [registry.start_wait_work_locked() for i in range(len(registry.wait_works))]
+                finally:
+                    registry.lock.release()
+                for work in works:
+                    registry.finish_doing_work(work)
+
+            measure('enqueue', hot_count, enqueue)
+            measure('flush_enqueue', hot_count, store.flush)
+            measure('start_and_finish', hot_count, start_and_finish)
+            measure('flush_finish', hot_count, store.flush)
+            registry.add_wait_work(False, '/data/restart', 'folder')
+            store.flush()
+            measure('load', 1, lambda: googleDrive.WorkRegistry(store).load())
+        finally:
+            shutil.rmtree(folder_path)
+
+
+def benchmark_work_listing(counts=(10000, 100000), polls=100):
+    """
+    大量工作时分页列出和增量列出的耗时，以及列出时持有锁的时间(调度被阻塞的时间)
+    """
+    print('benchmark_work_listing')
+    for count in counts:
+        print(' 队列规模', count)
+        registry = googleDrive.WorkRegistry()
+        for i in range(count):
+            registry.add_wait_work(i % 2 == 0, '/data/%d/%d' % (i % 10, i), 'folder')
+        version = registry.list_works()['version']
+
+        def page():
+            for i in range(polls):
+                registry.add_wait_work(False, '/page/%d' % i, 'folder')
+                registry.list_works(offset=count // 2, limit=googleDrive.LIST_WORKS_LIMIT)
+
+        def filtered():
+            for i in range(polls):
+                registry.list_works(state='wait', is_download=True, path_prefix='/data/3')
+
+        def delta():
+            for i in range(polls):
+                registry.add_wait_work(False, '/delta/%d' % i, 'folder')
+                registry.list_works(since_version=registry.version - 1)
+
+        def snapshot_lock():
+            for i in range(polls):
+                registry.add_wait_work(False, '/snapshot/%d' % i, 'folder')
+                registry.snapshot_time = 0
+                registry.get_snapshot()
+
+        measure('page', polls, page)
+        measure('filtered', polls, filtered)
+        measure('delta', polls, delta)
+        measure('snapshot_lock', polls, snapshot_lock)
+        registry.list_works(since_version=version)
+
+
+def start_server(application):
+    """
+    在后台线程用随机端口运行wsgi应用
+    :return: (服务, 地址)
+    """
+    server = make_server('127.0.0.1', 0, application, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d/' % server.server_port
+
+
+def percentile(seconds, ratio):
+    seconds = sorted(seconds)
+    return seconds[int(ratio * (len(seconds) - 1))] * 1000
+
+
+def benchmark_rpc_server(clients=100, calls=20, interval=0.5, batch_size=10):
+    """
+    多个客户端同时调用jsonrpc的延迟，后端是fakeDrive.py的假谷歌硬盘，
+    每个客户端像网页控制台一样每interval秒调用一次，p50和p99应该低于RPC_P50_TARGET_MS和RPC_P99_TARGET_MS
+    """
+    print('benchmark_rpc_server')
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    folder_path = tempfile.mkdtemp()
+    work_path = os.getcwd()
+    drive_server, googleDrive.DRIVE_API_URL = start_server(fakeDrive.FakeDrive().application)
+    try:
+        os.chdir(folder_path)
+        client_daemon = googleDrive.GoogleDiverClientDaemon()
+        client_daemon.register_methods()
+        rpc_server, url = start_server(client_daemon.application)
+        methods = ['get_scheduler_stats', 'get_now_file_list', 'list_works']
+        batch = [{'method': methods[i % len(methods)], 'jsonrpc': '2.0', 'id': i} for i in range(batch_size)]
+        latencies = dict((method, []) for method in methods + ['batch'])
+        lock = threading.Lock()
+
+        def client(index):
+            session = requests.Session()
+            sleep(random.random() * interval)
+            for i in range(calls):
+                method = methods[(index + i) % len(methods)]
+                if i % 10 == 9:
+                    method = 'batch'
+                    data = batch
+                else:
+                    data = {'method': method, 'jsonrpc': '2.0', 'id': i}
+                start_time = time()
+                session.post(url + 'jsonrpc', json=data).json()
+                seconds = time() - start_time
+                lock.acquire()
+                try:
+                    latencies[method].append(seconds)
+                finally:
+                    lock.release()
+                sleep(max(0, interval - seconds))
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+        start_time = time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time() - start_time
+        print(' 客户端 %d 调用 %d %.3fs %.1f次/s' % (clients, clients * calls, seconds, clients * calls / seconds))
+        all_latencies = []
+        for method in methods + ['batch']:
+            all_latencies.extend(latencies[method])
+            print('  %-24s %6d次 p50 %8.3fms p99 %8.3fms' % (method, len(latencies[method]),
+                                                            percentile(latencies[method], 0.5),
+                                                            percentile(latencies[method], 0.99)))
+        p50 = percentile(all_latencies, 0.5)
+        p99 = percentile(all_latencies, 0.99)
+        print('  %-24s p50 %.3fms(目标%dms) p99 %.3fms(目标%dms) %s' % (
+            'all', p50, RPC_P50_TARGET_MS, p99, RPC_P99_TARGET_MS,
+            '达标' if p50 <= RPC_P50_TARGET_MS and p99 <= RPC_P99_TARGET_MS else '未达标'))
+        rpc_server.shutdown()
+    finally:
+        os.chdir(work_path)
+        drive_server.shutdown()
+        shutil.rmtree(folder_path)
+
+
+def benchmark_engines(files=200, size=256 * 1024, latency=0.05, thread_pool_size=16):
+    """
+    线程引擎和异步引擎执行同样的工作：上传files个文件再把它们下载回来。
+    后端是fakeDrive.py的假谷歌硬盘，每个请求延迟latency秒模拟网络往返，不限制请求速率
+    """
+    print('benchmark_engines')
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    engines = ['threads'] + (['asyncio'] if googleDrive.aiohttp else [])
+    work_path = os.getcwd()
+    results = []
+    try:
+        for engine in engines:
+            folder_path = tempfile.mkdtemp()
+            fake_drive = fakeDrive.FakeDrive()
+            drive_server, googleDrive.DRIVE_API_URL = start_server(fake_drive.application)
+            try:
+                os.chdir(folder_path)
+                os.makedirs('upload')
+                for i in range(files):
+                    with open('upload/%d' % i, 'wb') as upload_file:
+                        upload_file.write(os.urandom(size))
+                googleDrive.ENGINE = engine
+                client = googleDrive.GoogleDiverClient()
+                client.set_thread_pool_size(thread_pool_size)
+                fake_drive.latency = latency
+                max_threads = [0]
+
+                def wait_works():
+                    while True:
+                        threads = [thread for thread in threading.enumerate()
+                                   if 'process_request_thread' not in thread.name]
+                        max_threads[0] = max(max_threads[0], len(threads))
+                        stats = client.work_registry.get_stats()
+                        if stats['wait_works'] == 0 and stats['doing_works'] == 0:
+                            return
+                        sleep(0.05)
+
+                start_time = time()
+                for i in range(files):
+                    client.upload(os.path.abspath('upload/%d' % i), client.root_id)
+                wait_works()
+                upload_seconds = time() - start_time
+                start_time = time()
+                for file in client.get_file_list(client.root_id):
+                    if file['name'] != googleDrive.MARK_FILE_NAME:
+                        client.download(file['id'], os.path.abspath('download'))
+                wait_works()
+                download_seconds = time() - start_time
+                fake_drive.latency = 0
+                results.append((engine, upload_seconds, download_seconds, max_threads[0],
+                                len(os.listdir('download')), fake_drive.request_count))
+            finally:
+                os.chdir(work_path)
+                drive_server.shutdown()
+                shutil.rmtree(folder_path)
+    finally:
+        googleDrive.ENGINE = 'threads'
+    print(' %d个%dKiB文件 每个请求延迟%dms 线程引擎%d个线程' % (files, size // 1024, latency * 1000, thread_pool_size))
+    for engine, upload_seconds, download_seconds, max_threads, downloaded, request_count in results:
+        print('  %-8s 上传 %7.3fs %7.1f个/s 下载 %7.3fs %7.1f个/s 最多线程 %4d 下载文件 %4d 请求 %d' % (
+            engine, upload_seconds, files / upload_seconds, download_seconds, files / download_seconds,
+            max_threads, downloaded, request_count))
+
+
+def benchmark_scheduling(slots=4, small_files=400, small_size=1024 * 1024, large_files=8,
+                         large_size=8 * 1024 * 1024 * 1024, bandwidth=50 * 1024 * 1024):
+    """
+    用模拟的时钟比较各个调度策略，几个大文件先加入队列，随后上传下载各加入很多小文件，
+    每个工作线程按固定带宽传输，统计小文件和所有文件在等待队列里的时间
+    """
+    print('benchmark_scheduling')
+    print(' %d个线程 %d个%dGiB文件 %d个%dMiB文件 每个线程%dMiB/s' % (
+        slots, large_files, large_size // 1024 ** 3, small_files, small_size // 1024 ** 2, bandwidth // 1024 ** 2))
+    real_time = googleDrive.time
+    clock = [0.0]
+    googleDrive.time = lambda: clock[0]
+    try:
+        for policy in googleDrive.SCHEDULE_POLICIES:
+            clock[0] = 0.0
+            registry = googleDrive.WorkRegistry(policy=policy)
+            for i in range(large_files):
+                registry.add_wait_work(i % 2 == 0, '/data/large/%d' % i, 'folder', size=large_size)
+            for i in range(small_files):
+                registry.add_wait_work(i % 2 == 0, '/data/small/%d' % i, 'folder', size=small_size)
+            small_waits = []
+            doing = []
+            registry.lock.acquire()
+            try:
+                while registry.wait_works or doing:
+                    while registry.wait_works and len(doing) < slots:
+                        work = registry.start_wait_work_locked()
+                        if work.size == small_size:
+                            small_waits.append(work.start_time - work.create_time)
+                        doing.append((work.start_time + work.size / float(bandwidth), work))
+                    doing.sort(key=lambda item: item[0])
+                    clock[0], work = doing.pop(0)
+            finally:
+                registry.lock.release()
+            waits = registry.get_stats()['wait_percentiles'][policy]
+            print('  %-14s 小文件等待 p50 %8.1fs p99 %8.1fs 所有文件等待 p50 %8.1fs p99 %8.1fs 完成 %8.1fs' % (
+                policy, percentile(small_waits, 0.5) / 1000.0, percentile(small_waits, 0.99) / 1000.0,
+                waits['p50_ms'] / 1000.0, waits['p99_ms'] / 1000.0, clock[0]))
+    finally:
+        googleDrive.time = real_time
+
+
+def benchmark_bandwidth(files=16, size=2 * 1024 * 1024, rate=4 * 1024 * 1024, work_rate=1024 * 1024,
+                        thread_pool_size=4):
+    """
+    全局带宽限制为rate字节每秒时上传files个文件再下载回来，以及单个文件限制为work_rate字节每秒时上传，
+    实际速度和限制的误差应该在5%以内。后端是fakeDrive.py的假谷歌硬盘
+    """
+    print('benchmark_bandwidth')
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    engines = ['threads'] + (['asyncio'] if googleDrive.aiohttp else [])
+    work_path = os.getcwd()
+    limiter = googleDrive.BANDWIDTH_LIMITER
+    limits = limiter.get_stats()
+    results = []
+    try:
+        for engine in engines:
+            folder_path = tempfile.mkdtemp()
+            fake_drive = fakeDrive.FakeDrive()
+            drive_server, googleDrive.DRIVE_API_URL = start_server(fake_drive.application)
+            try:
+                os.chdir(folder_path)
+                os.makedirs('upload')
+                for i in range(files):
+                    with open('upload/%d' % i, 'wb') as upload_file:
+                        upload_file.write(os.urandom(size))
+                googleDrive.ENGINE = engine
+                client = googleDrive.GoogleDiverClient()
+                client.set_thread_pool_size(thread_pool_size)
+
+                def wait_works():
+                    while True:
+                        stats = client.work_registry.get_stats()
+                        if stats['wait_works'] == 0 and stats['doing_works'] == 0:
+                            return
+                        sleep(0.01)
+
+                limiter.set_limits(rate, rate)
+                start_time = time()
+                for i in range(files):
+                    client.upload(os.path.abspath('upload/%d' % i), client.root_id)
+                wait_works()
+                results.append((engine, 'upload', files * size, rate, time() - start_time))
+                start_time = time()
+                for file in client.get_file_list(client.root_id):
+                    if file['name'] != googleDrive.MARK_FILE_NAME:
+                        client.download(file['id'], os.path.abspath('download'))
+                wait_works()
+                results.append((engine, 'download', files * size, rate, time() - start_time))
+                limiter.set_limits(0, 0)
+                os.rename('upload/0', 'upload/limited')
+                start_time = time()
+                client.upload(os.path.abspath('upload/limited'), client.root_id, bandwidth_limit=work_rate)
+                wait_works()
+                results.append((engine, 'work', size, work_rate, time() - start_time))
+            finally:
+                os.chdir(work_path)
+                drive_server.shutdown()
+                shutil.rmtree(folder_path)
+    finally:
+        googleDrive.ENGINE = 'threads'
+        limiter.set_limits(limits['upload'], limits['download'])
+    print(' %d个%dMiB文件 %d个线程' % (files, size // 1024 ** 2, thread_pool_size))
+    for engine, name, transferred, limit, seconds in results:
+        print('  %-8s %-8s 限制 %7.1fKiB/s 实际 %7.1fKiB/s 误差 %+5.1f%%' % (
+            engine, name, limit / 1024.0, transferred / seconds / 1024.0,
+            (transferred / seconds / limit - 1) * 100))
+
+
+def benchmark_upload_strategy(folders=50, files=1000, size=4 * 1024, latency=0.05, thread_pool_size=16):
+    """
+    上传folders个文件夹、每个files个size字节小文件的目录树，比较总是用可续传上传和小文件用multipart上传，
+    后端是fakeDrive.py的假谷歌硬盘，每个请求延迟latency秒模拟网络往返，不限制请求速率
+    """
+    print('benchmark_upload_strategy')
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    engines = ['threads'] + (['asyncio'] if googleDrive.aiohttp else [])
+    work_path = os.getcwd()
+    threshold = googleDrive.MULTIPART_UPLOAD_THRESHOLD
+    folder_path = tempfile.mkdtemp()
+    results = []
+    try:
+        for i in range(folders):
+            os.makedirs(folder_path + '/tree/%d' % i)
+            for j in range(files):
+                with open(folder_path + '/tree/%d/%d' % (i, j), 'wb') as upload_file:
+                    upload_file.write(os.urandom(size))
+        for engine in engines:
+            for name, multipart_threshold in (('resumable', 0), ('multipart', threshold)):
+                fake_drive = fakeDrive.FakeDrive()
+                drive_server, googleDrive.DRIVE_API_URL = start_server(fake_drive.application)
+                try:
+                    os.chdir(folder_path)
+                    for file_name in os.listdir('.'):
+                        if file_name.startswith('pythonGoogleDrive'):
+                            os.remove(file_name)
+                    googleDrive.ENGINE = engine
+                    googleDrive.MULTIPART_UPLOAD_THRESHOLD = multipart_threshold
+                    client = googleDrive.GoogleDiverClient()
+                    client.set_thread_pool_size(thread_pool_size)
+                    fake_drive.latency = latency
+                    request_count = fake_drive.request_count
+                    start_time = time()
+                    client.upload(os.path.abspath('tree'), client.root_id)
+                    sleep(0.1)
+                    while True:
+                        stats = client.work_registry.get_stats()
+                        if stats['wait_works'] == 0 and stats['doing_works'] == 0:
+                            break
+                        sleep(0.05)
+                    seconds = time() - start_time
+                    fake_drive.latency = 0
+                    results.append((engine, name, seconds, fake_drive.request_count - request_count,
+                                    len(fake_drive.files)))
+                finally:
+                    os.chdir(work_path)
+                    drive_server.shutdown()
+    finally:
+        googleDrive.ENGINE = 'threads'
+        googleDrive.MULTIPART_UPLOAD_THRESHOLD = threshold
+        shutil.rmtree(folder_path)
+    total = folders * files
+    print(' %d个文件夹共%d个%dKiB文件 每个请求延迟%dms 线程引擎%d个线程' % (
+        folders, total, size // 1024, latency * 1000, thread_pool_size))
+    for engine, name, seconds, request_count, file_count in results:
+        print('  %-8s %-10s %8.3fs %8.1f个/s 请求 %7d 远程文件 %d' % (
+            engine, name, seconds, total / seconds, request_count, file_count))
+
+
+BENCHMARKS = {
+    'work_registry': benchmark_work_registry,
+    'work_store': benchmark_work_store,
+    'work_listing': benchmark_work_listing,
+    'rpc_server': benchmark_rpc_server,
+    'engines': benchmark_engines,
+    'scheduling': benchmark_scheduling,
+    'bandwidth': benchmark_bandwidth,
+    'upload_strategy': benchmark_upload_strategy,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmarks', nargs='*', default=sorted(BENCHMARKS.keys()), help='要运行的测试')
+    for name in parser.parse_known_args()[0].benchmarks:
+        BENCHMARKS[name]()
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import hashlib
+import json
+import logging
+import re
+import threading
+from email.parser import BytesParser
+from time import sleep
+
+from werkzeug.routing import Map, Rule
+from werkzeug.test import EnvironBuilder
+from werkzeug.serving import run_simple
+from werkzeug.wrappers import Request, Response
+
+FAKE_DRIVE_HOST = '127.0.0.1'
+FAKE_DRIVE_PORT = 6601
+FAKE_ROOT_ID = 'fake-root'
+FOLDER_MINE_TYPE = 'application/vnd.google-apps.folder'
+DEFAULT_PAGE_SIZE = 100
+
+
+class FakeDrive(object):
+    """
+    本地的假谷歌硬盘接口，实现了pythonGoogleDrive用到的drive v3接口，用于测试和统计api请求次数。
+    启动后用 python googleDrive.py --drive_api_url http://127.0.0.1:6601/ 连接
+    """
+
+    def __init__(self):
+        self.files = {FAKE_ROOT_ID: {'id': FAKE_ROOT_ID, 'name': 'My Drive', 'mimeType': FOLDER_MINE_TYPE,
+                                     'trashed': False}}
+        self.contents = {}
+        self.changes = []
+        self.sessions = {}
+        self.next_id = 0
+        self.request_count = 0
+        self.request_counts = {}
+        self.failures = []
+        self.latency = 0
+        # 模拟忽略Range头的代理，接下来这么多个下载请求返回200和整个文件
+        self.ignore_range_count = 0
+        self.lock = threading.Lock()
+        self.url_map = Map([
+            Rule('/drive/v3/files', methods=['GET'], endpoint='list_files'),
+            Rule('/drive/v3/files', methods=['POST'], endpoint='create_file'),
+            Rule('/drive/v3/files/<file_id>', methods=['GET'], endpoint='get_file'),
+            Rule('/drive/v3/files/<file_id>', methods=['PATCH'], endpoint='update_file'),
+            Rule('/drive/v3/changes/startPageToken', methods=['GET'], endpoint='get_start_page_token'),
+            Rule('/drive/v3/changes', methods=['GET'], endpoint='list_changes'),
+            Rule('/upload/drive/v3/files', methods=['POST', 'PUT'], endpoint='upload_file'),
+            Rule('/batch/drive/v3', methods=['POST'], endpoint='batch'),
+            Rule('/fake/stats', methods=['GET'], endpoint='get_stats'),
+            Rule('/fake/fail', methods=['POST'], endpoint='fail'),
+            Rule('/fake/latency', methods=['POST'], endpoint='latency'),
+        ])
+
+    def add_file(self, name, parent_id=None, mime_type='application/octet-stream', content=None):
+        """
+        直接往假硬盘里添加文件，用于准备测试数据，不计入请求次数
+        :param name: 文件名
+        :param parent_id: 父文件夹id，默认为根目录
+        :param mime_type: 文件类型
+        :param content: 文件内容
+        :return: 文件对象
+        """
+        with self.lock:
+            return self.put_file({'name': name, 'mimeType': mime_type, 'parents': [parent_id or FAKE_ROOT_ID]},
+                                 content)
+
+    def put_file(self, metadata, content=None):
+        self.next_id = self.next_id + 1
+        file = {'id': 'fake-%d' % self.next_id, 'name': metadata.get('name', 'untitled'),
+                'mimeType': metadata.get('mimeType', 'application/octet-stream'),
+                'parents': [self.get_id(parent) for parent in metadata.get('parents') or [FAKE_ROOT_ID]],
+                'trashed': False,
+                'webViewLink': 'http://fake/view/%d' % self.next_id}
+        if file['mimeType'] != FOLDER_MINE_TYPE:
+            content = content or b''
+            file['size'] = str(len(content))
+            file['md5Checksum'] = hashlib.md5(content).hexdigest()
+            file['webContentLink'] = 'http://fake/download/%d' % self.next_id
+            self.contents[file['id']] = content
+        self.files[file['id']] = file
+        self.changes.append(file['id'])
+        return file
+
+    def get_id(self, file_id):
+        """
+        把根目录的别名root换成真实id
+        """
+        return FAKE_ROOT_ID if file_id == 'root' else file_id
+
+    def match(self, file, q):
+        """
+        计算查询语句，支持 'x' in parents、name contains 'x'、name = 'x'、mimeType = 'x'、trashed = false，
+        以及and、or和括号
+        """
+        tokens = re.findall(r"\(|\)|'(?:[^'\\]|\\.)*'|[^\s()']+", q)
+        position = [0]
+
+        def peek():
+            return tokens[position[0]] if position[0] < len(tokens) else None
+
+        def take():
+            position[0] = position[0] + 1
+            return tokens[position[0] - 1]
+
+        def term():
+            if peek() == '(':
+                take()
+                value = expression()
+                take()
+                return value
+            left = take()
+            operator = take()
+            right = take()
+            if operator == 'in':
+                return left.strip("'") in file.get('parents', [])
+            if right in ('true', 'false'):
+                return str(file.get(left, False)).lower() == right
+            right = right.strip("'")
+            if operator == 'contains':
+                return right in file.get(left, '')
+            if operator == '=':
+                return file.get(left) == right
+            return file.get(left) != right
+
+        def conjunction():
+            value = term()
+            while peek() == 'and':
+                take()
+                value = term() and value
+            return value
+
+        def expression():
+            value = conjunction()
+            while peek() == 'or':
+                take()
+                value = conjunction() or value
+            return value
+
+        return expression()
+
+    def count(self, endpoint):
+        self.request_count = self.request_count + 1
+        self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+
+    def json_response(self, value, status=200):
+        return Response(json.dumps(value), status=status, mimetype='application/json')
+
+    def error_response(self, status, reason):
+        return self.json_response({'error': {'code': status, 'message': reason,
+                                             'errors': [{'reason': reason, 'message': reason}]}}, status)
+
+    def on_list_files(self, request):
+        q = request.args.get('q', '')
+        page_size = int(request.args.get('pageSize', DEFAULT_PAGE_SIZE))
+        offset = int(request.args.get('pageToken', 0))
+        files = [file for file in self.files.values() if file['id'] != FAKE_ROOT_ID and (not q or self.match(file, q))]
+        response = {'files': files[offset:offset + page_size]}
+        if offset + page_size < len(files):
+            response['nextPageToken'] = str(offset + page_size)
+        return self.json_response(response)
+
+    def on_create_file(self, request):
+        return self.json_response(self.put_file(json.loads(request.get_data(as_text=True) or '{}')))
+
+    def on_get_file(self, request, file_id):
+        file = self.files.get(self.get_id(file_id))
+        if not file:
+            return self.error_response(404, 'notFound')
+        if request.args.get('alt') != 'media':
+            return self.json_response(file)
+        content = self.contents.get(file_id, b'')
+        match = re.match(r'bytes=(\d+)-(\d*)', request.headers.get('Range', ''))
+        if match and self.ignore_range_count > 0:
+            self.ignore_range_count = self.ignore_range_count - 1
+            match = None
+        if not match:
+            return Response(content, mimetype='application/octet-stream')
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else len(content) - 1, len(content) - 1)
+        response = Response(content[start:end + 1], status=206, mimetype='application/octet-stream')
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(content))
+        return response
+
+    def on_update_file(self, request, file_id):
+        file = self.files.get(file_id)
+        if not file:
+            return self.error_response(404, 'notFound')
+        parents = [parent for parent in file.get('parents', [])
+                   if parent not in request.args.get('removeParents', '').split(',')]
+        parents.extend(parent for parent in request.args.get('addParents', '').split(',') if parent)
+        file['parents'] = parents
+        file.update(json.loads(request.get_data(as_text=True) or '{}'))
+        self.changes.append(file_id)
+        return self.json_response(file)
+
+    def on_get_start_page_token(self, request):
+        return self.json_response({'startPageToken': str(len(self.changes))})
+
+    def on_list_changes(self, request):
+        offset = int(request.args.get('pageToken', 0))
+        page_size = int(request.args.get('pageSize', DEFAULT_PAGE_SIZE))
+        changes = []
+        for file_id in self.changes[offset:offset + page_size]:
+            file = self.files.get(file_id)
+            changes.append({'fileId': file_id, 'removed': file is None, 'file': file})
+        response = {'changes': changes}
+        if offset + page_size < len(self.changes):
+            response['nextPageToken'] = str(offset + page_size)
+        else:
+            response['newStartPageToken'] = str(len(self.changes))
+        return self.json_response(response)
+
+    def on_upload_file(self, request):
+        upload_type = request.args.get('uploadType')
+        if upload_type == 'multipart':
+            boundary = request.mimetype_params['boundary'].encode()
+            # googleapiclient用\n换行，其他客户端一般用\r\n
+            parts = [part for part in request.get_data().split(b'--' + boundary) if part.strip(b'\r\n-')]
+            metadata = json.loads(re.split(b'\r?\n\r?\n', parts[0], 1)[1].decode('utf-8'))
+            headers, content = re.split(b'\r?\n\r?\n', parts[1], 1) if len(parts) > 1 else (b'', b'')
+            content = re.sub(b'\r?\n\Z', b'', content, count=1)
+            # 和谷歌硬盘一样，元数据里没有mimeType时用内容部分的Content-Type
+            match = re.search(b'content-type:\\s*([^\r\n;]+)', headers, re.IGNORECASE)
+            if match and 'mimeType' not in metadata:
+                metadata['mimeType'] = match.group(1).strip().decode()
+            return self.json_response(self.put_file(metadata, content))
+        if upload_type == 'media':
+            return self.json_response(self.put_file({}, request.get_data()))
+        if 'upload_id' not in request.args:
+            self.next_id = self.next_id + 1
+            upload_id = str(self.next_id)
+            metadata = json.loads(request.get_data(as_text=True) or '{}')
+            if 'X-Upload-Content-Type' in request.headers and 'mimeType' not in metadata:
+                metadata['mimeType'] = request.headers['X-Upload-Content-Type']
+            self.sessions[upload_id] = {'metadata': metadata, 'content': b''}
+            response = Response(status=200)
+            response.headers['Location'] = request.base_url + '?uploadType=resumable&upload_id=' + upload_id
+            return response
+        session = self.sessions.get(request.args['upload_id'])
+        if session is None:
+            return self.error_response(404, 'notFound')
+        match = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', request.headers.get('Content-Range', ''))
+        if match and int(match.group(1)) == len(session['content']):
+            session['content'] = session['content'] + request.get_data()
+        total = match.group(3) if match else request.headers.get('Content-Range', '').split('/')[-1]
+        if total != '*' and len(session['content']) >= int(total or 0):
+            del self.sessions[request.args['upload_id']]
+            return self.json_response(self.put_file(session['metadata'], session['content']))
+        response = Response(status=308)
+        if session['content']:
+            response.headers['Range'] = 'bytes=0-%d' % (len(session['content']) - 1)
+        return response
+
+    def on_batch(self, request):
+        """
+        批量请求，把multipart/mixed里的每个请求分别执行，整个批量只算一次请求
+        """
+        message = BytesParser().parsebytes(b'Content-Type: ' + request.headers['Content-Type'].encode() +
+                                           b'\r\n\r\n' + request.get_data())
+        boundary = 'fake_batch_boundary'
+        body = []
+        for part in message.get_payload():
+            head, data = re.split(r'\r?\n\r?\n', part.get_payload(), 1)
+            lines = head.splitlines()
+            method, uri = lines[0].split(' ')[:2]
+            headers = dict(line.split(': ', 1) for line in lines[1:] if ': ' in line)
+            path, _, query_string = uri.partition('?')
+            inner_request = Request(EnvironBuilder(path=path, query_string=query_string, method=method,
+                                                   data=data.encode('utf-8'), headers=headers).get_environ())
+            endpoint, values = self.url_map.bind_to_environ(inner_request.environ).match()
+            self.request_counts['batch:' + endpoint] = self.request_counts.get('batch:' + endpoint, 0) + 1
+            response = getattr(self, 'on_' + endpoint)(inner_request, **values)
+            body.append('--' + boundary + '\r\nContent-Type: application/http\r\nContent-ID: <response-' +
+                        part['Content-ID'][1:-1] + '>\r\n\r\nHTTP/1.1 ' + response.status +
+                        '\r\nContent-Type: application/json\r\n\r\n' + response.get_data(as_text=True) + '\r\n')
+        body.append('--' + boundary + '--')
+        return Response(''.join(body), content_type='multipart/mixed; boundary=' + boundary)
+
+    def on_get_stats(self, request):
+        return self.json_response({'request_count': self.request_count, 'request_counts': self.request_counts,
+                                   'files': len(self.files)})
+
+    def on_fail(self, request):
+        """
+        让接下来count个请求返回错误，用于测试重试和限流，例如 /fake/fail?status=403&reason=userRateLimitExceeded&count=3
+        """
+        status = int(request.args.get('status', 429))
+        reason = request.args.get('reason', 'rateLimitExceeded')
+        self.failures.extend([(status, reason)] * int(request.args.get('count', 1)))
+        return self.json_response({'failures': len(self.failures)})
+
+    def on_latency(self, request):
+        """
+        设置每个请求的延迟秒数，用于模拟真实网络的往返时间，例如 /fake/latency?seconds=0.05
+        """
+        self.latency = float(request.args.get('seconds', 0))
+        return self.json_response({'latency': self.latency})
+
+    @Request.application
+    def application(self, request):
+        adapter = self.url_map.bind_to_environ(request.environ)
+        endpoint, values = adapter.match()
+        if self.latency and endpoint not in ('get_stats', 'fail', 'latency'):
+            sleep(self.latency)
+        with self.lock:
+            if endpoint in ('get_stats', 'fail', 'latency'):
+                return getattr(self, 'on_' + endpoint)(request, **values)
+            self.count(endpoint)
+            if self.failures:
+                return self.error_response(*self.failures.pop(0))
+            return getattr(self, 'on_' + endpoint)(request, **values)
+
+    def serve(self, host=FAKE_DRIVE_HOST, port=FAKE_DRIVE_PORT):
+        print('假谷歌硬盘地址', 'http://' + host + ':' + str(port) + '/')
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        run_simple(host, port, self.application, threaded=True)
+
+
+if __name__ == '__main__':
+    FakeDrive().serve()
@@ -2,28 +2,70 @@
 
 from __future__ import print_function
 
+import asyncio
+import atexit
+import collections
+import hashlib
+import heapq
+import itertools
 import json
+import mimetypes
+import multiprocessing
 import os
+import random
+import re
+import sqlite3
+import sys
 import threading
-from time import sleep
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from time import localtime, sleep, time
 
 import httplib2
 import requests
 
 from apiclient import discovery
-from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
+from googleapiclient import discovery_cache
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload, MediaDownloadProgress, MediaUpload
 from oauth2client import client
 from oauth2client import tools
 from oauth2client.file import Storage
-from werkzeug.serving import run_simple
+from werkzeug.serving import make_server
 from werkzeug.wrappers import Request, Response
 
 from jsonrpc import JSONRPCResponseManager, dispatcher
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 try:
     import argparse
 
-    flags = argparse.ArgumentParser(parents=[tools.argparser]).parse_args()
+    parser = argparse.ArgumentParser(parents=[tools.argparser])
+    parser.add_argument('--drive_api_url', default=None,
+                        help='谷歌硬盘api根地址，用于连接本地的假谷歌硬盘接口(fakeDrive.py)，设置后不进行授权')
+    parser.add_argument('--metadata_sync', action='store_true',
+                        help='通过changes接口增量同步元数据，文件列表和目录导航从本地元数据读取')
+    parser.add_argument('--timing', action='store_true', help='启动完成后输出启动各阶段耗时')
+    parser.add_argument('--download_policy', default='always',
+                        choices=('always', 'if-size-differs', 'if-md5-differs'),
+                        help='本地已有同名文件时是否下载：总是下载、大小不同才下载、md5不同才下载')
+    parser.add_argument('--schedule_policy', default='fifo', choices=('fifo', 'fair', 'shortest-first'),
+                        help='等待队列的调度策略：先进先出、上传下载轮流、小文件优先(等待越久越靠前)，都先按优先级')
+    parser.add_argument('--engine', default='threads', choices=('threads', 'asyncio'),
+                        help='传输引擎：每个工作线程一个httplib2连接，或者在一个事件循环里用aiohttp执行全部文件传输')
+    parser.add_argument('--request_rate', type=float, default=0,
+                        help='全局请求速率上限，每秒请求数，0不限制(只靠429/403限流响应退避)，上传下载的数据块请求不计入')
+    parser.add_argument('--upload_limit', type=int, default=0, help='全局上传带宽上限，字节每秒，0不限制')
+    parser.add_argument('--download_limit', type=int, default=0, help='全局下载带宽上限，字节每秒，0不限制')
+    parser.add_argument('--multipart_threshold', type=int, default=5 * 1024 * 1024,
+                        help='小于这个字节数的文件用一次multipart请求上传，不小于的用可续传上传，0总是用可续传上传')
+    parser.add_argument('--upload_stream', default=None,
+                        help='从标准输入流式上传，保存为这个文件名，例如 pg_dump db | python googleDrive.py --upload_stream db.sql')
+    parser.add_argument('--folder_id', default=None, help='流式上传保存到的文件夹id，默认根目录')
+    flags = parser.parse_known_args()[0]
 except ImportError:
     flags = None
 
@@ -36,736 +78,4023 @@ SCOPES = 'https://www.googleapis.com/auth/drive'
 TEMP_FILE_NAME = '.temp'
 APPLICATION_NAME = 'pythonGoogleDrive'
 CLIENT_JSON_FILE_NAME = 'pythonGoogleDrive-client.json'
+STATE_JSON_FILE_NAME = 'pythonGoogleDrive-state.json'
+UPLOAD_JOURNAL_JSON_FILE_NAME = 'pythonGoogleDrive-upload.json'
+HASH_CACHE_FILE_NAME = 'pythonGoogleDrive-hash.db'
+WORK_STORE_FILE_NAME = 'pythonGoogleDrive-works.db'
 FOLDER_MINE_TYPE = 'application/vnd.google-apps.folder'
-FILE_INFO = 'id, name, mimeType, parents, size, webViewLink, webContentLink'
+FILE_INFO = 'id, name, mimeType, parents, size, md5Checksum, webViewLink, webContentLink'
 MARK_FILE_NAME = 'pythonGoogleDrive.txt'
+METADATA_CACHE_SIZE = 10000
+METADATA_CACHE_TTL = 300
+METADATA_SYNC_INTERVAL = 10
+METADATA_SYNC_PAGE_SIZE = 1000
+BATCH_SIZE = 100
+PARALLEL_DOWNLOAD_THRESHOLD = 64 * 1024 * 1024
+PARALLEL_DOWNLOAD_STREAMS = 4
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+CHUNK_ALIGNMENT = 256 * 1024
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 256 * 1024 * 1024
+CHUNK_TARGET_SECONDS = 2
+CHUNK_ROUND_TRIP_RATIO = 10
+CHUNK_SAMPLE_COUNT = 8
+HTTP_TIMEOUT = 60
+REQUEST_BURST_SECONDS = 2
+RETRY_MAX_ATTEMPTS = 8
+RETRY_BASE_SECONDS = 1
+RETRY_MAX_SECONDS = 64
+RATE_LIMIT_REASONS = ('userRateLimitExceeded', 'rateLimitExceeded')
+HASH_PROCESS_COUNT = os.cpu_count() or 1
+HASH_BLOCK_SIZE = 1024 * 1024
+HASH_CACHE_QUERY_SIZE = 500
+UPLOAD_WALK_THREADS = 8
+SUBTREE_QUERY_PARENTS = 50
+SUBTREE_PAGE_SIZE = 1000
+SUBTREE_LIST_THREADS = 4
+WORK_STORE_FLUSH_INTERVAL = 0.2
+DONE_WORKS_SIZE = 1000
+WORK_CHANGE_LOG_SIZE = 100000
+LIST_WORKS_LIMIT = 100
+LIST_WORKS_SNAPSHOT_INTERVAL = 1
+PROGRESS_EVENTS_PER_SECOND = 2
+EVENT_QUEUE_SIZE = 10000
+EVENT_HEARTBEAT_SECONDS = 15
+CONSOLE_WORKS_LIMIT = 1000
+RPC_DRIVE_THREADS = 8
+RPC_DRIVE_QUEUE_SIZE = 64
+RPC_BATCH_THREADS = 8
+RPC_TIMEOUT = 30
+RPC_METHOD_TIMEOUTS = {'get_now_file_list': 60, 'goto_parent_folder': 60, 'goto_child_folder': 60}
+RPC_LATENCY_SAMPLES = 1000
+PART_FILE_SUFFIX = '.part'
+REQUESTS_PER_SECOND = flags.request_rate if flags else 0
+REQUEST_BURST = max(int(REQUESTS_PER_SECOND * REQUEST_BURST_SECONDS), 1)
+DRIVE_API_URL = flags.drive_api_url if flags else None
+METADATA_SYNC = flags.metadata_sync if flags else False
+STARTUP_TIMING = flags.timing if flags else False
+DOWNLOAD_POLICIES = ('always', 'if-size-differs', 'if-md5-differs')
+DOWNLOAD_POLICY = flags.download_policy if flags else 'always'
+ENGINE = flags.engine if flags else 'threads'
+SCHEDULE_POLICIES = ('fifo', 'fair', 'shortest-first')
+SCHEDULE_POLICY = flags.schedule_policy if flags else 'fifo'
+SCHEDULE_AGING_BYTES_PER_SECOND = 64 * 1024 * 1024
+SCHEDULE_COMPACT_SIZE = 1000
+SCHEDULE_WAIT_SAMPLES = 1000
+UPLOAD_BYTES_PER_SECOND = flags.upload_limit if flags else 0
+DOWNLOAD_BYTES_PER_SECOND = flags.download_limit if flags else 0
+BANDWIDTH_BURST_SECONDS = 0.1
+STREAM_MAX_CHUNK_SIZE = 64 * 1024 * 1024
+STREAM_MIME_TYPE = 'application/octet-stream'
+MULTIPART_UPLOAD_THRESHOLD = flags.multipart_threshold if flags else 5 * 1024 * 1024
+ASYNC_MAX_WORKS = 200
+ASYNC_CONNECTIONS = 100
+ASYNC_FOLDER_THREADS = 2
+DRIVE_API_ROOT_URL = 'https://www.googleapis.com/'
 
 
-class GoogleDiverAPI(object):
+class StartupTimer(object):
     def __init__(self):
-        self.service = self.get_service()
-        self.root_id = self.get_root_id()
+        self.start_time = time()
+        self.phases = []
+        self.finished = False
+        self.lock = threading.Lock()
 
-    def get_temp_file(self):
+    def measure(self, name, func, *args, **kwargs):
         """
-        获取临时文件
+        执行方法并记录耗时，启动完成后不再记录
+        :param name: 阶段名
+        :param func: 执行的方法
+        :return: 方法的返回值
+        """
+        if self.finished:
+            return func(*args, **kwargs)
+        start_time = time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.lock.acquire()
+            try:
+                self.phases.append((name, time() - start_time))
+            finally:
+                self.lock.release()
+
+    def finish(self):
+        """
+        结束启动计时
+        :return: 启动各阶段耗时map
+        """
+        self.finished = True
+        return {'total': time() - self.start_time, 'phases': self.phases}
+
+    def print_report(self):
+        report = self.finish()
+        print('启动耗时 %.3fs' % report['total'])
+        for name, seconds in report['phases']:
+            print('  %-24s %8.3fs %5.1f%%' % (name, seconds, seconds * 100 / report['total']))
+
+
+STARTUP_TIMER = StartupTimer()
+
+
+def get_discovery_document():
+    """
+    谷歌硬盘api的discovery文档，用googleapiclient随库发布的静态文档，不用请求，升级googleapiclient就会更新。
+    设置了DRIVE_API_URL时把根地址换成它
+    :return: discovery文档
+    """
+    document = json.loads(discovery_cache.get_static_doc('drive', 'v3'))
+    if DRIVE_API_URL:
+        document['rootUrl'] = DRIVE_API_URL
+    return document
+
+
+class StartupState(object):
+    """
+    持久化在STATE_JSON_FILE_NAME里的启动信息，例如根目录id，按api地址区分
+    """
+
+    def __init__(self, file_name=STATE_JSON_FILE_NAME):
+        self.file_name = file_name
+        self.key = DRIVE_API_URL if DRIVE_API_URL else 'drive'
+        self.lock = threading.Lock()
+        try:
+            with open(file_name, 'r') as file:
+                self.states = json.load(file)
+        except (IOError, ValueError):
+            self.states = {}
+
+    def get(self, name):
+        return self.states.get(self.key, {}).get(name)
+
+    def put(self, name, value):
+        """
+        保存启动信息，先写临时文件再改名，避免写一半的时候进程退出
+        :param name: 信息名
+        :param value: 信息值
         :return: 无返回
         """
-        request = requests.get('http://www.cellargalaxy.top/pythonGoogleDiver.json')
-        with open(TEMP_FILE_NAME, 'w') as file:
-            file.write(json.dumps(request.json()))
+        self.lock.acquire()
+        try:
+            self.states.setdefault(self.key, {})[name] = value
+            self.save_locked()
+        finally:
+            self.lock.release()
 
-    def delete_temp_file(self):
+    def remove(self, name):
         """
-        删除临时文件
+        删除启动信息
+        :param name: 信息名
         :return: 无返回
         """
-        os.remove(TEMP_FILE_NAME)
+        self.lock.acquire()
+        try:
+            if self.states.get(self.key, {}).pop(name, None) is not None:
+                self.save_locked()
+        finally:
+            self.lock.release()
 
-    def get_credentials(self):
+    def save_locked(self):
+        with open(self.file_name + '.tmp', 'w') as file:
+            json.dump(self.states, file)
+        os.replace(self.file_name + '.tmp', self.file_name)
+
+
+class UploadJournal(StartupState):
+    """
+    可续传上传的日志，保存在UPLOAD_JOURNAL_JSON_FILE_NAME里，记录每个上传的会话地址和服务器已确认的字节数，
+    重试或者重启后从最后确认的字节继续上传
+    """
+
+    def __init__(self, file_name=UPLOAD_JOURNAL_JSON_FILE_NAME):
+        StartupState.__init__(self, file_name)
+
+    def get_upload(self, file_path, folder_id, file_name):
         """
-        通过密匙json获取客户的登录权限并生成资格证书
-        Returns: 资格证书对象
+        获取上传记录，本地文件在记录之后被修改过返回None
+        :return: 上传记录map
         """
-        # 这个应该意思是谷歌的应用商店对象
-        store = Storage(CLIENT_JSON_FILE_NAME)
-        credentials = store.get()
-        # 如果获取证书失败或者证书失效
-        if not credentials or credentials.invalid:
-            self.get_temp_file()
-            flow = client.flow_from_clientsecrets(TEMP_FILE_NAME, SCOPES)
-            flow.user_agent = APPLICATION_NAME
-            self.delete_temp_file()
-            if flags:
-                credentials = tools.run_flow(flow, store, flags)
-            else:  # Needed only for compatibility with Python 2.6
-                credentials = tools.run(flow, store)
-            print('客户证书：' + CLIENT_JSON_FILE_NAME)
-        return credentials
+        upload = self.get(file_path + '|' + folder_id + '|' + file_name)
+        if not upload:
+            return None
+        stat = os.stat(file_path)
+        if upload['size'] != stat.st_size or upload['mtime'] != stat.st_mtime:
+            return None
+        return upload
+
+    def put_upload(self, file_path, folder_id, file_name, resumable_uri, offset):
+        stat = os.stat(file_path)
+        self.put(file_path + '|' + folder_id + '|' + file_name,
+                 {'resumable_uri': resumable_uri, 'offset': offset, 'size': stat.st_size, 'mtime': stat.st_mtime})
+
+    def remove_upload(self, file_path, folder_id, file_name):
+        self.remove(file_path + '|' + folder_id + '|' + file_name)
+
+
+def md5_file(file_path):
+    """
+    计算文件的md5，在进程池里执行
+    :param file_path: 文件路径
+    :return: 十六进制md5
+    """
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
 
-    def get_service(self):
+class HashCache(object):
+    """
+    本地文件的md5缓存，保存在WAL模式的SQLite数据库HASH_CACHE_FILE_NAME里，以文件路径为键，
+    值是(设备, inode, 大小, 修改时间)和md5，文件没有变化就不用再算，变化了就替换这个路径的记录，编辑再多次也只有一条。
+    没有缓存的文件放到进程池里计算，算完在一个事务里写入，不用重写整个缓存
+    """
+
+    def __init__(self, file_name=HASH_CACHE_FILE_NAME):
+        self.file_name = file_name
+        self.executor = None
+        self.hits = 0
+        self.misses = 0
+        self.hashed_bytes = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, stat_key TEXT NOT NULL, '
+                                'md5 TEXT NOT NULL) WITHOUT ROWID')
+        self.connection.commit()
+        self.connection_lock = threading.Lock()
+
+    def get_key(self, stat):
+        return '%d:%d:%d:%d' % (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def get_md5(self, file_path):
+        return self.get_md5s([file_path])[0]
+
+    def load(self, paths):
         """
-        获取谷歌硬盘服务对象
-        :return: 谷歌硬盘服务对象
+        读取多个路径的缓存，每次最多查询HASH_CACHE_QUERY_SIZE个
+        :param paths: 文件的绝对路径序列
+        :return: {路径: (stat_key, md5)}
         """
-        credentials = self.get_credentials()
-        http = credentials.authorize(httplib2.Http())
-        service = discovery.build('drive', 'v3', http=http)
-        return service
+        cached = {}
+        self.connection_lock.acquire()
+        try:
+            for start in range(0, len(paths), HASH_CACHE_QUERY_SIZE):
+                query_paths = paths[start:start + HASH_CACHE_QUERY_SIZE]
+                rows = self.connection.execute('SELECT path, stat_key, md5 FROM hashes WHERE path IN (%s)' %
+                                               ','.join('?' * len(query_paths)), query_paths)
+                for path, stat_key, md5 in rows:
+                    cached[path] = (stat_key, md5)
+        finally:
+            self.connection_lock.release()
+        return cached
 
-    def get_root_id(self):
+    def get_md5s(self, file_paths):
         """
-        获取根目录id
-        :return: 目录id
+        获取多个文件的md5，没有缓存的文件超过一个时用进程池同时计算
+        :param file_paths: 文件路径序列
+        :return: 与文件路径一一对应的md5序列
         """
+        paths = [os.path.abspath(file_path) for file_path in file_paths]
+        keys = [self.get_key(os.stat(path)) for path in paths]
+        cached = self.load(paths)
+        md5s = [None] * len(file_paths)
+        misses = []
+        for i, (path, key) in enumerate(zip(paths, keys)):
+            stat_key, md5 = cached.get(path, (None, None))
+            if stat_key == key:
+                md5s[i] = md5
+            else:
+                misses.append(i)
+        self.lock.acquire()
         try:
-            if self.root_id:
-                return self.root_id
-        except AttributeError:
+            self.hits = self.hits + len(file_paths) - len(misses)
+            self.misses = self.misses + len(misses)
+            if len(misses) > 1 and self.executor is None:
+                # 守护进程里有很多线程，fork出来的子进程可能继承别的线程持有的锁而死锁，所以用spawn启动
+                self.executor = ProcessPoolExecutor(HASH_PROCESS_COUNT,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+        finally:
+            self.lock.release()
+        if not misses:
+            return md5s
+        miss_paths = [paths[i] for i in misses]
+        if len(misses) == 1:
+            miss_md5s = [md5_file(miss_paths[0])]
+        else:
+            miss_md5s = list(self.executor.map(md5_file, miss_paths))
+        for i, md5 in zip(misses, miss_md5s):
+            md5s[i] = md5
+        self.connection_lock.acquire()
+        try:
+            self.connection.executemany('INSERT OR REPLACE INTO hashes (path, stat_key, md5) VALUES (?, ?, ?)',
+                                        [(paths[i], keys[i], md5s[i]) for i in misses])
+            self.connection.commit()
+        finally:
+            self.connection_lock.release()
+        self.lock.acquire()
+        try:
+            self.hashed_bytes = self.hashed_bytes + sum(int(keys[i].split(':')[2]) for i in misses)
+        finally:
+            self.lock.release()
+        return md5s
+
+    def get_stats(self):
+        self.connection_lock.acquire()
+        try:
+            files = self.connection.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+        finally:
+            self.connection_lock.release()
+        self.lock.acquire()
+        try:
+            return {'files': files, 'hits': self.hits, 'misses': self.misses, 'hashed_bytes': self.hashed_bytes}
+        finally:
+            self.lock.release()
+
+
+def get_mime_type(file_path):
+    """
+    按扩展名猜文件类型，和MediaFileUpload一样猜不出来时用STREAM_MIME_TYPE，两个引擎上传的同一个文件在谷歌硬盘上类型相同
+    :param file_path: 文件路径
+    :return: 文件类型
+    """
+    return mimetypes.guess_type(file_path)[0] or STREAM_MIME_TYPE
+
+
+def get_download_size(file):
+    """
+    要下载的文件的大小。谷歌文档等原生格式没有size，不能直接下载，当成0下载会得到一个空文件，所以直接报错
+    :param file: 下载文件的对象
+    :return: 文件大小
+    """
+    if 'size' not in file:
+        raise ValueError('文件没有大小，谷歌文档等原生格式无法直接下载 %s %s' % (file['id'], file.get('name')))
+    return int(file['size'])
+
+
+def check_range_response(file_id, status, content_range, start, end, length):
+    """
+    检查分段下载的响应是不是请求的那一段。代理或者服务器忽略Range返回200和整个文件时，写到start会覆盖相邻的段，
+    所以只接受206、Content-Range从start开始并且不超过请求长度的响应，否则抛出可重试的IOError
+    :param file_id: 文件id
+    :param status: 响应状态码
+    :param content_range: 响应的Content-Range头
+    :param start: 请求的开始字节
+    :param end: 请求的结束字节
+    :param length: 响应内容的长度
+    :return: 无返回
+    """
+    match = re.match(r'bytes (\d+)-(\d+)/', content_range or '')
+    if status != 206 or not match or int(match.group(1)) != start or length > end - start + 1:
+        raise IOError('分段下载返回的不是请求的分段 %s bytes=%d-%d 状态码%s Content-Range:%s 长度%d' % (
+            file_id, start, end, status, content_range, length))
+
+
+class DownloadCheckpoint(object):
+    """
+    断点下载的检查点，下载先写到文件旁边的.part文件，检查点保存在.part.json里，记录每一段下一个要下载的字节和结束字节。
+    数据fsync到.part文件后才更新检查点，重试或者重启后从记录的位置用Range请求继续下载，下载完成后改名成目标文件
+    """
+
+    def __init__(self, save_file_path, file):
+        self.save_file_path = save_file_path
+        self.part_path = save_file_path + PART_FILE_SUFFIX
+        self.checkpoint_path = self.part_path + '.json'
+        self.file_id = file['id']
+        self.size = get_download_size(file)
+        self.md5 = file.get('md5Checksum')
+        self.ranges = None
+        self.lock = threading.Lock()
+
+    def load(self, streams):
+        """
+        读取检查点，检查点和.part文件对不上(不存在、不是同一个文件或者大小、md5变了)时重新分段并创建.part文件，
+        远程文件内容被替换后不会把新旧内容拼在一起
+        :param streams: 重新分段时的段数
+        :return: 每一段的[下一个要下载的字节, 结束字节]
+        """
+        try:
+            with open(self.checkpoint_path, 'r') as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            if checkpoint['id'] == self.file_id and checkpoint['size'] == self.size and \
+                    checkpoint.get('md5') == self.md5 and os.path.getsize(self.part_path) == self.size:
+                self.ranges = checkpoint['ranges']
+                return self.ranges
+        except (IOError, OSError, ValueError, KeyError):
             pass
+        range_size = max(-(-self.size // streams), 1)
+        self.ranges = [[start, min(start + range_size, self.size) - 1] for start in range(0, self.size, range_size)]
+        if not self.ranges:
+            self.ranges = [[0, -1]]
+        with open(self.part_path, 'wb') as part_file:
+            part_file.truncate(self.size)
+        self.save()
+        return self.ranges
 
-        mark_files = self.search_files_by_name(MARK_FILE_NAME)
-        if not mark_files:
-            with open(MARK_FILE_NAME, 'w') as file:
-                file.write('这是' + APPLICATION_NAME + '的标记文件。')
-            mark_file = self.upload_file(MARK_FILE_NAME)
-            os.remove(MARK_FILE_NAME)
-        else:
-            mark_file = mark_files[0]
+    def get_downloaded_size(self):
+        """
+        已经下载的字节数
+        """
+        self.lock.acquire()
+        try:
+            remain = sum(end - start + 1 for start, end in self.ranges if start <= end)
+            return self.size - remain
+        finally:
+            self.lock.release()
 
-        folder_id = mark_file['id']
-        while True:
-            parent_folder_id = self.get_parent_folder(folder_id)
-            if parent_folder_id == folder_id:
-                break
+    def update(self, index, start, part_file):
+        """
+        先把.part文件fsync到磁盘，再把某一段的进度写进检查点
+        :param index: 第几段
+        :param start: 这一段下一个要下载的字节
+        :param part_file: 写这一段用的文件对象
+        :return: 无返回
+        """
+        part_file.flush()
+        os.fsync(part_file.fileno())
+        self.lock.acquire()
+        try:
+            self.ranges[index][0] = start
+            self.save()
+        finally:
+            self.lock.release()
+
+    def save(self):
+        with open(self.checkpoint_path + '.tmp', 'w') as checkpoint_file:
+            json.dump({'id': self.file_id, 'size': self.size, 'md5': self.md5, 'ranges': self.ranges},
+                      checkpoint_file)
+        os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+
+    def commit(self):
+        """
+        下载完成，把.part文件改名成目标文件并删除检查点。检查点里还有没下载的字节时不改名，避免留下不完整的目标文件
+        :return: 无返回
+        """
+        if self.get_downloaded_size() != self.size or os.path.getsize(self.part_path) != self.size:
+            raise IOError('下载没有完成，不能改名成目标文件 %s %d/%d' % (
+                self.save_file_path, self.get_downloaded_size(), self.size))
+        os.replace(self.part_path, self.save_file_path)
+        os.remove(self.checkpoint_path)
+
+
+class ChunkSizer(object):
+    """
+    根据测得的速度和往返时间调整分块大小。用最近CHUNK_SAMPLE_COUNT块的大小和耗时拟合 耗时 = 往返时间 + 大小 / 带宽，
+    每块的目标耗时是CHUNK_TARGET_SECONDS秒，往返时间长的时候延长到往返时间的CHUNK_ROUND_TRIP_RATIO倍，让往返时间只占一小部分。
+    分块大小按CHUNK_ALIGNMENT(可续传上传要求的256KiB)对齐，每次最多翻倍或者减半，并限制在上下限之间
+    """
+
+    def __init__(self, chunk_size=UPLOAD_CHUNK_SIZE, min_chunk_size=MIN_CHUNK_SIZE, max_chunk_size=MAX_CHUNK_SIZE):
+        self.min_chunk_size = max(self.align(min_chunk_size), CHUNK_ALIGNMENT)
+        self.max_chunk_size = max(self.align(max_chunk_size), self.min_chunk_size)
+        self.chunk_size = min(max(self.align(chunk_size), self.min_chunk_size), self.max_chunk_size)
+        self.bytes_per_second = None
+        self.bandwidth = None
+        self.round_trip_seconds = 0
+        self.transferred_bytes = 0
+        self.samples = collections.deque(maxlen=CHUNK_SAMPLE_COUNT)
+        self.lock = threading.Lock()
+
+    def align(self, size):
+        return int(size) // CHUNK_ALIGNMENT * CHUNK_ALIGNMENT
+
+    def record(self, size, seconds):
+        """
+        记录一块的传输字节数和耗时，并计算下一块的大小
+        :param size: 传输的字节数
+        :param seconds: 耗时，包含往返时间
+        :return: 下一块的大小
+        """
+        self.lock.acquire()
+        try:
+            self.transferred_bytes = self.transferred_bytes + size
+            if size <= 0 or seconds <= 0:
+                return self.chunk_size
+            bytes_per_second = size / seconds
+            if self.bytes_per_second is None:
+                self.bytes_per_second = bytes_per_second
             else:
-                folder_id = parent_folder_id
-        return folder_id
+                self.bytes_per_second = (self.bytes_per_second + bytes_per_second) / 2
+            self.samples.append((size, seconds))
+            self.fit_locked()
+            target_seconds = max(CHUNK_TARGET_SECONDS, self.round_trip_seconds * CHUNK_ROUND_TRIP_RATIO)
+            chunk_size = min(max(self.bandwidth * target_seconds, self.chunk_size / 2), self.chunk_size * 2)
+            self.chunk_size = min(max(self.align(chunk_size), self.min_chunk_size), self.max_chunk_size)
+            return self.chunk_size
+        finally:
+            self.lock.release()
 
-    def get_file_list(self, folder_id=None):
+    def fit_locked(self):
         """
-        获取某个文件夹下全部文件序列，默认在根目录
-        :param folder_id: 某个文件夹的id
-        :return: 某个文件夹下全部文件序列
+        最小二乘拟合带宽和往返时间，样本的大小都一样没法拟合时，沿用之前的往返时间估计带宽
         """
-        if not folder_id:
-            folder_id = self.get_root_id()
-        files = []
-        page_token = None
-        while True:
-            response = self.service.files().list(q="'" + folder_id + "' in parents and trashed = false",
-                                                 fields='nextPageToken, files(' + FILE_INFO + ')',
-                                                 pageToken=page_token).execute()
-            for file in response.get('files', []):
-                files.append(file)
-            page_token = response.get('nextPageToken', None)
-            if page_token is None:
-                break
-        return files
+        count = len(self.samples)
+        mean_size = sum(size for size, seconds in self.samples) / count
+        mean_seconds = sum(seconds for size, seconds in self.samples) / count
+        variance = sum((size - mean_size) ** 2 for size, seconds in self.samples)
+        if variance > 0:
+            slope = sum((size - mean_size) * (seconds - mean_seconds) for size, seconds in self.samples) / variance
+            if slope > 0:
+                self.bandwidth = 1 / slope
+                self.round_trip_seconds = max(mean_seconds - slope * mean_size, 0)
+                return
+        size, seconds = self.samples[-1]
+        if seconds > self.round_trip_seconds:
+            self.bandwidth = size / (seconds - self.round_trip_seconds)
+        else:
+            self.bandwidth = size / seconds
 
-    def search_files_by_name(self, file_name):
+    def get_stats(self):
         """
-        通过文件名寻找文件
-        :param file_name: 文件名
-        :return: 包含文件名的文件对象序列
+        当前分块大小和测得的速度
         """
-        files = []
-        page_token = None
-        while True:
-            response = self.service.files().list(q="name contains '" + file_name + "' and trashed = false",
-                                                 fields='nextPageToken, files(' + FILE_INFO + ')',
-                                                 pageToken=page_token).execute()
-            for file in response.get('files', []):
-                files.append(file)
-            page_token = response.get('nextPageToken', None)
-            if page_token is None:
-                break
-        return files
+        self.lock.acquire()
+        try:
+            return {'chunk_size': self.chunk_size, 'min_chunk_size': self.min_chunk_size,
+                    'max_chunk_size': self.max_chunk_size, 'transferred_bytes': self.transferred_bytes,
+                    'bytes_per_second': int(self.bytes_per_second) if self.bytes_per_second else None,
+                    'round_trip_seconds': self.round_trip_seconds}
+        finally:
+            self.lock.release()
 
-    def search_file_by_id(self, file_id):
-        return self.service.files().get(fileId=file_id,
-                                        fields=FILE_INFO).execute()
 
-    def get_parent_folder(self, file_id):
+class StreamUpload(MediaUpload):
+    """
+    从长度未知的流上传的可续传媒体，流可以是有read方法的对象(管道、标准输入)或者字节串的迭代器。
+    内存里只保留服务器还没确认的数据和下一块，最多两块多一个字节。读到流结束之前size返回None，
+    size在每次发送前被调用，这时预读到下一块之后的一个字节，流在下一块里结束时就返回总大小，最后一块带上总大小
+    """
+
+    def __init__(self, source, mimetype=STREAM_MIME_TYPE, chunksize=UPLOAD_CHUNK_SIZE):
+        self.source = source
+        self.iterator = None if hasattr(source, 'read') else iter(source)
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self.buffer = bytearray()
+        self.buffer_offset = 0
+        self.sent_offset = 0
+        self.eof = False
+        self.max_buffer_size = 0
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
         """
-        获取文件或者文件夹的父文件夹id
-        :param file_id: 文件或者文件夹id
-        :return: 父文件夹id
+        :return: 流结束前返回None，否则返回总大小
         """
-        file = self.search_file_by_id(file_id)
-        if not file:
-            return None
-        if file.get('parents') and file.get('parents')[0]:
-            return file.get('parents')[0]
-        else:
-            return file_id
+        self.fill(self.sent_offset + self._chunksize + 1)
+        return self.buffer_offset + len(self.buffer) if self.eof else None
 
-    def create_folder(self, folder_name, parent_folder_id=None):
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+    def fill(self, end):
         """
-        创建一个文件夹，默认在根目录下
-        :param folder_name: 文件夹名字
-        :param folder_id: 文件夹所在文件夹
-        :return: 新建文件夹对象
+        从流读到缓冲区包含end之前的数据或者流结束
+        :param end: 流里的位置
+        :return: 无返回
         """
-        if not parent_folder_id:
-            parent_folder_id = self.get_root_id()
-        folder_metadata = {
-            'name': folder_name,
-            'mimeType': 'application/vnd.google-apps.folder',
-            'parents': [parent_folder_id]
-        }
-        folder = self.service.files().create(body=folder_metadata,
-                                             fields=FILE_INFO).execute()
-        return folder
+        while not self.eof and self.buffer_offset + len(self.buffer) < end:
+            if self.iterator is None:
+                data = self.source.read(end - self.buffer_offset - len(self.buffer)) or None
+            else:
+                # 迭代器中间可以产生空的字节串(例如压缩器的输出)，只有迭代结束才是流结束
+                data = next(self.iterator, None)
+            if data is None:
+                self.eof = True
+            else:
+                self.buffer.extend(data)
+        self.max_buffer_size = max(self.max_buffer_size, len(self.buffer))
 
-    def upload_file(self, file_path, folder_id=None, file_name=None):
+    def getbytes(self, begin, length):
         """
-        上传文件，上传的文件名默认为本地文件名
-        :param file_path: 文件的本地路径
-        :param folder_id: 上传到哪个文件夹的id,默认为根目录
-        :param file_name: 重命名上传文件，默认原名
-        :return: 成功上传的文件对象
+        获取要发送的数据，begin之前的数据服务器已经确认收到，从缓冲区丢掉
+        :param begin: 服务器已经收到的字节数
+        :param length: 块大小
+        :return: 数据，比length短时是最后一块
         """
-        if not folder_id:
-            folder_id = self.get_root_id()
-        if not file_name:
-            file_name = os.path.basename(file_path)
-        file_metadata = {
-            'name': file_name,
-            'parents': [folder_id]
-        }
-        media = MediaFileUpload(file_path, resumable=True)
+        if begin < self.buffer_offset:
+            raise ValueError('流式上传无法重发已经丢掉的数据 %d < %d' % (begin, self.buffer_offset))
+        del self.buffer[:begin - self.buffer_offset]
+        self.buffer_offset = begin
+        self.fill(begin + length)
+        data = bytes(self.buffer[:length])
+        self.sent_offset = begin + len(data)
+        return data
 
-        file = self.service.files().create(body=file_metadata,
-                                           media_body=media,
-                                           fields=FILE_INFO).execute()
-        return file
 
-    def download_file_by_id(self, file_id, save_folder_path, status_func, file_name=None):
+class MetadataCache(object):
+    def __init__(self, size=METADATA_CACHE_SIZE, ttl=METADATA_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
         """
-        下载文件
-        :param file_id: 下载文件的id
-        :param save_file_path: 下载到本地的路径
-        :param status_func: 下载状态调用方法
-        :param file_name: 命名下载文件，默认原名
+        获取缓存，不存在或者已过期返回None
+        :param key: 缓存键
+        :return: 缓存值
+        """
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses = self.misses + 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits = self.hits + 1
+            return entry[1]
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        """
+        添加缓存，超过容量时淘汰最久没有使用的缓存
+        :param key: 缓存键
+        :param value: 缓存值
         :return: 无返回
         """
-        file = self.search_file_by_id(file_id)
-        self.download_file(file, save_folder_path, status_func, file_name)
+        self.lock.acquire()
+        try:
+            self.entries[key] = (time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def update(self, key, func):
+        """
+        在锁里修改还没过期的缓存，不存在或者已过期时不做任何事，过期时间不变
+        :param key: 缓存键
+        :param func: 传入旧值返回新值的方法
+        :return: 无返回
+        """
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] >= time():
+                self.entries[key] = (entry[0], func(entry[1]))
+        finally:
+            self.lock.release()
+
+    def invalidate(self, key):
+        """
+        删除缓存
+        :param key: 缓存键
+        :return: 无返回
+        """
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        """
+        获取缓存命中统计
+        :return: 统计map
+        """
+        self.lock.acquire()
+        try:
+            total = self.hits + self.misses
+            return {'size': len(self.entries), 'capacity': self.size, 'ttl': self.ttl, 'hits': self.hits,
+                    'misses': self.misses, 'hit_rate': float(self.hits) / total if total else 0.0}
+        finally:
+            self.lock.release()
+
+
+class MetadataSync(object):
+    def __init__(self, service):
+        self.service = service
+        self.files = {}
+        self.children = {}
+        self.page_token = None
+        self.last_refresh_time = 0
+        self.full_sync_api_calls = 0
+        self.refresh_count = 0
+        self.last_refresh_api_calls = 0
+        self.total_refresh_api_calls = 0
+        self.applied_changes = 0
+        self.lock = threading.Lock()
+
+    def full_sync(self):
+        """
+        全量列出硬盘全部文件，建立本地元数据，并记录changes的起始token
+        :return: 无返回
+        """
+        self.lock.acquire()
+        try:
+            api_calls = 1
+            page_token = self.service.changes().getStartPageToken().execute()['startPageToken']
+            self.files = {}
+            self.children = {}
+            list_page_token = None
+            while True:
+                response = self.service.files().list(q='trashed = false',
+                                                     pageSize=METADATA_SYNC_PAGE_SIZE,
+                                                     fields='nextPageToken, files(' + FILE_INFO + ')',
+                                                     pageToken=list_page_token).execute()
+                api_calls = api_calls + 1
+                for file in response.get('files', []):
+                    self.put_file_locked(file)
+                list_page_token = response.get('nextPageToken', None)
+                if list_page_token is None:
+                    break
+            self.page_token = page_token
+            self.last_refresh_time = time()
+            self.full_sync_api_calls = api_calls
+            print('元数据全量同步完成', len(self.files), '个文件', api_calls, '次请求')
+        finally:
+            self.lock.release()
+
+    def refresh(self):
+        """
+        通过changes接口获取上次同步之后的变化，并应用到本地元数据
+        :return: 本次刷新的请求次数
+        """
+        self.lock.acquire()
+        try:
+            api_calls = 0
+            page_token = self.page_token
+            while page_token is not None:
+                response = self.service.changes().list(pageToken=page_token,
+                                                       pageSize=METADATA_SYNC_PAGE_SIZE,
+                                                       fields='nextPageToken, newStartPageToken, '
+                                                              'changes(fileId, removed, file(' + FILE_INFO +
+                                                              ', trashed))').execute()
+                api_calls = api_calls + 1
+                for change in response.get('changes', []):
+                    file = change.get('file')
+                    if change.get('removed') or not file or file.get('trashed'):
+                        self.remove_file_locked(change['fileId'])
+                    else:
+                        self.put_file_locked(file)
+                    self.applied_changes = self.applied_changes + 1
+                if 'newStartPageToken' in response:
+                    self.page_token = response['newStartPageToken']
+                    break
+                page_token = response.get('nextPageToken', None)
+            self.last_refresh_time = time()
+            self.refresh_count = self.refresh_count + 1
+            self.last_refresh_api_calls = api_calls
+            self.total_refresh_api_calls = self.total_refresh_api_calls + api_calls
+            return api_calls
+        finally:
+            self.lock.release()
+
+    def refresh_if_stale(self):
+        """
+        距离上次同步超过METADATA_SYNC_INTERVAL秒则刷新
+        :return: 无返回
+        """
+        if time() - self.last_refresh_time > METADATA_SYNC_INTERVAL:
+            self.refresh()
+
+    def put_file_locked(self, file):
+        self.remove_file_locked(file['id'])
+        self.files[file['id']] = file
+        for parent_id in file.get('parents', []):
+            self.children.setdefault(parent_id, set()).add(file['id'])
+
+    def remove_file_locked(self, file_id):
+        file = self.files.pop(file_id, None)
+        if file:
+            for parent_id in file.get('parents', []):
+                self.children.get(parent_id, set()).discard(file_id)
+
+    def put_file(self, file):
+        """
+        把本程序新建或者修改的文件写入本地元数据，不用等下次刷新
+        :param file: 文件对象
+        :return: 无返回
+        """
+        self.lock.acquire()
+        try:
+            self.put_file_locked(file)
+        finally:
+            self.lock.release()
+
+    def get_file(self, file_id):
+        """
+        从本地元数据获取文件对象
+        :param file_id: 文件id
+        :return: 文件对象，不存在返回None
+        """
+        self.refresh_if_stale()
+        self.lock.acquire()
+        try:
+            return self.files.get(file_id)
+        finally:
+            self.lock.release()
+
+    def get_file_list(self, folder_id):
+        """
+        从本地元数据获取某个文件夹下全部文件序列
+        :param folder_id: 文件夹id
+        :return: 文件序列
+        """
+        self.refresh_if_stale()
+        self.lock.acquire()
+        try:
+            return [self.files[file_id] for file_id in self.children.get(folder_id, ())]
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        """
+        获取同步统计，relist_api_calls是逐个文件夹重新列出至少需要的请求次数，用于和增量刷新对比
+        :return: 统计map
+        """
+        self.lock.acquire()
+        try:
+            folders = len([file for file in self.files.values() if file['mimeType'] == FOLDER_MINE_TYPE])
+            return {'files': len(self.files), 'folders': folders, 'page_token': self.page_token,
+                    'full_sync_api_calls': self.full_sync_api_calls, 'relist_api_calls': folders + 1,
+                    'refresh_count': self.refresh_count, 'last_refresh_api_calls': self.last_refresh_api_calls,
+                    'total_refresh_api_calls': self.total_refresh_api_calls,
+                    'applied_changes': self.applied_changes}
+        finally:
+            self.lock.release()
+
+
+class RateGovernor(object):
+    """
+    全局的请求速率令牌桶，所有工作线程和jsonrpc处理共用，每秒补充rate个令牌，最多攒burst个。
+    令牌不够时可以先欠着，欠多少就等多少时间，批量请求可以一次取多个令牌。
+    被限流时暂停整个令牌桶，让所有线程一起退避。rate为0时不限制，也用作以字节为令牌的带宽令牌桶
+    """
+
+    def __init__(self, rate=REQUESTS_PER_SECOND, burst=REQUEST_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.update_time = time()
+        self.pause_until = 0
+        self.request_count = 0
+        self.wait_count = 0
+        self.wait_seconds = 0
+        self.throttle_count = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, count=1):
+        """
+        取令牌，不够时阻塞到令牌补充上来
+        :param count: 令牌数
+        :return: 等待的秒数
+        """
+        wait_seconds = self.reserve(count)
+        if wait_seconds > 0:
+            sleep(wait_seconds)
+        return wait_seconds
+
+    def reserve(self, count=1):
+        """
+        取令牌但不阻塞，由调用者自己等待，用于异步引擎
+        :param count: 令牌数
+        :return: 需要等待的秒数
+        """
+        if count <= 0:
+            return 0
+        self.lock.acquire()
+        try:
+            now = time()
+            if self.rate:
+                self.tokens = min(self.burst, self.tokens + (now - self.update_time) * self.rate) - count
+            else:
+                self.tokens = self.burst
+            self.update_time = now
+            wait_seconds = max(-self.tokens / self.rate if self.rate else 0, self.pause_until - now, 0)
+            self.request_count = self.request_count + count
+            if wait_seconds > 0:
+                self.wait_count = self.wait_count + 1
+                self.wait_seconds = self.wait_seconds + wait_seconds
+        finally:
+            self.lock.release()
+        return wait_seconds
+
+    def throttle(self, seconds):
+        """
+        被限流，暂停整个令牌桶
+        :param seconds: 暂停秒数
+        :return: 无返回
+        """
+        self.lock.acquire()
+        try:
+            self.throttle_count = self.throttle_count + 1
+            self.pause_until = max(self.pause_until, time() + seconds)
+        finally:
+            self.lock.release()
+
+    def set_rate(self, rate, burst=None):
+        self.lock.acquire()
+        try:
+            self.rate = rate
+            if burst:
+                self.burst = burst
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        self.lock.acquire()
+        try:
+            return {'rate': self.rate, 'burst': self.burst, 'requests': self.request_count,
+                    'waits': self.wait_count, 'wait_seconds': self.wait_seconds, 'throttles': self.throttle_count,
+                    'paused_seconds': max(self.pause_until - time(), 0)}
+        finally:
+            self.lock.release()
+
+
+RATE_GOVERNOR = RateGovernor()
+
+
+def get_bandwidth_burst(rate):
+    """
+    带宽令牌桶最多攒BANDWIDTH_BURST_SECONDS秒的字节
+    :param rate: 字节每秒
+    :return: 最多攒下的字节数
+    """
+    return max(int(rate * BANDWIDTH_BURST_SECONDS), 1)
+
+
+class BandwidthLimiter(object):
+    """
+    全局的上传和下载带宽限制，各是一个以字节为令牌的RateGovernor，限制为0时不限制。
+    每传输完一块按实际字节数取令牌，不够时等待欠下的时间，所以长时间的平均速度等于限制。
+    时间表按一天中的时间段设置限制，当前时间在某一段里时用这一段的限制，否则用默认限制，每次取令牌时检查。
+    工作可以有自己的带宽令牌桶，两个桶都取令牌，等待其中较长的时间
+    """
+
+    def __init__(self, upload_rate=UPLOAD_BYTES_PER_SECOND, download_rate=DOWNLOAD_BYTES_PER_SECOND):
+        self.rates = {False: upload_rate, True: download_rate}
+        self.schedule = []
+        self.governors = {False: RateGovernor(upload_rate, get_bandwidth_burst(upload_rate)),
+                          True: RateGovernor(download_rate, get_bandwidth_burst(download_rate))}
+        self.lock = threading.Lock()
+
+    def get_rate(self, is_download):
+        """
+        按时间表获取现在的限制
+        :param is_download: 是下载还是上传
+        :return: 字节每秒，0不限制
+        """
+        now = localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        direction = 'download' if is_download else 'upload'
+        self.lock.acquire()
+        try:
+            for period in self.schedule:
+                start, end = period['start_minute'], period['end_minute']
+                if (start <= minute < end if start < end else minute >= start or minute < end) \
+                        and direction in period:
+                    return period[direction]
+            return self.rates[is_download]
+        finally:
+            self.lock.release()
+
+    def consume(self, is_download, count, work=None):
+        """
+        传输完一块之后取令牌
+        :param is_download: 是下载还是上传
+        :param count: 传输的字节数
+        :param work: 所属的工作，有带宽限制时同时从工作的令牌桶取令牌
+        :return: 需要等待的秒数
+        """
+        rate = self.get_rate(is_download)
+        governor = self.governors[is_download]
+        if governor.rate != rate:
+            governor.set_rate(rate, get_bandwidth_burst(rate))
+        wait_seconds = governor.reserve(count)
+        if work and work.bandwidth:
+            wait_seconds = max(wait_seconds, work.bandwidth.reserve(count))
+        return wait_seconds
+
+    def set_limits(self, upload_rate=None, download_rate=None, schedule=None):
+        """
+        修改默认限制和时间表，不需要重启
+        :param upload_rate: 默认上传限制，字节每秒，None不修改
+        :param download_rate: 默认下载限制，字节每秒，None不修改
+        :param schedule: 时间表，[{'start': 'HH:MM', 'end': 'HH:MM', 'upload': 字节每秒, 'download': 字节每秒}]，
+        start大于end时跨过零点，upload和download可以只有一个，None不修改
+        :return: 修改是否成功
+        """
+        for rate in (upload_rate, download_rate):
+            if rate is not None and rate < 0:
+                return False
+        periods = None
+        if schedule is not None:
+            periods = []
+            try:
+                for period in schedule:
+                    period = dict(period)
+                    for name in ('start', 'end'):
+                        hour, minute = [int(value) for value in period[name].split(':')]
+                        if not 0 <= hour < 24 or not 0 <= minute < 60:
+                            return False
+                        period[name + '_minute'] = hour * 60 + minute
+                    for direction in ('upload', 'download'):
+                        if direction in period and period[direction] < 0:
+                            return False
+                    periods.append(period)
+            except (KeyError, ValueError, TypeError, AttributeError):
+                return False
+        self.lock.acquire()
+        try:
+            if upload_rate is not None:
+                self.rates[False] = upload_rate
+            if download_rate is not None:
+                self.rates[True] = download_rate
+            if periods is not None:
+                self.schedule = periods
+            return True
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        self.lock.acquire()
+        try:
+            stats = {'upload': self.rates[False], 'download': self.rates[True],
+                     'schedule': [dict((name, value) for name, value in period.items()
+                                       if not name.endswith('_minute')) for period in self.schedule]}
+        finally:
+            self.lock.release()
+        for is_download, direction in ((False, 'upload'), (True, 'download')):
+            governor_stats = self.governors[is_download].get_stats()
+            stats[direction + '_now'] = self.get_rate(is_download)
+            stats[direction + '_bytes'] = governor_stats['requests']
+            stats[direction + '_wait_seconds'] = governor_stats['wait_seconds']
+        return stats
+
+
+BANDWIDTH_LIMITER = BandwidthLimiter()
+
+
+def is_media_request(uri):
+    """
+    是否是上传下载数据块的请求(可续传上传的块、alt=media的下载和分段下载)。这些请求不占谷歌硬盘的请求配额，不从令牌桶取令牌，
+    否则一个大文件的每一块都要排队，令牌桶会卡住所有工作
+    :param uri: 请求地址
+    :return: 是否是数据块请求
+    """
+    return 'alt=media' in uri or 'upload_id=' in uri
+
+
+class GovernedHttp(httplib2.Http):
+    """
+    除了数据块请求，每个请求先从全局令牌桶取令牌的httplib2.Http
+    """
+
+    def __init__(self, governor=RATE_GOVERNOR, **kwargs):
+        httplib2.Http.__init__(self, **kwargs)
+        self.governor = governor
+        # 和googleapiclient.http.build_http一样，308是可续传上传的未完成响应，不当成重定向
+        self.redirect_codes = self.redirect_codes - {308}
+
+    def request(self, uri, *args, **kwargs):
+        if not is_media_request(uri):
+            self.governor.acquire()
+        return httplib2.Http.request(self, uri, *args, **kwargs)
+
+
+class RetryPolicy(object):
+    """
+    共用的重试策略。错误分成限流(429、403 userRateLimitExceeded/rateLimitExceeded)、可重试(5xx、408、网络错误)和致命三类，
+    限流和可重试的错误按指数退避加随机抖动等待后重试，限流时还会暂停全局令牌桶，致命错误和超过次数直接抛出
+    """
+
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, base_seconds=RETRY_BASE_SECONDS,
+                 max_seconds=RETRY_MAX_SECONDS, governor=RATE_GOVERNOR):
+        self.max_attempts = max_attempts
+        self.base_seconds = base_seconds
+        self.max_seconds = max_seconds
+        self.governor = governor
+
+    def classify(self, e):
+        """
+        给错误分类
+        :param e: 异常
+        :return: 'throttle'、'retry'或者'fatal'
+        """
+        if isinstance(e, HttpError):
+            status = e.resp.status
+            if status == 429:
+                return 'throttle'
+            if status == 403:
+                try:
+                    errors = json.loads(e.content.decode('utf-8'))['error']['errors']
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    errors = []
+                if any(error.get('reason') in RATE_LIMIT_REASONS for error in errors):
+                    return 'throttle'
+                return 'fatal'
+            if status >= 500 or status == 408:
+                return 'retry'
+            return 'fatal'
+        if isinstance(e, (FileNotFoundError, PermissionError, IsADirectoryError, NotADirectoryError)):
+            return 'fatal'
+        if isinstance(e, (OSError, httplib2.HttpLib2Error)):
+            return 'retry'
+        if aiohttp and isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError)):
+            return 'retry'
+        return 'fatal'
+
+    def get_delay(self, attempt, e=None):
+        """
+        第attempt次失败后的等待秒数，指数退避加全抖动，服务器给了Retry-After时至少等这么久
+        """
+        delay = random.uniform(0, min(self.max_seconds, self.base_seconds * 2 ** attempt))
+        if isinstance(e, HttpError):
+            try:
+                delay = max(delay, float(e.resp.get('retry-after', 0)))
+            except ValueError:
+                pass
+        return delay
+
+    def run(self, func, work=None, name=None):
+        """
+        按重试策略执行方法
+        :param func: 执行的方法
+        :param work: 记录重试和限流次数的工作对象
+        :param name: 打印用的名字
+        :return: 方法的返回值
+        """
+        attempt = 0
+        while True:
+            try:
+                return func()
+            except Exception as e:
+                attempt = attempt + 1
+                delay = self.get_retry_delay(e, attempt, work, name)
+                if delay is None:
+                    raise
+                sleep(delay)
+
+    async def run_async(self, func, work=None, name=None):
+        """
+        按重试策略执行协程，用于异步引擎
+        :param func: 返回协程的方法
+        :param work: 记录重试和限流次数的工作对象
+        :param name: 打印用的名字
+        :return: 协程的返回值
+        """
+        attempt = 0
+        while True:
+            try:
+                return await func()
+            except Exception as e:
+                attempt = attempt + 1
+                delay = self.get_retry_delay(e, attempt, work, name)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+
+    def get_retry_delay(self, e, attempt, work=None, name=None):
+        """
+        第attempt次失败后决定是否重试，限流时暂停令牌桶，并记录工作的重试和限流次数
+        :return: 重试前等待的秒数，不重试返回None
+        """
+        kind = self.classify(e)
+        if kind == 'fatal' or attempt >= self.max_attempts:
+            return None
+        delay = self.get_delay(attempt, e)
+        if kind == 'throttle':
+            self.governor.throttle(delay)
+            if work:
+                work.throttle_count = work.throttle_count + 1
+        if work:
+            work.retry_count = work.retry_count + 1
+        print(e)
+        print('失败，%.1f秒后第%d次重试' % (delay, attempt), name)
+        return delay
+
+
+RETRY_POLICY = RetryPolicy()
+
+
+class ServicePool(object):
+    """
+    谷歌硬盘服务对象池。httplib2.Http不是线程安全的，每个线程借出一个服务对象，用完归还，
+    归还的服务对象保留着已经建立的连接。所有服务对象共用同一个资格证书，过期时只刷新一次
+    """
+
+    def __init__(self, build_service, credentials=None):
+        self.build_service = build_service
+        self.credentials = credentials
+        self.services = []
+        self.created_count = 0
+        self.checked_out_count = 0
+        self.refresh_count = 0
+        self.lock = threading.Lock()
+
+    def checkout(self):
+        """
+        借出一个服务对象，没有空闲的服务对象时新建一个
+        :return: 谷歌硬盘服务对象
+        """
+        self.refresh_credentials()
+        self.lock.acquire()
+        try:
+            self.checked_out_count = self.checked_out_count + 1
+            if self.services:
+                return self.services.pop()
+            self.created_count = self.created_count + 1
+        finally:
+            self.lock.release()
+        http = GovernedHttp(timeout=HTTP_TIMEOUT)
+        if self.credentials:
+            http = self.credentials.authorize(http)
+        return self.build_service(http)
+
+    def refresh_credentials(self):
+        """
+        资格证书过期时刷新，多个线程同时发现过期时只刷新一次
+        :return: 无返回
+        """
+        self.lock.acquire()
+        try:
+            if self.credentials and self.credentials.access_token_expired:
+                self.credentials.refresh(httplib2.Http())
+                self.refresh_count = self.refresh_count + 1
+        finally:
+            self.lock.release()
+
+    def checkin(self, service):
+        """
+        归还服务对象
+        :param service: 借出的服务对象
+        :return: 无返回
+        """
+        self.lock.acquire()
+        try:
+            self.checked_out_count = self.checked_out_count - 1
+            self.services.append(service)
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        """
+        获取服务对象池统计
+        :return: 统计map
+        """
+        self.lock.acquire()
+        try:
+            return {'created': self.created_count, 'idle': len(self.services),
+                    'checked_out': self.checked_out_count, 'credentials_refreshes': self.refresh_count}
+        finally:
+            self.lock.release()
+
+
+class GoogleDiverAPI(object):
+    def __init__(self, metadata_cache=None, metadata_sync=None, root_id=None, service_pool=None, upload_journal=None,
+                 hash_cache=None):
+        self.metadata_cache = metadata_cache if metadata_cache else MetadataCache()
+        self.metadata_sync = metadata_sync
+        self.upload_journal = upload_journal if upload_journal else UploadJournal()
+        self.hash_cache = hash_cache if hash_cache else HashCache()
+        if service_pool:
+            self.service_pool = service_pool
+        else:
+            self.startup_state = STARTUP_TIMER.measure('load_state', StartupState)
+            credentials = None if DRIVE_API_URL else STARTUP_TIMER.measure('credentials', self.get_credentials)
+            self.service_pool = ServicePool(self.get_service, credentials)
+        self.service = self.service_pool.checkout()
+        self.root_id = root_id
+        self.root_id = STARTUP_TIMER.measure('root_id', self.get_root_id)
+
+    def get_temp_file(self):
+        """
+        获取临时文件
+        :return: 无返回
+        """
+        request = requests.get('http://www.cellargalaxy.top/pythonGoogleDiver.json')
+        with open(TEMP_FILE_NAME, 'w') as file:
+            file.write(json.dumps(request.json()))
+
+    def delete_temp_file(self):
+        """
+        删除临时文件
+        :return: 无返回
+        """
+        os.remove(TEMP_FILE_NAME)
+
+    def get_credentials(self):
+        """
+        通过密匙json获取客户的登录权限并生成资格证书
+        Returns: 资格证书对象
+        """
+        # 这个应该意思是谷歌的应用商店对象
+        store = Storage(CLIENT_JSON_FILE_NAME)
+        credentials = store.get()
+        # 如果获取证书失败或者证书失效
+        if not credentials or credentials.invalid:
+            self.get_temp_file()
+            flow = client.flow_from_clientsecrets(TEMP_FILE_NAME, SCOPES)
+            flow.user_agent = APPLICATION_NAME
+            self.delete_temp_file()
+            if flags:
+                credentials = tools.run_flow(flow, store, flags)
+            else:  # Needed only for compatibility with Python 2.6
+                credentials = tools.run(flow, store)
+            print('客户证书：' + CLIENT_JSON_FILE_NAME)
+        return credentials
+
+    def get_service(self, http):
+        """
+        获取谷歌硬盘服务对象
+        :param http: 已授权的http对象
+        :return: 谷歌硬盘服务对象
+        """
+        document = STARTUP_TIMER.measure('discovery', get_discovery_document)
+        # 以前的版本把discovery文档保存在启动信息里，现在用随库发布的文档，删掉旧的
+        self.startup_state.remove('discovery_document')
+        return STARTUP_TIMER.measure('build_service', discovery.build_from_document, document, http=http)
+
+    def get_root_id(self):
+        """
+        获取根目录id，优先使用保存的根目录id，并用一次请求确认它仍然是根目录
+        :return: 目录id
+        """
+        try:
+            if self.root_id:
+                return self.root_id
+        except AttributeError:
+            pass
+
+        root_id = self.startup_state.get('root_id')
+        if root_id and self.is_root_folder(root_id):
+            return root_id
+
+        mark_files = self.search_files_by_name(MARK_FILE_NAME)
+        if not mark_files:
+            with open(MARK_FILE_NAME, 'w') as file:
+                file.write('这是' + APPLICATION_NAME + '的标记文件。')
+            mark_file = self.upload_file(MARK_FILE_NAME, 'root')
+            os.remove(MARK_FILE_NAME)
+        else:
+            mark_file = mark_files[0]
+
+        folder_id = mark_file['id']
+        while True:
+            parent_folder_id = self.get_parent_folder(folder_id)
+            if parent_folder_id == folder_id:
+                break
+            else:
+                folder_id = parent_folder_id
+        self.startup_state.put('root_id', folder_id)
+        return folder_id
+
+    def is_root_folder(self, folder_id):
+        """
+        确认某个文件夹是否是根目录，根目录没有父文件夹
+        :param folder_id: 文件夹id
+        :return: 是否是根目录
+        """
+        try:
+            folder = self.service.files().get(fileId=folder_id, fields='id, parents, trashed').execute()
+            return not folder.get('parents') and not folder.get('trashed')
+        except Exception as e:
+            print(e)
+            print('保存的根目录id失效', folder_id)
+            return False
+
+    def get_file_list(self, folder_id=None):
+        """
+        获取某个文件夹下全部文件序列，默认在根目录
+        :param folder_id: 某个文件夹的id
+        :return: 某个文件夹下全部文件序列
+        """
+        if not folder_id:
+            folder_id = self.get_root_id()
+        if self.metadata_sync:
+            return self.metadata_sync.get_file_list(folder_id)
+        files = self.metadata_cache.get(('list', folder_id))
+        if files is not None:
+            return files
+        files = []
+        page_token = None
+        while True:
+            response = self.service.files().list(q="'" + folder_id + "' in parents and trashed = false",
+                                                 fields='nextPageToken, files(' + FILE_INFO + ')',
+                                                 pageToken=page_token).execute()
+            for file in response.get('files', []):
+                files.append(file)
+                self.metadata_cache.put(('file', file['id']), file)
+            page_token = response.get('nextPageToken', None)
+            if page_token is None:
+                break
+        self.metadata_cache.put(('list', folder_id), files)
+        return files
+
+    def search_files_by_name(self, file_name):
+        """
+        通过文件名寻找文件
+        :param file_name: 文件名
+        :return: 包含文件名的文件对象序列
+        """
+        files = []
+        page_token = None
+        while True:
+            response = self.service.files().list(q="name contains '" + file_name + "' and trashed = false",
+                                                 fields='nextPageToken, files(' + FILE_INFO + ')',
+                                                 pageToken=page_token).execute()
+            for file in response.get('files', []):
+                files.append(file)
+            page_token = response.get('nextPageToken', None)
+            if page_token is None:
+                break
+        return files
+
+    def get_subtree(self, folder_id):
+        """
+        列出文件夹下的整个子树。按层广度优先，每层的文件夹每SUBTREE_QUERY_PARENTS个合成一个
+        'a' in parents or 'b' in parents ...的查询，每页SUBTREE_PAGE_SIZE个，只要FILE_INFO字段，各组查询同时进行。
+        请求次数随层数和页数增长，而不是随文件夹数增长。列出的文件和文件列表放进元数据缓存，之后的下载不用再请求
+        :param folder_id: 文件夹id
+        :return: 文件夹id到子文件序列的map
+        """
+        children = {}
+        level = [folder_id]
+        if self.metadata_sync:
+            while level:
+                next_level = []
+                for parent_id in level:
+                    children[parent_id] = self.metadata_sync.get_file_list(parent_id)
+                    next_level.extend(file['id'] for file in children[parent_id]
+                                      if self.is_folder(file) and file['id'] not in children)
+                level = next_level
+            return children
+        executor = ThreadPoolExecutor(SUBTREE_LIST_THREADS)
+        try:
+            while level:
+                for parent_id in level:
+                    children[parent_id] = []
+                groups = [level[i:i + SUBTREE_QUERY_PARENTS] for i in range(0, len(level), SUBTREE_QUERY_PARENTS)]
+                next_level = []
+                for group, files in zip(groups, executor.map(self.list_children, groups)):
+                    group_ids = set(group)
+                    for file in files:
+                        for parent_id in file.get('parents', []):
+                            if parent_id in group_ids:
+                                children[parent_id].append(file)
+                        self.metadata_cache.put(('file', file['id']), file)
+                        if self.is_folder(file) and file['id'] not in children:
+                            next_level.append(file['id'])
+                level = list(collections.OrderedDict.fromkeys(next_level))
+        finally:
+            executor.shutdown()
+        for parent_id, files in children.items():
+            self.metadata_cache.put(('list', parent_id), files)
+        return children
+
+    def list_children(self, folder_ids):
+        """
+        借一个服务对象，用一个多父文件夹查询分页列出多个文件夹的子文件
+        :param folder_ids: 文件夹id序列
+        :return: 子文件序列
+        """
+        q = '(' + ' or '.join("'" + folder_id + "' in parents" for folder_id in folder_ids) + ') and trashed = false'
+        service = self.service_pool.checkout()
+        try:
+            files = []
+            page_token = None
+            while True:
+                response = service.files().list(q=q, pageSize=SUBTREE_PAGE_SIZE,
+                                                fields='nextPageToken, files(' + FILE_INFO + ')',
+                                                pageToken=page_token).execute()
+                files.extend(response.get('files', []))
+                page_token = response.get('nextPageToken', None)
+                if page_token is None:
+                    return files
+        finally:
+            self.service_pool.checkin(service)
+
+    def search_file_by_id(self, file_id):
+        """
+        通过id获取文件对象，优先从元数据缓存获取
+        :param file_id: 文件id
+        :return: 文件对象
+        """
+        file = self.get_cached_file(file_id)
+        if file is not None:
+            return file
+        file = self.service.files().get(fileId=file_id,
+                                        fields=FILE_INFO).execute()
+        self.metadata_cache.put(('file', file_id), file)
+        return file
+
+    def search_files_by_id(self, file_ids):
+        """
+        批量通过id获取文件对象，缓存中没有的合并成批量请求
+        :param file_ids: 文件id序列
+        :return: 与id一一对应的文件对象序列，获取失败的对应异常对象
+        """
+        files = [self.get_cached_file(file_id) for file_id in file_ids]
+        miss_indexes = [i for i in range(len(files)) if files[i] is None]
+        results = self.execute_batch([self.service.files().get(fileId=file_ids[i], fields=FILE_INFO)
+                                      for i in miss_indexes])
+        for i, result in zip(miss_indexes, results):
+            if not isinstance(result, Exception):
+                self.metadata_cache.put(('file', file_ids[i]), result)
+            files[i] = result
+        return files
+
+    def get_cached_file(self, file_id):
+        """
+        从元数据同步或者元数据缓存中获取文件对象
+        :param file_id: 文件id
+        :return: 文件对象，没有缓存返回None
+        """
+        if self.metadata_sync:
+            file = self.metadata_sync.get_file(file_id)
+            if file is not None:
+                return file
+        return self.metadata_cache.get(('file', file_id))
+
+    def cache_file(self, file, changed_folder_ids):
+        """
+        新建或者修改文件后更新元数据缓存，并更新受影响文件夹的文件列表缓存，
+        文件还在这个文件夹里就替换或者加进列表，不在了就从列表删除
+        :param file: 新建或者修改后的文件对象
+        :param changed_folder_ids: 文件列表发生变化的文件夹id序列
+        :return: 无返回
+        """
+        for folder_id in changed_folder_ids:
+            in_folder = folder_id in file.get('parents', [])
+            self.metadata_cache.update(('list', folder_id),
+                                       lambda files, in_folder=in_folder: [f for f in files if f['id'] != file['id']] +
+                                                                          ([file] if in_folder else []))
+        self.metadata_cache.put(('file', file['id']), file)
+        if self.metadata_sync:
+            self.metadata_sync.put_file(file)
+
+    def execute_batch(self, requests):
+        """
+        把多个请求合并成批量请求执行，每批最多BATCH_SIZE个请求
+        :param requests: 请求序列
+        :return: 与请求一一对应的结果序列，失败的请求对应异常对象
+        """
+        results = [None] * len(requests)
+
+        def callback(request_id, response, exception):
+            results[int(request_id)] = exception if exception else response
+
+        for start in range(0, len(requests), BATCH_SIZE):
+            batch = self.service.new_batch_http_request(callback=callback)
+            count = 0
+            for i in range(start, min(start + BATCH_SIZE, len(requests))):
+                batch.add(requests[i], request_id=str(i))
+                count = count + 1
+            # 批量里的每个请求都算配额，http请求本身会再取一个令牌
+            RATE_GOVERNOR.acquire(count - 1)
+            batch.execute()
+        return results
+
+    def get_parent_folder(self, file_id):
+        """
+        获取文件或者文件夹的父文件夹id
+        :param file_id: 文件或者文件夹id
+        :return: 父文件夹id
+        """
+        file = self.search_file_by_id(file_id)
+        if not file:
+            return None
+        if file.get('parents') and file.get('parents')[0]:
+            return file.get('parents')[0]
+        else:
+            return file_id
+
+    def create_folder(self, folder_name, parent_folder_id=None):
+        """
+        创建一个文件夹，默认在根目录下
+        :param folder_name: 文件夹名字
+        :param folder_id: 文件夹所在文件夹
+        :return: 新建文件夹对象
+        """
+        if not parent_folder_id:
+            parent_folder_id = self.get_root_id()
+        folder_metadata = {
+            'name': folder_name,
+            'mimeType': 'application/vnd.google-apps.folder',
+            'parents': [parent_folder_id]
+        }
+        folder = self.service.files().create(body=folder_metadata,
+                                             fields=FILE_INFO).execute()
+        self.cache_file(folder, [parent_folder_id])
+        self.metadata_cache.put(('list', folder['id']), [])
+        return folder
+
+    def create_folders(self, folders):
+        """
+        批量创建文件夹
+        :param folders: (文件夹名字, 所在文件夹id)序列
+        :return: 与参数一一对应的新建文件夹对象序列，创建失败的对应异常对象
+        """
+        requests = []
+        for folder_name, parent_folder_id in folders:
+            folder_metadata = {
+                'name': folder_name,
+                'mimeType': FOLDER_MINE_TYPE,
+                'parents': [parent_folder_id]
+            }
+            requests.append(self.service.files().create(body=folder_metadata, fields=FILE_INFO))
+        results = self.execute_batch(requests)
+        for (folder_name, parent_folder_id), result in zip(folders, results):
+            if not isinstance(result, Exception):
+                self.cache_file(result, [parent_folder_id])
+                self.metadata_cache.put(('list', result['id']), [])
+        return results
+
+    def find_same_files(self, file_paths, folder_id, file_names=None, remote_files=None):
+        """
+        在文件夹里找和本地文件内容相同的同名文件。只有同名同大小的远程文件才需要算本地文件的md5
+        :param file_paths: 本地文件路径序列
+        :param folder_id: 文件夹id
+        :param file_names: 远程文件名序列，默认和本地文件同名
+        :param remote_files: 文件夹下的文件序列，已经得到时传入，不用再请求
+        :return: 与本地文件一一对应的相同远程文件对象序列，没有相同文件的对应None
+        """
+        if not file_names:
+            file_names = [os.path.basename(file_path) for file_path in file_paths]
+        if remote_files is None:
+            remote_files = self.get_file_list(folder_id)
+        candidates = {}
+        for file in remote_files:
+            if file.get('md5Checksum') and 'size' in file:
+                candidates.setdefault((file['name'], int(file['size'])), []).append(file)
+        same_files = [None] * len(file_paths)
+        candidate_names = set(name for name, size in candidates)
+        hash_indexes = [i for i, (file_path, file_name) in enumerate(zip(file_paths, file_names))
+                        if file_name in candidate_names and (file_name, os.path.getsize(file_path)) in candidates]
+        md5s = self.hash_cache.get_md5s([file_paths[i] for i in hash_indexes])
+        for i, md5 in zip(hash_indexes, md5s):
+            for file in candidates[(file_names[i], os.path.getsize(file_paths[i]))]:
+                if file['md5Checksum'] == md5:
+                    same_files[i] = file
+                    break
+        return same_files
+
+    def upload_file(self, file_path, folder_id=None, file_name=None, chunk_sizer=None, work=None):
+        """
+        上传文件，上传的文件名默认为本地文件名，文件夹里已经有内容相同的同名文件时跳过上传。
+        小于MULTIPART_UPLOAD_THRESHOLD的文件用一次multipart请求上传，省掉创建可续传会话的往返，
+        其他文件用可续传上传，每上传一块按BANDWIDTH_LIMITER限速
+        :param file_path: 文件的本地路径
+        :param folder_id: 上传到哪个文件夹的id,默认为根目录
+        :param file_name: 重命名上传文件，默认原名
+        :param chunk_sizer: 分块大小调整器，默认从UPLOAD_CHUNK_SIZE开始调整
+        :param work: 所属的工作，按工作的带宽上限限速
+        :return: 成功上传的文件对象，跳过时返回已有的文件对象
+        """
+        if not chunk_sizer:
+            chunk_sizer = ChunkSizer(UPLOAD_CHUNK_SIZE)
+        if not folder_id:
+            folder_id = self.get_root_id()
+        if not file_name:
+            file_name = os.path.basename(file_path)
+        same_file = self.find_same_files([file_path], folder_id, [file_name])[0]
+        if same_file:
+            print('文件没有变化，跳过上传', file_path)
+            return same_file
+        file_metadata = {
+            'name': file_name,
+            'parents': [folder_id]
+        }
+        upload = self.upload_journal.get_upload(file_path, folder_id, file_name)
+        size = os.path.getsize(file_path)
+        if not upload and size < MULTIPART_UPLOAD_THRESHOLD:
+            file = self.service.files().create(body=file_metadata,
+                                               media_body=MediaFileUpload(file_path, resumable=False),
+                                               fields=FILE_INFO).execute()
+            sleep(BANDWIDTH_LIMITER.consume(False, size, work))
+            self.cache_file(file, [folder_id])
+            return file
+        media = MediaFileUpload(file_path, chunksize=chunk_sizer.chunk_size, resumable=True)
+
+        request = self.service.files().create(body=file_metadata,
+                                              media_body=media,
+                                              fields=FILE_INFO)
+        if upload:
+            print('继续上传', file_path, upload['offset'])
+            request.resumable_uri = upload['resumable_uri']
+            request.resumable_progress = upload['offset']
+            # 先向服务器查询实际已接收的字节数再继续
+            request._in_error_state = True
+        file = None
+        try:
+            while file is None:
+                media._chunksize = chunk_sizer.chunk_size
+                progress = request.resumable_progress
+                start_time = time()
+                status, file = request.next_chunk()
+                sent = (request.resumable_progress if file is None else media.size()) - progress
+                chunk_sizer.record(sent, time() - start_time)
+                sleep(BANDWIDTH_LIMITER.consume(False, sent, work))
+                if file is None:
+                    self.upload_journal.put_upload(file_path, folder_id, file_name, request.resumable_uri,
+                                                   request.resumable_progress)
+        except HttpError as e:
+            if upload and e.resp.status in (404, 410):
+                print('上传会话已失效，重新上传', file_path)
+                self.upload_journal.remove_upload(file_path, folder_id, file_name)
+                return self.upload_file(file_path, folder_id, file_name, chunk_sizer, work)
+            raise
+        self.upload_journal.remove_upload(file_path, folder_id, file_name)
+        self.cache_file(file, [folder_id])
+        return file
+
+    def upload_stream(self, stream, file_name, folder_id=None, chunk_sizer=None, mimetype=STREAM_MIME_TYPE, work=None):
+        """
+        从长度未知的流上传文件，不用先写到本地文件，内存里最多保留两块数据。
+        流没法重新读，不能像upload_file那样整个重试，也不能在重启后继续，
+        每一块单独按RETRY_POLICY重试，重试前先向服务器查询已经收到的字节数
+        :param stream: 有read方法的对象或者字节串的迭代器，例如sys.stdin.buffer
+        :param file_name: 上传的文件名
+        :param folder_id: 上传到哪个文件夹的id，默认为根目录
+        :param chunk_sizer: 分块大小调整器，默认从UPLOAD_CHUNK_SIZE开始调整，最大STREAM_MAX_CHUNK_SIZE
+        :param mimetype: 文件类型
+        :param work: 所属的工作，记录重试次数并按工作的带宽上限限速
+        :return: 上传的文件对象
+        """
+        if not chunk_sizer:
+            chunk_sizer = ChunkSizer(UPLOAD_CHUNK_SIZE, MIN_CHUNK_SIZE, STREAM_MAX_CHUNK_SIZE)
+        if not folder_id:
+            folder_id = self.get_root_id()
+        media = StreamUpload(stream, mimetype, chunk_sizer.chunk_size)
+        request = self.service.files().create(body={'name': file_name, 'parents': [folder_id]}, media_body=media,
+                                              fields=FILE_INFO)
+
+        def next_chunk():
+            try:
+                return request.next_chunk()
+            except Exception:
+                if request.resumable_uri:
+                    request._in_error_state = True
+                raise
+
+        file = None
+        while file is None:
+            media._chunksize = chunk_sizer.chunk_size
+            progress = request.resumable_progress
+            start_time = time()
+            status, file = RETRY_POLICY.run(next_chunk, work, file_name)
+            sent = (request.resumable_progress if file is None else media.size()) - progress
+            chunk_sizer.record(sent, time() - start_time)
+            sleep(BANDWIDTH_LIMITER.consume(False, sent, work))
+        print('流式上传完成', file_name, media.size(), '最多缓存', media.max_buffer_size)
+        self.cache_file(file, [folder_id])
+        return file
+
+    def download_file_by_id(self, file_id, save_folder_path, status_func, file_name=None):
+        """
+        下载文件
+        :param file_id: 下载文件的id
+        :param save_file_path: 下载到本地的路径
+        :param status_func: 下载状态调用方法
+        :param file_name: 命名下载文件，默认原名
+        :return: 无返回
+        """
+        file = self.search_file_by_id(file_id)
+        self.download_file(file, save_folder_path, status_func, file_name)
+
+    def find_same_local_files(self, files, save_folder_path, policy=None):
+        """
+        按下载策略检查本地是否已经有和远程文件相同的文件，md5从本地文件md5缓存获取
+        :param files: 远程文件对象序列
+        :param save_folder_path: 保存到的本地文件夹
+        :param policy: 下载策略，always总是下载，if-size-differs大小相同就跳过，if-md5-differs大小和md5都相同才跳过，默认DOWNLOAD_POLICY
+        :return: 与远程文件一一对应的本地是否已有相同文件的序列
+        """
+        if not policy:
+            policy = DOWNLOAD_POLICY
+        same = [False] * len(files)
+        if policy == 'always':
+            return same
+        hash_indexes = []
+        for i, file in enumerate(files):
+            file_path = save_folder_path + '/' + file['name']
+            if 'size' not in file or not os.path.isfile(file_path) or os.path.getsize(file_path) != int(file['size']):
+                continue
+            if policy == 'if-size-differs':
+                same[i] = True
+            elif file.get('md5Checksum'):
+                hash_indexes.append(i)
+        md5s = self.hash_cache.get_md5s([save_folder_path + '/' + files[i]['name'] for i in hash_indexes])
+        for i, md5 in zip(hash_indexes, md5s):
+            same[i] = files[i]['md5Checksum'] == md5
+        return same
+
+    def download_file(self, file, save_folder_path, status_func, file_name=None, streams=PARALLEL_DOWNLOAD_STREAMS,
+                      chunk_sizer=None, policy=None, work=None):
+        """
+        下载文件，文件大小不小于PARALLEL_DOWNLOAD_THRESHOLD时分成多段同时下载。
+        下载先写到.part文件并记录检查点，上次没下载完的从检查点继续，全部下载完才改名成目标文件。
+        按下载策略本地已经有相同文件时跳过。每下载一块按BANDWIDTH_LIMITER限速
+        :param file: 下载文件的对象
+        :param save_file_path: 下载到本地的路径
+        :param status_func: 下载状态调用方法
+        :param file_name: 命名下载文件，默认原名
+        :param streams: 分段下载的连接数
+        :param chunk_sizer: 分块大小调整器，默认从DOWNLOAD_CHUNK_SIZE开始调整
+        :param policy: 下载策略，默认DOWNLOAD_POLICY
+        :param work: 所属的工作，按工作的带宽上限限速
+        :return: 无返回
+        """
+        if not chunk_sizer:
+            chunk_sizer = ChunkSizer(DOWNLOAD_CHUNK_SIZE)
+        if not os.path.exists(save_folder_path):
+            os.makedirs(save_folder_path)
+        if not file_name:
+            file_name = file['name']
+        size = get_download_size(file)
+        if self.find_same_local_files([dict(file, name=file_name)], save_folder_path, policy)[0]:
+            print('本地文件没有变化，跳过下载', save_folder_path + '/' + file_name)
+            status_func(file, MediaDownloadProgress(size, size), True)
+            return
+
+        if streams < 1 or size < PARALLEL_DOWNLOAD_THRESHOLD:
+            streams = 1
+        checkpoint = DownloadCheckpoint(save_folder_path + '/' + file_name, file)
+        ranges = checkpoint.load(streams)
+        if checkpoint.get_downloaded_size() > 0:
+            print('继续下载', file['name'], checkpoint.get_downloaded_size())
+        if len(ranges) > 1:
+            self.download_file_by_ranges(file, checkpoint, status_func, chunk_sizer, work)
+        elif ranges[0][0] <= ranges[0][1]:
+            with open(checkpoint.part_path, 'r+b') as save_file:
+                save_file.seek(ranges[0][0])
+                request = self.service.files().get_media(fileId=file['id'])
+                downloader = MediaIoBaseDownload(save_file, request, chunksize=chunk_sizer.chunk_size)
+                downloader._progress = ranges[0][0]
+                done = False
+                while not done:
+                    downloader._chunksize = chunk_sizer.chunk_size
+                    progress = downloader._progress
+                    start_time = time()
+                    status, done = downloader.next_chunk()
+                    chunk_sizer.record(downloader._progress - progress, time() - start_time)
+                    checkpoint.update(0, downloader._progress, save_file)
+                    status_func(file, status, done)
+                    sleep(BANDWIDTH_LIMITER.consume(True, downloader._progress - progress, work))
+        else:
+            status_func(file, MediaDownloadProgress(checkpoint.size, checkpoint.size), True)
+        checkpoint.commit()
+
+    def download_file_by_ranges(self, file, checkpoint, status_func, chunk_sizer, work=None):
+        """
+        按检查点里的分段，每段从服务对象池借一个服务对象用Range请求同时下载，写到.part文件的对应位置，
+        每下载一块更新一次这一段的检查点
+        :param file: 下载文件的对象
+        :param checkpoint: 下载的检查点
+        :param status_func: 下载状态调用方法，各段的进度合并后调用
+        :param chunk_sizer: 分块大小调整器，各段共用，按单个连接的速度调整
+        :param work: 所属的工作，各段共用工作的带宽上限
+        :return: 无返回
+        """
+        size = checkpoint.size
+        progress = [checkpoint.get_downloaded_size()]
+        errors = []
+        lock = threading.Lock()
+
+        def download_range(index, start, end):
+            service = self.service_pool.checkout()
+            try:
+                with open(checkpoint.part_path, 'r+b') as save_file:
+                    save_file.seek(start)
+                    while start <= end:
+                        request_end = min(start + chunk_sizer.chunk_size - 1, end)
+                        request = service.files().get_media(fileId=file['id'])
+                        request.headers['range'] = 'bytes=%d-%d' % (start, request_end)
+                        # 默认只返回内容，要检查状态码和Content-Range
+                        request.postproc = lambda response, content: (response, content)
+                        start_time = time()
+                        response, content = request.execute()
+                        chunk_sizer.record(len(content), time() - start_time)
+                        check_range_response(file['id'], response.status, response.get('content-range'), start,
+                                             request_end, len(content))
+                        if not content:
+                            raise IOError('分段下载没有返回数据 %s bytes=%d-%d' % (file['id'], start, end))
+                        save_file.write(content)
+                        start = start + len(content)
+                        checkpoint.update(index, start, save_file)
+                        lock.acquire()
+                        try:
+                            progress[0] = progress[0] + len(content)
+                            status_func(file, MediaDownloadProgress(progress[0], size), False)
+                        finally:
+                            lock.release()
+                        sleep(BANDWIDTH_LIMITER.consume(True, len(content), work))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                self.service_pool.checkin(service)
+
+        threads = [threading.Thread(target=download_range, args=(index, start, end))
+                   for index, (start, end) in enumerate(checkpoint.ranges) if start <= end]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        status_func(file, MediaDownloadProgress(size, size), True)
+
+    def is_folder_by_id(self, file_id):
+        """
+        某个文件是否是文件夹
+        :param file_id: 文件id
+        :return: 是否是文件夹
+        """
+        file = self.search_file_by_id(file_id)
+        return self.is_folder(file)
+
+    def is_folder(self, file):
+        """
+        某个文件是否是文件夹
+        :param file: 文件对象
+        :return: 是否是文件夹
+        """
+        if file['mimeType'] == FOLDER_MINE_TYPE:
+            return True
+        else:
+            return False
+
+    def move_file(self, file_id, folder_id):
+        """
+        移动文件到另一个文件夹下
+        :param file_id: 文件或文件夹id
+        :param folder_id: 目的地文件夹
+        :return: 移动后的文件对象
+        """
+        file = self.move_files([(file_id, folder_id)])[0]
+        if isinstance(file, Exception):
+            raise file
+        return file
+
+    def move_files(self, moves):
+        """
+        批量移动文件，原父文件夹从元数据缓存获取，缓存中没有的合并成一次批量请求获取
+        :param moves: (文件或文件夹id, 目的地文件夹id)序列
+        :return: 与参数一一对应的移动后文件对象序列，移动失败的对应异常对象
+        """
+        files = self.search_files_by_id([file_id for file_id, folder_id in moves])
+        update_indexes = [i for i in range(len(moves)) if not isinstance(files[i], Exception)]
+        requests = []
+        for i in update_indexes:
+            file_id, folder_id = moves[i]
+            requests.append(self.service.files().update(fileId=file_id,
+                                                        addParents=folder_id,
+                                                        removeParents=",".join(files[i].get('parents', [])),
+                                                        fields=FILE_INFO))
+        results = self.execute_batch(requests)
+        for i, result in zip(update_indexes, results):
+            if not isinstance(result, Exception):
+                self.cache_file(result, files[i].get('parents', []) + [moves[i][1]])
+            files[i] = result
+        return files
+
+    def print_files(self, files):
+        for file in files:
+            try:
+                print('%s\t(%s)\t类型:%s\t%sK\tparents:%s\t浏览链接:%s\t下载链接:%s' % (
+                    file['name'], file['id'], file['mimeType'], file['size'], file['parents'], file['webViewLink'],
+                    file['webContentLink']))
+            except KeyError:
+                print('%s\t(%s)\t类型:%s\tparents:%s\t浏览链接:%s' % (
+                    file['name'], file['id'], file['mimeType'], file['parents'], file['webViewLink']))
+
+
+class GoogleDiverClient(GoogleDiverAPI):
+    def __init__(self, metadata_cache=None, metadata_sync=None, root_id=None):
+        self.thread_services = threading.local()
+        GoogleDiverAPI.__init__(self, metadata_cache, metadata_sync, root_id)
+        self.event_bus = EventBus()
+        self.work_registry = WorkRegistry(STARTUP_TIMER.measure('work_store', WorkStore), self.event_bus)
+        self.threads = []
+        self.now_id = self.get_root_id()
+        self.thread_pool_lock = threading.Lock()
+        self.thread_pool_size = THREAD_POOL_SIZE
+        self.engine = None
+        if ENGINE == 'asyncio' and not aiohttp:
+            print('没有安装aiohttp，使用线程引擎')
+        restored_count = self.work_registry.load()
+        if restored_count:
+            print('恢复等待工作', restored_count)
+            self.create_thread()
+
+    @property
+    def service(self):
+        """
+        rpc方法在多个线程里同时执行，每个线程从服务对象池借一个自己的服务对象
+        :return: 当前线程的谷歌硬盘服务对象
+        """
+        service = getattr(self.thread_services, 'service', None)
+        if service is None:
+            service = self.service_pool.checkout()
+            self.thread_services.service = service
+        return service
+
+    @service.setter
+    def service(self, service):
+        self.thread_services.service = service
+
+    def create_thread(self):
+        """
+        把工作线程补足到线程池大小，工作线程常驻，没有工作时阻塞等待。使用异步引擎时只启动一次异步引擎
+        :return:
+        """
+        self.thread_pool_lock.acquire()
+        try:
+            if ENGINE == 'asyncio' and aiohttp:
+                if not self.engine:
+                    self.engine = AsyncDriveEngine(self)
+                    self.engine.start()
+                return
+            while len(self.threads) < self.thread_pool_size:
+                thread = WorkThread(self)
+                self.threads.append(thread)
+                thread.start()
+        finally:
+            self.thread_pool_lock.release()
+
+    def set_thread_pool_size(self, thread_pool_size):
+        """
+        修改线程池大小，变大时马上创建线程，变小时多出来的线程做完手上的工作后退出
+        :param thread_pool_size: 线程池大小
+        :return: 修改是否成功
+        """
+        if thread_pool_size < 1:
+            return False
+        self.thread_pool_lock.acquire()
+        try:
+            self.thread_pool_size = thread_pool_size
+        finally:
+            self.thread_pool_lock.release()
+        self.create_thread()
+        self.work_registry.condition.acquire()
+        try:
+            self.work_registry.condition.notify_all()
+        finally:
+            self.work_registry.condition.release()
+        return True
+
+    def is_thread_needed(self, thread):
+        """
+        线程池缩小后，排在线程池大小之后的线程被移除出线程队列
+        :param thread: 工作线程
+        :return: 线程是否还需要继续工作
+        """
+        self.thread_pool_lock.acquire()
+        try:
+            if thread in self.threads[:self.thread_pool_size]:
+                return True
+        finally:
+            self.thread_pool_lock.release()
+        self.remove_thread(thread)
+        return False
+
+    def remove_thread(self, thread):
+        """
+        当工作线程死亡时移除出线程队列
+        :param thread: 死亡的线程
+        :return:
+        """
+        self.thread_pool_lock.acquire()
+        try:
+            if thread in self.threads:
+                self.threads.remove(thread)
+        finally:
+            self.thread_pool_lock.release()
+
+    def create_and_add_wait_work(self, is_download, path, id, chunk_config=None, download_policy=None, priority=0,
+                                 size=None, bandwidth_limit=0):
+        """
+        往工作等待队列添加工作
+        :param is_download: 是下载还是上传
+        :param path: 本地路径
+        :param id: 文件id
+        :param chunk_config: 分块配置
+        :param download_policy: 下载策略
+        :param priority: 优先级，越大越先执行
+        :param size: 文件大小，不知道时为None
+        :param bandwidth_limit: 带宽上限，字节每秒，0不限制
+        :return: 如何工作重复返回None，否则成功插入到工作等待队列，返回工作对象
+        """
+        work = self.work_registry.add_wait_work(is_download, path, id, chunk_config, download_policy, priority, size,
+                                                bandwidth_limit)
+        if work:
+            self.create_thread()
+        return work
+
+    def remove_wait_work(self, is_download, path, id):
+        """
+        在等待队列删除任务
+        :param is_download:
+        :param path:
+        :param id:
+        :return: 删除是否成功
+        """
+        return self.work_registry.remove_wait_work(is_download, path, id)
+
+    def take_wait_work(self, thread):
+        """
+        从等待队列中获取工作并放入正在工作队列，等待队列为空时阻塞，直到有新工作加入时被唤醒
+        :param thread: 获取工作的工作线程，异步引擎取工作时为None
+        :return: 工作对象，线程不再需要时返回None
+        """
+        self.work_registry.condition.acquire()
+        try:
+            while True:
+                if thread and not self.is_thread_needed(thread):
+                    return None
+                work = self.work_registry.start_wait_work_locked()
+                if work:
+                    return work
+                self.work_registry.condition.wait()
+        finally:
+            self.work_registry.condition.release()
+
+    def get_scheduler_stats(self):
+        """
+        获取调度统计，wait_microseconds是工作从加入等待队列到开始执行的时间
+        :return: 统计map
+        """
+        stats = self.work_registry.get_stats()
+        stats['thread_pool_size'] = self.thread_pool_size
+        stats['threads'] = len(self.threads)
+        stats['store'] = self.work_registry.store.get_stats()
+        stats['events'] = self.event_bus.get_stats()
+        stats['engine'] = self.engine.get_stats() if self.engine else {'engine': 'threads'}
+        return stats
+
+    def finish_doing_work(self, work):
+        """
+        把已完成的工作从正在工作队列移到完成队列
+        :param work: 已完成的工作
+        :return:
+        """
+        self.work_registry.finish_doing_work(work)
+
+    def remove_done_work(self, is_download, path, id):
+        """
+        从完成队列中删除一个已完成工作
+        :param is_download:
+        :param path:
+        :param id:
+        :return:
+        """
+        return self.work_registry.remove_done_work(is_download, path, id)
+
+                    # API start ---------------------------------------------------------------
+
+    def upload(self, path, folder_id=None, chunk_config=None, priority=0, bandwidth_limit=0):
+        """
+        添加上传任务
+        :param path: 上传的本地路径
+        :param folder_id: 保存到文件夹的id
+        :param chunk_config: 分块配置，默认自动调整
+        :param priority: 优先级，文件夹拆散后的文件沿用
+        :param bandwidth_limit: 每个文件的带宽上限，字节每秒，0不限制，文件夹拆散后的文件沿用
+        :return: 任务添加是否成功
+        """
+        if not os.path.exists(path):
+            print('目录不存在', path)
+            return False
+        size = os.path.getsize(path) if os.path.isfile(path) else None
+        if self.create_and_add_wait_work(False, path, folder_id, chunk_config, priority=priority, size=size,
+                                         bandwidth_limit=bandwidth_limit):
+            print('添加上传任务', path, folder_id)
+            return True
+        else:
+            print('上传任务已经在队列中', path, folder_id)
+            return False
+
+    def download(self, id, save_folder_path, chunk_config=None, download_policy=None, priority=0, bandwidth_limit=0):
+        """
+        添加下载任务
+        :param id: 下载的文件夹或者文件的id
+        :param save_folder_path: 保存到本地目录
+        :param chunk_config: 分块配置，默认自动调整
+        :param download_policy: 下载策略，always、if-size-differs或者if-md5-differs，默认DOWNLOAD_POLICY
+        :param priority: 优先级，文件夹拆散后的文件沿用
+        :param bandwidth_limit: 每个文件的带宽上限，字节每秒，0不限制，文件夹拆散后的文件沿用
+        :return: 任务添加是否成功
+        """
+        if download_policy and download_policy not in DOWNLOAD_POLICIES:
+            print('下载策略不存在', download_policy)
+            return False
+        file = self.get_cached_file(id)
+        size = int(file['size']) if file and 'size' in file else None
+        if self.create_and_add_wait_work(True, save_folder_path, id, chunk_config, download_policy, priority, size,
+                                         bandwidth_limit):
+            print('添加下载队列', id, save_folder_path)
+            return True
+        else:
+            print('下载任务已在队列中', id, save_folder_path)
+            return False
+
+    def set_work_priority(self, is_download, path, id, priority):
+        """
+        修改等待中的工作的优先级
+        :return: 修改是否成功
+        """
+        return self.work_registry.set_priority(is_download, path, id, priority)
+
+    def set_schedule_policy(self, policy):
+        """
+        修改调度策略
+        :param policy: fifo、fair或者shortest-first
+        :return: 修改是否成功
+        """
+        return self.work_registry.set_policy(policy)
+
+    def upload_pipe(self, path, folder_id=None, file_name=None):
+        """
+        在后台线程从命名管道之类不知道长度的本地文件流式上传，一直读到写入端关闭
+        :param path: 本地路径，例如mkfifo创建的命名管道
+        :param folder_id: 保存到文件夹的id
+        :param file_name: 上传的文件名，默认本地文件名
+        :return: 是否开始上传
+        """
+        if not os.path.exists(path) or os.path.isdir(path):
+            print('文件不存在', path)
+            return False
+        if not file_name:
+            file_name = os.path.basename(path)
+
+        def upload():
+            api = GoogleDiverWorker(self)
+            try:
+                with open(path, 'rb') as stream:
+                    api.upload_stream(stream, file_name, folder_id)
+            except Exception as e:
+                print(e)
+                print('流式上传失败', path)
+            finally:
+                api.close()
+
+        thread = threading.Thread(target=upload)
+        thread.daemon = True
+        thread.start()
+        print('开始流式上传', path, folder_id)
+        return True
+
+    def set_work_bandwidth_limit(self, is_download, path, id, bandwidth_limit):
+        """
+        修改等待中或者正在工作的工作的带宽上限
+        :param bandwidth_limit: 字节每秒，0不限制
+        :return: 修改是否成功
+        """
+        if bandwidth_limit < 0:
+            return False
+        return self.work_registry.set_bandwidth_limit(is_download, path, id, bandwidth_limit)
+
+    def get_bandwidth_limits(self):
+        """
+        获取全局带宽限制、时间表、现在生效的限制和传输统计
+        :return: 统计map
+        """
+        return BANDWIDTH_LIMITER.get_stats()
+
+    def set_bandwidth_limits(self, upload=None, download=None, schedule=None):
+        """
+        修改全局带宽限制和时间表
+        :param upload: 默认上传限制，字节每秒，0不限制，None不修改
+        :param download: 默认下载限制，字节每秒，0不限制，None不修改
+        :param schedule: 时间表，None不修改
+        :return: 修改是否成功
+        """
+        return BANDWIDTH_LIMITER.set_limits(upload, download, schedule)
+
+    def delete_wait_work(self, is_download, path, id):
+        """
+        从等待队列中取消任务
+        :param is_download: 任务是下载还是上传
+        :param path: 本地路径
+        :param id: 文件或者文件夹id
+        :return: 取消是否成功
+        """
+        return self.remove_wait_work(is_download, path, id)
+
+    def delete_done_work(self, is_download, path, id):
+        """
+        从完成队列中删除任务
+        :param is_download: 任务是下载还是上传
+        :param path: 本地路径
+        :param id: 文件或者文件夹id
+        :return: 删除是否成功
+        """
+        return self.remove_done_work(is_download, path, id)
+
+    def get_now_file_list(self):
+        """
+        返回当前文件夹的文件列表json
+        :return: 前文件夹的文件列表json
+        """
+        return self.get_file_list(self.now_id)
+
+    def goto_parent_folder(self):
+        """
+        返回父目录
+        :return: 父目录下全部文件夹和文件json
+        """
+        print('self.now_id', self.now_id)
+        self.now_id = self.get_parent_folder(self.now_id)
+        return self.get_file_list(self.now_id)
+
+    def goto_child_folder(self, child_folder_id):
+        """
+        进入子目录
+        :param child_folder_id: 子目录的id
+        :return: 子目录下全部文件夹和文件json
+        """
+        self.now_id = child_folder_id
+        return self.get_file_list(self.now_id)
+
+    def list_works(self, state=None, is_download=None, path_prefix=None, offset=0, limit=LIST_WORKS_LIMIT,
+                   since_version=None):
+        """
+        分页、过滤、增量列出工作，参数见WorkRegistry.list_works
+        :return: 工作列表map
+        """
+        return self.work_registry.list_works(state, is_download, path_prefix, offset, limit, since_version)
+
+    def get_json_wait_works(self):
+        """
+        获取wait_works的json
+        :return: wait_works的json
+        """
+        return json.dumps([work.to_map() for work in self.work_registry.get_works(self.work_registry.wait_works)])
+
+    def get_json_doing_works(self):
+        """
+        获取doing_works的json
+        :return: doing_works的json
+        """
+        return json.dumps([work.to_map() for work in self.work_registry.get_works(self.work_registry.doing_works)])
+
+    def get_json_done_works(self):
+        """
+        获取done_works的json
+        :return: done_works的json
+        """
+        return json.dumps([work.to_map() for work in self.work_registry.get_works(self.work_registry.done_works)])
+
+    def get_metadata_cache_stats(self):
+        """
+        获取元数据缓存的命中统计，命中次数即节省的api请求次数
+        :return: 统计map
+        """
+        return self.metadata_cache.get_stats()
+
+    def start_metadata_sync(self):
+        """
+        开启元数据增量同步，全量列出一次硬盘，之后列表和导航都从本地元数据读取
+        :return: 无返回
+        """
+        metadata_sync = MetadataSync(self.service_pool.checkout())
+        metadata_sync.full_sync()
+        self.metadata_sync = metadata_sync
+
+    def get_metadata_sync_stats(self):
+        """
+        获取元数据同步统计，没有开启同步返回None
+        :return: 统计map
+        """
+        if not self.metadata_sync:
+            return None
+        return self.metadata_sync.get_stats()
+
+    def get_service_pool_stats(self):
+        """
+        获取服务对象池统计
+        :return: 统计map
+        """
+        return self.service_pool.get_stats()
+
+    def get_hash_cache_stats(self):
+        """
+        获取本地文件md5缓存统计
+        :return: 统计map
+        """
+        return self.hash_cache.get_stats()
+
+    def get_rate_governor_stats(self):
+        """
+        获取全局请求速率令牌桶统计
+        :return: 统计map
+        """
+        return RATE_GOVERNOR.get_stats()
+
+    def set_request_rate(self, rate, burst=None):
+        """
+        设置全局每秒请求数
+        :param rate: 每秒请求数，0不限制
+        :param burst: 最多攒下的令牌数，默认REQUEST_BURST_SECONDS秒的请求数
+        :return: 设置后的统计map
+        """
+        if rate < 0:
+            return RATE_GOVERNOR.get_stats()
+        RATE_GOVERNOR.set_rate(rate, burst or max(int(rate * REQUEST_BURST_SECONDS), 1))
+        return RATE_GOVERNOR.get_stats()
+
+
+# API end ---------------------------------------------------------------
+
+
+class GoogleDiverWorker(GoogleDiverAPI):
+    """
+    工作线程使用的api对象，和主客户端共用元数据缓存、根目录id和服务对象池，创建时不会发出网络请求
+    """
+
+    def __init__(self, main_client):
+        GoogleDiverAPI.__init__(self, main_client.metadata_cache, main_client.metadata_sync, main_client.root_id,
+                                main_client.service_pool, main_client.upload_journal, main_client.hash_cache)
+
+    def close(self):
+        """
+        把服务对象归还服务对象池
+        :return: 无返回
+        """
+        self.service_pool.checkin(self.service)
+        self.service = None
+
+    def do_work(self, main_client, work, status_func):
+        """
+        执行工作
+        :param work:
+        :param status_func:
+        :return:
+        """
+        if work.is_download:
+            self.do_download_work(main_client, work.id, work.path, status_func, work)
+        else:
+            self.do_upload_work(main_client, work.path, work.id, work)
+
+    def do_upload_work(self, main_client, path, id, work=None):
+        """
+        执行上传工作，如果上传是文件，则按RETRY_POLICY重试上传，如果是文件夹，先交由upload_folder_to_works拆散成单个文件，并添加到等待队列
+        :param path: 上传本地路径
+        :param id: 上传到文件夹的id
+        :param work: 工作对象，提供分块配置并记录重试次数
+        :return:
+        """
+        chunk_config = work.chunk_config if work else None
+        priority = work.priority if work else 0
+        bandwidth_limit = work.bandwidth_limit if work else 0
+        try:
+            if os.path.isdir(path):
+                self.upload_folder_to_works(main_client=main_client, folder_path=path, folder_id=id,
+                                            chunk_config=chunk_config, priority=priority,
+                                            bandwidth_limit=bandwidth_limit)
+            else:
+                print('开始上传', path)
+                chunk_sizer = work.get_chunk_sizer() if work else None
+                RETRY_POLICY.run(lambda: self.upload_file(file_path=path, folder_id=id, chunk_sizer=chunk_sizer,
+                                                          work=work), work, path)
+                print('上传完成', path)
+        except Exception as e:
+            print(e)
+            if work:
+                work.error = str(e)
+            print('上传失败', path, id)
+
+    def do_download_work(self, main_client, id, path, status_func, work=None):
+        """
+        执行下载工作，如果下载是文件则按RETRY_POLICY重试下载，否则交给download_folder_to_works拆散成单个文件，并添加到等待队列
+        :param id: 下载的id
+        :param path: 保存的本地路径
+        :param status_func: 监控方法
+        :param work: 工作对象，提供分块配置并记录重试次数
+        :return:
+        """
+        chunk_config = work.chunk_config if work else None
+        download_policy = work.download_policy if work else None
+        priority = work.priority if work else 0
+        bandwidth_limit = work.bandwidth_limit if work else 0
+        try:
+            if self.is_folder_by_id(id):
+                self.download_folder_to_works(main_client=main_client, folder_id=id, save_folder_path=path,
+                                              chunk_config=chunk_config, download_policy=download_policy,
+                                              priority=priority, bandwidth_limit=bandwidth_limit)
+            else:
+                file = self.search_file_by_id(id)
+                print('开始下载', file['name'], file['id'])
+                chunk_sizer = work.get_chunk_sizer() if work else None
+                RETRY_POLICY.run(lambda: self.download_file(file=file, save_folder_path=path, status_func=status_func,
+                                                            chunk_sizer=chunk_sizer, policy=download_policy,
+                                                            work=work), work, file['name'])
+                print('下载完成', file['name'], file['id'])
+        except Exception as e:
+            print(e)
+            if work:
+                work.error = str(e)
+            print('下载失败', id, path)
+
+    def upload_folder_to_works(self, main_client, folder_path, folder_id=None, chunk_config=None, priority=0,
+                               bandwidth_limit=0):
+        """
+        把文件夹拆散成单个文件，文件夹里已有同名文件夹时沿用，否则创建对应的文件夹得到其id，分配到各个文件上传，并添加到等待队列
+        :param folder_path: 上传的文件夹
+        :param folder_id: 保存到文件夹的id
+        :param chunk_config: 分块配置
+        :param priority: 文件的优先级
+        :param bandwidth_limit: 文件的带宽上限
+        :return: 无返回
+        """
+        if not os.path.exists(folder_path):
+            return
+        if not folder_id:
+            folder_id = self.get_root_id()
+        folder_name = os.path.basename(folder_path)
+        folders = [file for file in self.get_file_list(folder_id) if self.is_folder(file) and file['name'] == folder_name]
+        if folders:
+            self.upload_folder_files_to_works(main_client, folder_path, folders[0], chunk_config, priority=priority,
+                                              bandwidth_limit=bandwidth_limit)
+        else:
+            folder = self.create_folder(folder_name, folder_id)
+            self.upload_folder_files_to_works(main_client, folder_path, folder, chunk_config, True, priority,
+                                              bandwidth_limit)
+
+    def upload_folder_files_to_works(self, main_client, folder_path, folder, chunk_config=None, created=False,
+                                     priority=0, bandwidth_limit=0):
+        """
+        按层广度优先遍历本地文件夹，把文件添加到等待队列，内容和远程同名文件相同的文件跳过。
+        每层的文件夹由UPLOAD_WALK_THREADS个线程同时读取，文件一知道所在的远程文件夹就添加到等待队列，
+        远程已有的同名子文件夹直接沿用，其余子文件夹整层合并成批量请求创建后进入下一层
+        :param folder_path: 上传的文件夹
+        :param folder: 上传的文件夹在谷歌硬盘对应的文件夹对象
+        :param chunk_config: 分块配置
+        :param created: 文件夹是否是刚创建的，刚创建的文件夹是空的，不用列出
+        :param priority: 文件的优先级
+        :param bandwidth_limit: 文件的带宽上限
+        :return: 无返回
+        """
+        start_time = time()
+        folder_count = 0
+        level = [(folder_path, folder, created)]
+        executor = ThreadPoolExecutor(UPLOAD_WALK_THREADS)
+        try:
+            while level:
+                folder_count = folder_count + len(level)
+                next_level = []
+                new_folders = []
+                for child_folders, child_new_folders in executor.map(
+                        lambda item: self.scan_upload_folder(main_client, item[0], item[1], item[2], chunk_config,
+                                                             priority, bandwidth_limit),
+                        level):
+                    next_level.extend(child_folders)
+                    new_folders.extend(child_new_folders)
+                results = self.create_folders([(os.path.basename(new_folder_path), parent_folder['id'])
+                                               for new_folder_path, parent_folder in new_folders])
+                for (new_folder_path, parent_folder), new_folder in zip(new_folders, results):
+                    if isinstance(new_folder, Exception):
+                        print(new_folder)
+                        print('创建文件夹失败', new_folder_path, parent_folder['name'], parent_folder['id'])
+                    else:
+                        next_level.append((new_folder_path, new_folder, True))
+                level = next_level
+        finally:
+            executor.shutdown()
+        print('遍历文件夹完成', folder_path, folder_count, '个文件夹', '%.2f秒' % (time() - start_time))
+
+    def scan_upload_folder(self, main_client, folder_path, folder, created, chunk_config, priority=0,
+                           bandwidth_limit=0):
+        """
+        在遍历线程里读取一个本地文件夹，文件添加到等待队列，借一个服务对象列出远程文件
+        :param folder_path: 本地文件夹
+        :param folder: 对应的远程文件夹对象
+        :param created: 远程文件夹是否是刚创建的
+        :param chunk_config: 分块配置
+        :param priority: 文件的优先级
+        :param bandwidth_limit: 文件的带宽上限
+        :return: (沿用远程文件夹的(本地路径, 远程文件夹, False)序列, 需要新建的(本地路径, 远程父文件夹)序列)
+        """
+        api = GoogleDiverWorker(main_client)
+        try:
+            remote_files = [] if created else api.get_file_list(folder['id'])
+            remote_folders = {}
+            for file in remote_files:
+                if api.is_folder(file):
+                    remote_folders.setdefault(file['name'], file)
+            child_folders = []
+            new_folders = []
+            file_paths = []
+            sizes = []
+            with os.scandir(folder_path) as entries:
+                for entry in entries:
+                    file_path = folder_path + '/' + entry.name
+                    try:
+                        if not entry.is_dir():
+                            size = entry.stat().st_size
+                            file_paths.append(file_path)
+                            sizes.append(size)
+                        elif entry.name in remote_folders:
+                            child_folders.append((file_path, remote_folders[entry.name], False))
+                        else:
+                            new_folders.append((file_path, folder))
+                    except OSError as e:
+                        # 遍历时被删除或者没有权限的文件只跳过它自己，不影响文件夹里的其他文件
+                        print(e)
+                        print('读取文件失败，跳过', file_path)
+            same_files = api.find_same_files(file_paths, folder['id'], remote_files=remote_files)
+            for file_path, size, same_file in zip(file_paths, sizes, same_files):
+                if same_file:
+                    print('文件没有变化，跳过上传', file_path)
+                elif not main_client.create_and_add_wait_work(False, file_path, folder['id'], chunk_config,
+                                                              priority=priority, size=size,
+                                                              bandwidth_limit=bandwidth_limit):
+                    print('上传任务已经在队列中', file_path, folder['name'], folder['id'])
+                else:
+                    print('添加上传任务', file_path, folder['name'], folder['id'])
+            return child_folders, new_folders
+        except Exception as e:
+            print(e)
+            print('读取文件夹失败', folder_path, folder['name'], folder['id'])
+            return [], []
+        finally:
+            api.close()
+
+    def download_folder_to_works(self, main_client, folder_id, save_folder_path, folder=None, chunk_config=None,
+                                 download_policy=None, priority=0, bandwidth_limit=0):
+        """
+        下载文件夹，先用get_subtree列出整个子树，再把文件夹拆散成单个文件，并设置对应的保存路径，并添加到等待队列，
+        按下载策略本地已经有相同文件的不添加
+        :param folder_id: 下载文件夹的id
+        :param save_folder_path: 保存到的本地路径
+        :param folder: 下载文件夹的对象，已经从文件列表得到时传入，不用再请求
+        :param chunk_config: 分块配置
+        :param download_policy: 下载策略
+        :param priority: 文件的优先级
+        :param bandwidth_limit: 文件的带宽上限
+        :return:
+        """
+        if not folder:
+            folder = self.search_file_by_id(folder_id)
+        children = self.get_subtree(folder_id)
+        folders = [(folder, save_folder_path)]
+        while folders:
+            folder, save_folder_path = folders.pop()
+            folder_path = save_folder_path + '/' + folder['name']
+            files = children.get(folder['id'], [])
+            child_files = [file for file in files if not self.is_folder(file)]
+            same = self.find_same_local_files(child_files, folder_path, download_policy)
+            for file, is_same in zip(child_files, same):
+                if is_same:
+                    print('本地文件没有变化，跳过下载', file['name'], file['id'], folder_path)
+                elif not main_client.create_and_add_wait_work(True, folder_path, file['id'], chunk_config,
+                                                              download_policy, priority,
+                                                              int(file['size']) if 'size' in file else None,
+                                                              bandwidth_limit):
+                    print('下载任务已在队列中', file['name'], file['id'], folder_path)
+                else:
+                    print('添加下载队列', file['name'], file['id'], folder_path)
+            folders.extend((file, folder_path) for file in files if self.is_folder(file))
+
+
+WORK_SERIALS = itertools.count(1)
+
+
+class Work(object):
+    def __init__(self, is_download, path, id, chunk_config=None, download_policy=None, priority=0, size=None,
+                 bandwidth_limit=0):
+        """
+        :param chunk_config: 分块配置，可以有chunk_size(初始分块大小)、min_chunk_size和max_chunk_size，
+        上下限相等时分块大小固定
+        :param download_policy: 下载策略，默认DOWNLOAD_POLICY
+        :param priority: 优先级，越大越先执行
+        :param size: 文件大小，不知道时为None，用于小文件优先的调度
+        :param bandwidth_limit: 这个工作的带宽上限，字节每秒，0不限制
+        """
+        self.is_download = is_download
+        self.path = path
+        self.id = id
+        self.progress = 0
+        self.done = False
+        self.file_name = None
+        self.key = (is_download, path, id)
+        self.create_time = time()
+        self.start_time = None
+        self.retry_count = 0
+        self.throttle_count = 0
+        self.download_policy = download_policy
+        self.priority = priority
+        self.size = size
+        self.bandwidth_limit = 0
+        self.bandwidth = None
+        self.set_bandwidth_limit(bandwidth_limit)
+        self.schedule_seq = None
+        self.finish_time = None
+        self.error = None
+        self.store_id = None
+        self.serial = next(WORK_SERIALS)
+        self.state = None
+        self.version = 0
+        self.chunk_config = chunk_config or {}
+        self.chunk_sizer = None
+
+    def get_chunk_size(self):
+        """
+        配置的初始分块大小
+        """
+        return self.chunk_config.get('chunk_size') or (DOWNLOAD_CHUNK_SIZE if self.is_download else UPLOAD_CHUNK_SIZE)
+
+    def get_chunk_sizer(self):
+        """
+        获取分块大小调整器，开始传输时才创建，排队的工作不占这部分内存，重试时沿用同一个
+        :return: 分块大小调整器
+        """
+        if not self.chunk_sizer:
+            self.chunk_sizer = ChunkSizer(self.get_chunk_size(),
+                                          self.chunk_config.get('min_chunk_size') or MIN_CHUNK_SIZE,
+                                          self.chunk_config.get('max_chunk_size') or MAX_CHUNK_SIZE)
+        return self.chunk_sizer
+
+    def set_bandwidth_limit(self, bandwidth_limit):
+        """
+        修改带宽上限，有上限时才创建令牌桶，正在传输的工作下一块就按新的上限
+        :param bandwidth_limit: 字节每秒，0不限制
+        :return: 无返回
+        """
+        self.bandwidth_limit = bandwidth_limit or 0
+        if self.bandwidth:
+            self.bandwidth.set_rate(self.bandwidth_limit, get_bandwidth_burst(self.bandwidth_limit))
+        elif self.bandwidth_limit:
+            self.bandwidth = RateGovernor(self.bandwidth_limit, get_bandwidth_burst(self.bandwidth_limit))
+
+    def to_map(self):
+        if self.chunk_sizer:
+            chunk_stats = self.chunk_sizer.get_stats()
+        else:
+            chunk_stats = {'chunk_size': self.get_chunk_size(), 'bytes_per_second': None}
+        return {'serial': self.serial, 'state': self.state, 'version': self.version,
+                'is_download': self.is_download, 'path': self.path, 'id': self.id, 'progress': self.progress,
+                'done': self.done, 'file_name': self.file_name,
+                'wait_microseconds': int((self.start_time - self.create_time) * 1000000) if self.start_time else None,
+                'chunk_size': chunk_stats['chunk_size'], 'bytes_per_second': chunk_stats['bytes_per_second'],
+                'retry_count': self.retry_count, 'throttle_count': self.throttle_count, 'error': self.error,
+                'priority': self.priority, 'size': self.size, 'bandwidth_limit': self.bandwidth_limit}
+
+
+class WorkStore(object):
+    """
+    工作的持久化存储，保存在WAL模式的SQLite数据库WORK_STORE_FILE_NAME里，重启后恢复等待和正在工作的工作，
+    完成的工作作为历史一直保留。写入在内存里按工作合并，由后台线程每WORK_STORE_FLUSH_INTERVAL秒在一个事务里批量提交，
+    入队和状态变化只是一次字典赋值。未完成的工作有部分索引，历史再多也不影响启动和写入
+    """
+
+    def __init__(self, file_name=WORK_STORE_FILE_NAME):
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS works (id INTEGER PRIMARY KEY, is_download INTEGER NOT NULL, '
+                                'path TEXT NOT NULL, file_id TEXT, state TEXT NOT NULL, chunk_config TEXT, '
+                                'download_policy TEXT, file_name TEXT, progress INTEGER, retry_count INTEGER, '
+                                'throttle_count INTEGER, create_time REAL, start_time REAL, finish_time REAL, '
+                                'priority INTEGER, size INTEGER, bandwidth_limit INTEGER)')
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(works)')]
+        for column in ('priority', 'size', 'bandwidth_limit'):
+            if column not in columns:
+                self.connection.execute('ALTER TABLE works ADD COLUMN ' + column + ' INTEGER')
+        self.connection.execute("CREATE INDEX IF NOT EXISTS works_active ON works (state) WHERE state != 'done'")
+        self.connection.commit()
+        self.next_id = (self.connection.execute('SELECT MAX(id) FROM works').fetchone()[0] or 0) + 1
+        self.pending = collections.OrderedDict()
+        self.flush_count = 0
+        self.written_count = 0
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.connection_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def put(self, work, state):
+        """
+        保存工作的状态，没有编号的工作分配一个编号，实际写入由后台线程完成
+        :param work: 工作对象
+        :param state: wait、doing或者done
+        :return: 无返回
+        """
+        self.lock.acquire()
+        try:
+            if work.store_id is None:
+                work.store_id = self.next_id
+                self.next_id = self.next_id + 1
+            self.pending[work.store_id] = (work, state)
+            self.condition.notify()
+        finally:
+            self.lock.release()
 
-    def download_file(self, file, save_folder_path, status_func, file_name=None):
+    def remove(self, work):
         """
-        下载文件
-        :param file: 下载文件的对象
-        :param save_file_path: 下载到本地的路径
-        :param status_func: 下载状态调用方法
-        :param file_name: 命名下载文件，默认原名
+        删除工作
+        :param work: 工作对象
         :return: 无返回
         """
-        if not os.path.exists(save_folder_path):
-            os.makedirs(save_folder_path)
-        if not file_name:
-            file_name = file['name']
+        self.lock.acquire()
+        try:
+            if work.store_id is not None:
+                self.pending[work.store_id] = None
+                self.condition.notify()
+        finally:
+            self.lock.release()
 
-        save_file = open(save_folder_path + '/' + file_name, 'wb')
-        request = self.service.files().get_media(fileId=file['id'])
-        downloader = MediaIoBaseDownload(save_file, request)
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
-            status_func(file, status, done)
+    def run(self):
+        while True:
+            self.lock.acquire()
+            try:
+                while not self.pending:
+                    self.condition.wait()
+            finally:
+                self.lock.release()
+            sleep(WORK_STORE_FLUSH_INTERVAL)
+            self.flush()
 
-    def is_folder_by_id(self, file_id):
+    def flush(self):
         """
-        某个文件是否是文件夹
-        :param file_id: 文件id
-        :return: 是否是文件夹
+        把合并后的写入在一个事务里提交
+        :return: 提交的工作数
         """
-        file = self.search_file_by_id(file_id)
-        return self.is_folder(file)
+        self.lock.acquire()
+        try:
+            pending = self.pending
+            self.pending = collections.OrderedDict()
+        finally:
+            self.lock.release()
+        if not pending:
+            return 0
+        rows = []
+        removed_ids = []
+        for store_id, value in pending.items():
+            if value is None:
+                removed_ids.append((store_id,))
+                continue
+            work, state = value
+            rows.append((store_id, int(work.is_download), work.path, work.id, state,
+                         json.dumps(work.chunk_config) if work.chunk_config else None, work.download_policy,
+                         work.file_name, work.progress, work.retry_count, work.throttle_count, work.create_time,
+                         work.start_time, work.finish_time, work.priority, work.size, work.bandwidth_limit))
+        self.connection_lock.acquire()
+        try:
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO works VALUES (' + ', '.join(['?'] * 17) + ')', rows)
+                self.connection.executemany('DELETE FROM works WHERE id = ?', removed_ids)
+            self.flush_count = self.flush_count + 1
+            self.written_count = self.written_count + len(pending)
+        except sqlite3.Error as e:
+            print(e)
+            print('保存工作失败', len(pending))
+        finally:
+            self.connection_lock.release()
+        return len(pending)
 
-    def is_folder(self, file):
+    def load(self, done_size=DONE_WORKS_SIZE):
         """
-        某个文件是否是文件夹
-        :param file: 文件对象
-        :return: 是否是文件夹
+        读取未完成的工作和最近完成的工作
+        :param done_size: 读取最近完成的工作数
+        :return: ((状态, 工作对象)序列按编号排序, 最近完成的工作对象序列按编号排序)
         """
-        if file['mimeType'] == FOLDER_MINE_TYPE:
-            return True
-        else:
-            return False
+        self.connection_lock.acquire()
+        try:
+            active_rows = self.connection.execute(
+                "SELECT * FROM works INDEXED BY works_active WHERE state != 'done' ORDER BY id").fetchall()
+            done_rows = self.connection.execute(
+                "SELECT * FROM works WHERE state = 'done' ORDER BY id DESC LIMIT ?", (done_size,)).fetchall()
+        finally:
+            self.connection_lock.release()
+        return [(row[4], self.row_to_work(row)) for row in active_rows], \
+               [self.row_to_work(row) for row in reversed(done_rows)]
 
-    def move_file(self, file_id, folder_id):
+    def row_to_work(self, row):
+        work = Work(bool(row[1]), row[2], row[3], json.loads(row[5]) if row[5] else None, row[6], row[14] or 0, row[15],
+                    row[16] or 0)
+        work.store_id = row[0]
+        work.file_name = row[7]
+        work.progress = row[8] or 0
+        work.retry_count = row[9] or 0
+        work.throttle_count = row[10] or 0
+        work.create_time = row[11] or work.create_time
+        work.start_time = row[12]
+        work.finish_time = row[13]
+        work.done = row[4] == 'done'
+        return work
+
+    def get_stats(self):
+        self.lock.acquire()
+        try:
+            return {'next_id': self.next_id, 'pending': len(self.pending), 'flushes': self.flush_count,
+                    'written': self.written_count}
+        finally:
+            self.lock.release()
+
+
+class EventSubscriber(object):
+    """
+    事件订阅者，每个连接一个。普通事件按顺序排队，进度事件按工作合并，
+    同一个工作每秒最多发出PROGRESS_EVENTS_PER_SECOND个进度事件，没来得及发的只保留最新的一个。
+    队列超过EVENT_QUEUE_SIZE时清空并发出reset事件，订阅者需要重新获取全部工作
+    """
+
+    def __init__(self, progress_rate=PROGRESS_EVENTS_PER_SECOND, queue_size=EVENT_QUEUE_SIZE):
+        self.progress_interval = 1.0 / progress_rate
+        self.queue_size = queue_size
+        self.events = collections.deque()
+        self.progress = collections.OrderedDict()
+        self.progress_times = {}
+        self.overflow = False
+        self.condition = threading.Condition()
+
+    def put(self, event, work):
         """
-        移动文件到另一个文件夹下
-        :param file_id: 文件或文件夹id
-        :param folder_id: 目的地文件夹
-        :return: 移动后的文件对象
+        加入事件，由EventBus调用
+        :param event: 事件类型
+        :param work: 工作
+        :return: 无返回
         """
-        file = self.service.files().get(fileId=file_id, fields='parents').execute()
-        previous_parents = ",".join(file.get('parents'))
-        file = self.service.files().update(fileId=file_id,
-                                           addParents=folder_id,
-                                           removeParents=previous_parents,
-                                           fields=FILE_INFO).execute()
-        return file
+        self.condition.acquire()
+        try:
+            if event == 'progress':
+                self.progress[work.serial] = work
+            else:
+                self.progress.pop(work.serial, None)
+                if event != 'started':
+                    self.progress_times.pop(work.serial, None)
+                self.events.append((event, work))
+                if len(self.events) > self.queue_size:
+                    self.overflow = True
+                    self.events.clear()
+                    self.progress.clear()
+            self.condition.notify()
+        finally:
+            self.condition.release()
 
-    def print_files(self, files):
-        for file in files:
-            try:
-                print('%s\t(%s)\t类型:%s\t%sK\tparents:%s\t浏览链接:%s\t下载链接:%s' % (
-                    file['name'], file['id'], file['mimeType'], file['size'], file['parents'], file['webViewLink'],
-                    file['webContentLink']))
-            except KeyError:
-                print('%s\t(%s)\t类型:%s\tparents:%s\t浏览链接:%s' % (
-                    file['name'], file['id'], file['mimeType'], file['parents'], file['webViewLink']))
+    def get(self, timeout=EVENT_HEARTBEAT_SECONDS):
+        """
+        取出可以发送的事件，没有时阻塞等待
+        :param timeout: 最多等待的秒数
+        :return: (事件类型, 工作)序列，超时返回空序列，队列溢出过返回[('reset', None)]
+        """
+        deadline = time() + timeout
+        self.condition.acquire()
+        try:
+            while True:
+                if self.overflow:
+                    self.overflow = False
+                    self.progress_times.clear()
+                    return [('reset', None)]
+                now = time()
+                events = list(self.events)
+                self.events.clear()
+                wait_seconds = deadline - now
+                for serial, work in list(self.progress.items()):
+                    next_time = self.progress_times.get(serial, 0) + self.progress_interval
+                    if next_time <= now:
+                        del self.progress[serial]
+                        self.progress_times[serial] = now
+                        events.append(('progress', work))
+                    else:
+                        wait_seconds = min(wait_seconds, next_time - now)
+                if events or wait_seconds <= 0:
+                    return events
+                self.condition.wait(wait_seconds)
+        finally:
+            self.condition.release()
 
 
-class GoogleDiverClient(GoogleDiverAPI):
+class EventBus(object):
+    """
+    工作事件总线，事件有queued、started、progress、finished、failed和removed，
+    发布只是把事件放进各个订阅者的队列，可以在持有工作登记表的锁时调用
+    """
+
     def __init__(self):
-        GoogleDiverAPI.__init__(self)
-        self.wait_works = []
-        self.doing_works = []
-        self.done_works = []
-        self.threads = []
-        self.now_id = self.get_root_id()
-        self.wait_works_lock = threading.Lock()
-        self.doing_works_lock = threading.Lock()
-        self.done_works_lock = threading.Lock()
-        self.thread_pool_lock = threading.Lock()
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.published_count = 0
 
-    def create_thread(self):
+    def subscribe(self):
         """
-        创建新增一个工作线程
-        :return:
+        :return: 新的订阅者
         """
-        self.thread_pool_lock.acquire()
+        subscriber = EventSubscriber()
+        self.lock.acquire()
         try:
-            if len(self.threads) == 0 or (len(self.wait_works) > 1 and len(self.threads) < THREAD_POOL_SIZE):
-                thread = WorkThread(self)
-                self.threads.append(thread)
-                thread.start()
+            self.subscribers.append(subscriber)
+            return subscriber
         finally:
-            self.thread_pool_lock.release()
+            self.lock.release()
 
-    def remove_thread(self, thread):
+    def unsubscribe(self, subscriber):
+        self.lock.acquire()
+        try:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+        finally:
+            self.lock.release()
+
+    def publish(self, event, work):
         """
-        当工作线程死亡时移除出线程队列
-        :param thread: 死亡的线程
-        :return:
+        发布事件
+        :param event: 事件类型
+        :param work: 工作
+        :return: 无返回
         """
-        i = 0
-        self.thread_pool_lock.acquire()
+        self.lock.acquire()
         try:
-            for th in self.threads:
-                if th == thread:
-                    self.threads.pop(i)
-                    return
-                i = i + 1
+            self.published_count = self.published_count + 1
+            for subscriber in self.subscribers:
+                subscriber.put(event, work)
         finally:
-            self.thread_pool_lock.release()
+            self.lock.release()
+
+    def get_stats(self):
+        self.lock.acquire()
+        try:
+            return {'subscribers': len(self.subscribers), 'published_events': self.published_count}
+        finally:
+            self.lock.release()
+
+
+def get_percentiles(microseconds):
+    """
+    :param microseconds: 微秒数序列
+    :return: {'count': 个数, 'p50_ms', 'p90_ms', 'p99_ms'}
+    """
+    microseconds = sorted(microseconds)
+    stats = {'count': len(microseconds)}
+    for name, ratio in (('p50_ms', 0.5), ('p90_ms', 0.9), ('p99_ms', 0.99)):
+        stats[name] = round(microseconds[int(ratio * (len(microseconds) - 1))] / 1000.0, 3) if microseconds else 0
+    return stats
+
+
+WORK_EVENTS = {'wait': 'queued', 'doing': 'started', 'done': 'finished', 'removed': 'removed'}
 
-    def create_and_add_wait_work(self, is_download, path, id):
+
+class WorkRegistry(object):
+    """
+    工作登记表，等待、正在工作和完成队列都是以(is_download, path, id)为键的哈希表，
+    等待队列和完成队列用OrderedDict保持先进先出的顺序，入队、查重、取消、取出都是O(1)。
+    三个队列共用一把锁，工作在队列之间的转移是原子的。
+    有工作存储时每次状态变化都交给工作存储保存，内存里的完成队列只保留最近DONE_WORKS_SIZE个。
+    每次变化(包括进度)版本号加一，变化记录按工作保留最新一次，用于只返回某个版本之后变化的工作。
+    有事件总线时每次变化同时发布对应的事件。
+    等待队列另外按方向放在两个堆里决定执行顺序，先按优先级，同优先级时fifo按加入顺序，fair按加入顺序并且上传下载轮流，
+    shortest-first按文件大小加上等待时间折算的大小(每秒SCHEDULE_AGING_BYTES_PER_SECOND)并且上传下载轮流。
+    取消和修改优先级时堆里的旧记录不删除，取出时跳过
+    """
+
+    def __init__(self, store=None, event_bus=None, policy=None):
+        self.wait_works = collections.OrderedDict()
+        self.doing_works = collections.OrderedDict()
+        self.done_works = collections.OrderedDict()
+        self.store = store
+        self.event_bus = event_bus
+        self.version = 0
+        self.min_version = 0
+        self.changes = collections.OrderedDict()
+        self.snapshot = []
+        self.snapshot_version = -1
+        self.snapshot_time = 0
+        self.policy = policy or SCHEDULE_POLICY
+        self.wait_heaps = {False: [], True: []}
+        self.schedule_seqs = itertools.count()
+        self.last_direction = True
+        self.wait_samples = {}
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.started_work_count = 0
+        self.total_wait_microseconds = 0
+        self.max_wait_microseconds = 0
+
+    def load(self):
         """
-        往工作等待队列添加工作
+        从工作存储恢复工作，上次退出时正在进行的工作重新放回等待队列
+        :return: 恢复的等待工作数
+        """
+        if not self.store:
+            return 0
+        active_works, done_works = self.store.load()
+        self.lock.acquire()
+        try:
+            for work in done_works:
+                self.done_works[work.key] = work
+                self.record_change_locked(work, 'done')
+            for state, work in active_works:
+                if work.key in self.wait_works:
+                    self.store.remove(work)
+                    continue
+                self.wait_works[work.key] = work
+                self.schedule_locked(work)
+                self.record_change_locked(work, 'wait')
+                if state != 'wait':
+                    work.start_time = None
+                    self.store.put(work, 'wait')
+            self.condition.notify_all()
+            return len(self.wait_works)
+        finally:
+            self.lock.release()
+
+    def add_wait_work(self, is_download, path, id, chunk_config=None, download_policy=None, priority=0, size=None,
+                      bandwidth_limit=0):
+        """
+        往等待队列添加工作，并唤醒一个等待工作的线程
         :param is_download: 是下载还是上传
         :param path: 本地路径
         :param id: 文件id
-        :return: 如何工作重复返回None，否则成功插入到工作等待队列，返回工作对象
+        :param chunk_config: 分块配置
+        :param download_policy: 下载策略
+        :param priority: 优先级
+        :param size: 文件大小
+        :param bandwidth_limit: 带宽上限
+        :return: 工作已经在等待队列或者正在工作队列返回None，否则返回工作对象
         """
-        self.wait_works_lock.acquire()
+        key = (is_download, path, id)
+        self.lock.acquire()
         try:
-            for work in self.wait_works:
-                if work.is_download == is_download and work.path == path and work.id == id:
-                    return None
+            if key in self.wait_works or key in self.doing_works:
+                return None
+            work = Work(is_download, path, id, chunk_config, download_policy, priority, size, bandwidth_limit)
+            self.wait_works[key] = work
+            self.schedule_locked(work)
+            self.record_change_locked(work, 'wait')
+            if self.store:
+                self.store.put(work, 'wait')
+            self.condition.notify()
+            return work
         finally:
-            self.wait_works_lock.release()
+            self.lock.release()
 
-        self.doing_works_lock.acquire()
+    def remove_wait_work(self, is_download, path, id):
+        """
+        从等待队列删除工作
+        :return: 删除是否成功
+        """
+        self.lock.acquire()
         try:
-            for work in self.doing_works:
-                if work.is_download == is_download and work.path == path and work.id == id:
-                    return None
+            work = self.wait_works.pop((is_download, path, id), None)
+            if work:
+                self.record_change_locked(work, 'removed')
+            if work and self.store:
+                self.store.remove(work)
+            return work is not None
         finally:
-            self.doing_works_lock.release()
+            self.lock.release()
 
-        self.wait_works_lock.acquire()
-        try:
-            work = Work(is_download, path, id)
-            self.wait_works.append(work)
-        finally:
-            self.wait_works_lock.release()
+    def schedule_locked(self, work):
+        """
+        按当前调度策略把等待的工作放进堆里，调用前需要持有锁
+        :param work: 等待的工作
+        :return: 无返回
+        """
+        if self.policy == 'shortest-first':
+            key = (-work.priority, (work.size or 0) + SCHEDULE_AGING_BYTES_PER_SECOND * work.create_time)
+        else:
+            key = (-work.priority, work.serial)
+        work.schedule_seq = next(self.schedule_seqs)
+        heapq.heappush(self.wait_heaps[work.is_download and self.policy != 'fifo'], (key, work.schedule_seq, work))
+        if len(self.wait_heaps[False]) + len(self.wait_heaps[True]) > 2 * len(self.wait_works) + SCHEDULE_COMPACT_SIZE:
+            self.wait_heaps = {False: [], True: []}
+            for wait_work in self.wait_works.values():
+                self.schedule_locked(wait_work)
 
-        self.create_thread()
+    def peek_wait_work_locked(self, is_download):
+        """
+        丢掉堆顶已经取消或者修改过优先级的旧记录
+        :return: 堆顶的记录，堆为空返回None
+        """
+        heap = self.wait_heaps[is_download]
+        while heap:
+            key, schedule_seq, work = heap[0]
+            if work.schedule_seq == schedule_seq and self.wait_works.get(work.key) is work:
+                return heap[0]
+            heapq.heappop(heap)
+        return None
+
+    def start_wait_work_locked(self):
+        """
+        按调度策略取出下一个等待的工作放入正在工作队列，调用前需要持有锁
+        :return: 工作对象，等待队列为空返回None
+        """
+        heads = dict((is_download, self.peek_wait_work_locked(is_download)) for is_download in (False, True))
+        if not heads[False] and not heads[True]:
+            return None
+        if not heads[False] or not heads[True]:
+            direction = bool(heads[True])
+        elif heads[False][0][0] != heads[True][0][0]:
+            direction = heads[True][0][0] < heads[False][0][0]
+        else:
+            direction = not self.last_direction
+        self.last_direction = direction
+        work = heapq.heappop(self.wait_heaps[direction])[2]
+        key = work.key
+        del self.wait_works[key]
+        self.doing_works[key] = work
+        work.start_time = time()
+        self.record_change_locked(work, 'doing')
+        if self.store:
+            self.store.put(work, 'doing')
+        wait_microseconds = int((work.start_time - work.create_time) * 1000000)
+        self.started_work_count = self.started_work_count + 1
+        self.total_wait_microseconds = self.total_wait_microseconds + wait_microseconds
+        self.max_wait_microseconds = max(self.max_wait_microseconds, wait_microseconds)
+        if self.policy not in self.wait_samples:
+            self.wait_samples[self.policy] = collections.deque(maxlen=SCHEDULE_WAIT_SAMPLES)
+        self.wait_samples[self.policy].append(wait_microseconds)
         return work
 
-    def remove_wait_work(self, is_download, path, id):
+    def set_priority(self, is_download, path, id, priority):
         """
-        在等待队列删除任务
-        :param is_download:
-        :param path:
-        :param id:
-        :return: 删除是否成功
+        修改等待中的工作的优先级
+        :return: 修改是否成功
         """
-        i = 0
-        self.wait_works_lock.acquire()
+        self.lock.acquire()
         try:
-            for work in self.wait_works:
-                if work.is_download == is_download and work.path == path and work.id == id:
-                    self.wait_works.pop(i)
-                    return True
-                i = i + 1
-            return False
+            work = self.wait_works.get((is_download, path, id))
+            if not work:
+                return False
+            work.priority = priority
+            self.schedule_locked(work)
+            self.record_change_locked(work, 'wait', 'updated')
+            if self.store:
+                self.store.put(work, 'wait')
+            return True
         finally:
-            self.wait_works_lock.release()
+            self.lock.release()
 
-    def poll_wait_work(self):
+    def set_bandwidth_limit(self, is_download, path, id, bandwidth_limit):
         """
-        从等待队列中获取工作
-        :return: 工作对象
+        修改等待中或者正在工作的工作的带宽上限
+        :return: 修改是否成功
         """
-        self.wait_works_lock.acquire()
+        self.lock.acquire()
         try:
-            if len(self.wait_works) > 0:
-                return self.wait_works.pop(0)
-            return None
+            key = (is_download, path, id)
+            work = self.wait_works.get(key) or self.doing_works.get(key)
+            if not work:
+                return False
+            work.set_bandwidth_limit(bandwidth_limit)
+            self.record_change_locked(work, work.state, 'updated')
+            if self.store:
+                self.store.put(work, work.state)
+            return True
         finally:
-            self.wait_works_lock.release()
+            self.lock.release()
 
-    def add_doing_work(self, work):
+    def set_policy(self, policy):
         """
-        往正在工作队列中添加工作
-        :param work: 添加的工作
-        :return:
+        修改调度策略，按新策略重新排列等待的工作
+        :param policy: fifo、fair或者shortest-first
+        :return: 修改是否成功
         """
-        self.doing_works_lock.acquire()
+        if policy not in SCHEDULE_POLICIES:
+            return False
+        self.lock.acquire()
         try:
-            print('add_doing_work')
-            print(self.doing_works)
-            print()
-            self.doing_works.append(work)
+            self.policy = policy
+            self.wait_heaps = {False: [], True: []}
+            for work in self.wait_works.values():
+                self.schedule_locked(work)
+            return True
         finally:
-            self.doing_works_lock.release()
+            self.lock.release()
 
-    def remove_doing_work(self, work):
+    def finish_doing_work(self, work):
         """
-        从正在工作队列中删除已完成的工作
+        把工作从正在工作队列移到完成队列，同一个工作再次完成时只保留最新的一次
         :param work: 已完成的工作
         :return:
         """
-        i = 0
-        self.doing_works_lock.acquire()
+        self.lock.acquire()
         try:
-            for w in self.doing_works:
-                if w == work:
-                    self.doing_works.pop(i)
-                    return True
-                i = i + 1
-            return False
+            if self.doing_works.get(work.key) is work:
+                del self.doing_works[work.key]
+            old_work = self.done_works.pop(work.key, None)
+            if old_work and old_work is not work:
+                self.record_change_locked(old_work, 'removed')
+            self.done_works[work.key] = work
+            while len(self.done_works) > DONE_WORKS_SIZE:
+                self.record_change_locked(self.done_works.popitem(last=False)[1], 'removed')
+            work.finish_time = time()
+            self.record_change_locked(work, 'done', 'failed' if work.error else 'finished')
+            if self.store:
+                self.store.put(work, 'done')
         finally:
-            self.doing_works_lock.release()
+            self.lock.release()
 
-    def add_done_work(self, work):
+    def remove_done_work(self, is_download, path, id):
         """
-        添加一个已完成工作到完成队列
-        :param work:
-        :return:
+        从完成队列删除工作
+        :return: 删除是否成功
         """
-        self.done_works_lock.acquire()
+        self.lock.acquire()
         try:
-            self.done_works.append(work)
+            work = self.done_works.pop((is_download, path, id), None)
+            if work:
+                self.record_change_locked(work, 'removed')
+            if work and self.store:
+                self.store.remove(work)
+            return work is not None
         finally:
-            self.done_works_lock.release()
+            self.lock.release()
 
-    def remove_done_work(self, is_download, path, id):
+    def record_change_locked(self, work, state, event=None):
         """
-        从完成队列中删除一个已完成工作
-        :param is_download:
-        :param path:
-        :param id:
-        :return:
+        记录工作的变化并发布事件，调用前需要持有锁，变化记录超过WORK_CHANGE_LOG_SIZE时丢掉最早的
+        :param work: 变化的工作
+        :param state: 变化后的状态，wait、doing、done或者removed
+        :param event: 事件类型，默认按状态从WORK_EVENTS取
+        :return: 无返回
+        """
+        self.version = self.version + 1
+        work.state = state
+        work.version = self.version
+        self.changes.pop(work.serial, None)
+        self.changes[work.serial] = work
+        while len(self.changes) > WORK_CHANGE_LOG_SIZE:
+            self.min_version = self.changes.popitem(last=False)[1].version
+        if self.event_bus:
+            self.event_bus.publish(event or WORK_EVENTS[state], work)
+
+    def touch(self, work):
+        """
+        工作的进度变化
+        :param work: 工作
+        :return: 无返回
         """
-        i = 0
-        self.done_works_lock.acquire()
+        self.lock.acquire()
         try:
-            for work in self.done_works:
-                if work.is_download == is_download and work.path == path and work.id == id:
-                    self.done_works.pop(i)
-                    return True
-                i = i + 1
-            return False
+            if self.doing_works.get(work.key) is work:
+                self.record_change_locked(work, 'doing', 'progress')
         finally:
-            self.done_works_lock.release()
+            self.lock.release()
 
-    def do_work(self, main_client, work, status_func):
+    def get_snapshot(self):
         """
-        执行工作
-        :param work:
-        :param status_func:
-        :return:
+        获取全部工作的快照，按等待、正在工作、完成的顺序。锁里只复制引用，转换和过滤都在锁外进行，
+        快照最多每LIST_WORKS_SNAPSHOT_INTERVAL秒重建一次，避免频繁轮询时反复在锁里复制大队列，
+        之后的变化可以用快照的版本号增量获取
+        :return: (快照的版本号, 工作序列)
         """
-        if work.is_download:
-            self.do_download_work(main_client, work.id, work.path, status_func)
-        else:
-            self.do_upload_work(main_client, work.path, work.id)
+        self.lock.acquire()
+        try:
+            if self.snapshot_version != self.version and time() - self.snapshot_time >= LIST_WORKS_SNAPSHOT_INTERVAL:
+                self.snapshot = list(self.wait_works.values()) + list(self.doing_works.values()) + \
+                                list(self.done_works.values())
+                self.snapshot_version = self.version
+                self.snapshot_time = time()
+            return self.snapshot_version, self.snapshot
+        finally:
+            self.lock.release()
 
-    def do_upload_work(self, main_client, path, id):
+    def get_changes(self, since_version):
         """
-        执行上传工作，如果上传是文件，则上传，如果是文件夹，先交由upload_folder_to_works拆散成单个文件，并添加到等待队列
-        :param path: 上传本地路径
-        :param id: 上传到文件夹的id
-        :return:
+        获取某个版本之后变化的工作
+        :param since_version: 版本号
+        :return: (版本号, 按变化先后排序的(变化的版本号, 工作)序列)，版本号太旧，变化记录已经丢掉时返回(版本号, None)
         """
+        self.lock.acquire()
         try:
-            if os.path.isdir(path):
-                self.upload_folder_to_works(main_client=main_client, folder_path=path, folder_id=id)
-            else:
-                print('开始上传', path)
-                while True:
-                    try:
-                        self.upload_file(file_path=path, folder_id=id)
-                        break
-                    except Exception as e:
-                        print(e)
-                        if os.path.getsize(path) == 0:
-                            print('上传失败，是空文件，上传会报400 bad request，无法上传', path)
-                            break
-                        print('上传失败，再次尝试上传', path)
-                print('上传完成', path)
-        except Exception as e:
-            print(e)
-            print('上传失败', path, id)
+            if since_version < self.min_version:
+                return self.version, None
+            changes = []
+            for work in reversed(self.changes.values()):
+                if work.version <= since_version:
+                    break
+                changes.append((work.version, work))
+            changes.reverse()
+            return self.version, changes
+        finally:
+            self.lock.release()
 
-    def do_download_work(self, main_client, id, path, status_func):
+    def list_works(self, state=None, is_download=None, path_prefix=None, offset=0, limit=LIST_WORKS_LIMIT,
+                   since_version=None):
         """
-        执行下载工作，如果下载是文件则直接下载，否则交给download_folder_to_works拆散成单个文件，并添加到等待队列
-        :param id: 下载的id
-        :param path: 保存的本地路径
-        :param status_func: 监控方法
-        :return:
+        分页、过滤列出工作
+        :param state: 只列出某个状态的工作，wait、doing或者done，增量列出时不按状态过滤，以便客户端知道工作离开了某个状态
+        :param is_download: 只列出下载或者上传
+        :param path_prefix: 只列出本地路径以此开头的工作
+        :param offset: 跳过的工作数，增量列出时不使用，用返回的version继续获取
+        :param limit: 最多返回的工作数
+        :param since_version: 只列出这个版本之后变化的工作，包括被删除的(状态为removed)
+        :return: {'version': 下次作为since_version传入的版本号, 'reset': 版本号太旧需要重新全量获取时为True,
+                  'more': 还有没返回的工作时为True, 'total': 符合条件的工作数, 'works': 工作map序列}。
+                 增量列出的变化超过limit时只返回最早的limit个，version是其中最后一个变化的版本号而不是当前版本号，
+                 客户端应该马上用它再获取一次，直到more为False
         """
+        reset = False
+        changes = None
+        if since_version is not None:
+            version, changes = self.get_changes(since_version)
+            reset = changes is None
+        if changes is None:
+            version, works = self.get_snapshot()
+            works = [work for work in works
+                     if (state is None or work.state == state) and
+                     (is_download is None or work.is_download == is_download) and
+                     (not path_prefix or work.path.startswith(path_prefix))]
+            return {'version': version, 'reset': reset, 'more': offset + limit < len(works), 'total': len(works),
+                    'works': [work.to_map() for work in works[offset:offset + limit]]}
+        changes = [(change_version, work) for change_version, work in changes
+                   if (is_download is None or work.is_download == is_download) and
+                   (not path_prefix or work.path.startswith(path_prefix))]
+        more = len(changes) > limit
+        if more:
+            version = changes[limit - 1][0] if limit > 0 else since_version
+        return {'version': version, 'reset': reset, 'more': more, 'total': len(changes),
+                'works': [work.to_map() for change_version, work in changes[:limit]]}
+
+    def get_works(self, works):
+        """
+        复制某个队列的工作序列
+        :param works: wait_works、doing_works或者done_works
+        :return: 工作序列
+        """
+        self.lock.acquire()
         try:
-            if self.is_folder_by_id(id):
-                self.download_folder_to_works(main_client=main_client, folder_id=id, save_folder_path=path)
-            else:
-                file = self.search_file_by_id(id)
-                print('开始下载', file['name'], file['id'])
-                while True:
-                    try:
-                        self.download_file(file=file, save_folder_path=path, status_func=status_func)
-                        break
-                    except Exception as e:
-                        print(e)
-                        print('下载失败，再次尝试下载', file['name'], file['id'])
-                print('下载完成', file['name'], file['id'])
-        except Exception as e:
-            print(e)
-            print('下载失败', id, path)
+            return list(works.values())
+        finally:
+            self.lock.release()
 
-    def upload_folder_to_works(self, main_client, folder_path, folder_id=None):
+    def get_stats(self):
         """
-        把文件夹拆散成单个文件，并创建对应的文件夹得到其id，分配到各个文件上传，并添加到等待队列
-        :param folder_path: 上传的文件夹
-        :param folder_id: 保存到文件夹的id
+        获取各队列大小和工作从加入等待队列到开始执行的时间统计
+        :return: 统计map
+        """
+        self.lock.acquire()
+        try:
+            return {'wait_works': len(self.wait_works), 'doing_works': len(self.doing_works),
+                    'done_works': len(self.done_works), 'started_works': self.started_work_count,
+                    'avg_wait_microseconds': self.total_wait_microseconds // self.started_work_count
+                    if self.started_work_count else 0,
+                    'max_wait_microseconds': self.max_wait_microseconds, 'schedule_policy': self.policy,
+                    'wait_percentiles': dict((policy, get_percentiles(samples))
+                                             for policy, samples in self.wait_samples.items())}
+        finally:
+            self.lock.release()
+
+
+class WorkThread(threading.Thread):
+    def __init__(self, main_client):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.main_client = main_client
+        self.thread_client = GoogleDiverWorker(main_client)
+        self.work = None
+
+    def run(self):
+        try:
+            while True:
+                work = self.main_client.take_wait_work(self)
+                if not work:
+                    break
+                self.work = work
+                self.thread_client.do_work(self.main_client, work, self.status_func)
+                self.main_client.finish_doing_work(work)
+                self.work = None
+        finally:
+            self.thread_client.close()
+
+    def status_func(self, file, status, done):
+        if self.work:
+            report_work_status(self.main_client, self.work, file, status, done)
+
+
+def report_work_status(main_client, work, file, status, done):
+    """
+    更新工作的进度
+    :param main_client: 主客户端
+    :param work: 工作
+    :param file: 正在传输的文件对象
+    :param status: 进度
+    :param done: 是否完成
+    :return: 无返回
+    """
+    work.progress = int(status.progress() * 100)
+    work.done = done
+    work.file_name = file['name']
+    main_client.work_registry.touch(work)
+    print(file['name'], "%d%%." % int(status.progress() * 100), done)
+
+
+class AsyncDriveEngine(object):
+    """
+    基于asyncio和aiohttp的传输引擎，代替工作线程。一个事件循环线程里同时执行最多ASYNC_MAX_WORKS个文件工作，
+    元数据、文件列表、可续传上传和分段下载都是协程，共用一个最多ASYNC_CONNECTIONS个连接的连接池。
+    读写本地文件和算md5在线程池里执行，拆散文件夹交给ASYNC_FOLDER_THREADS个GoogleDiverWorker
+    """
+
+    def __init__(self, main_client, max_works=ASYNC_MAX_WORKS, connections=ASYNC_CONNECTIONS):
+        self.main_client = main_client
+        self.api_url = DRIVE_API_URL or DRIVE_API_ROOT_URL
+        self.max_works = max_works
+        self.connections = connections
+        self.slots = threading.Semaphore(max_works)
+        self.loop = asyncio.new_event_loop()
+        self.session = None
+        self.folder_executor = ThreadPoolExecutor(ASYNC_FOLDER_THREADS)
+        self.folder_workers = threading.local()
+        self.list_tasks = {}
+        self.lock = threading.Lock()
+        self.doing_count = 0
+        self.max_doing_count = 0
+        self.done_count = 0
+
+    def start(self):
+        """
+        启动事件循环线程和取工作的线程
         :return: 无返回
         """
-        if not os.path.exists(folder_path):
-            return
-        if not folder_id:
-            folder_id = self.get_root_id()
-        folder = self.create_folder(os.path.basename(folder_path), folder_id)
-        file_names = os.listdir(folder_path)
-        for file_name in file_names:
-            file_path = folder_path + '/' + file_name
-            if os.path.isdir(file_path):
-                self.upload_folder_to_works(main_client, file_path, folder['id'])
-            else:
-                if not main_client.create_and_add_wait_work(False, file_path, folder['id']):
-                    print('上传任务已经在队列中', file_path, folder['name'], folder['id'])
-                else:
-                    print('添加上传任务', file_path, folder['name'], folder['id'])
+        for target in (self.loop.run_forever, self.run):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
 
-    def download_folder_to_works(self, main_client, folder_id, save_folder_path):
+    async def create_session(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.connections),
+            timeout=aiohttp.ClientTimeout(sock_connect=HTTP_TIMEOUT, sock_read=HTTP_TIMEOUT))
+
+    def run(self):
         """
-        下载文件夹，将下载的文件夹拆散成单个文件，并设置对应的保存路径，并添加到等待队列
-        :param folder_id: 下载文件夹的id
-        :param save_folder_path: 保存到的本地路径
-        :param status_func: 下载状态调用方法
-        :return:
+        不断从等待队列取工作交给事件循环，同时执行的工作数达到上限时等其中一个完成
+        :return: 无返回
         """
-        folder = self.search_file_by_id(folder_id)
-        files = self.get_file_list(folder_id)
-        for file in files:
-            if self.is_folder(file):
-                self.download_folder_to_works(main_client, file['id'], save_folder_path + '/' + folder['name'])
+        asyncio.run_coroutine_threadsafe(self.create_session(), self.loop).result()
+        while True:
+            self.slots.acquire()
+            work = self.main_client.take_wait_work(None)
+            self.lock.acquire()
+            try:
+                self.doing_count = self.doing_count + 1
+                self.max_doing_count = max(self.max_doing_count, self.doing_count)
+            finally:
+                self.lock.release()
+            future = asyncio.run_coroutine_threadsafe(self.do_work(work), self.loop)
+            future.add_done_callback(lambda f, work=work: self.finish_work(work))
+
+    def finish_work(self, work):
+        self.main_client.finish_doing_work(work)
+        self.lock.acquire()
+        try:
+            self.doing_count = self.doing_count - 1
+            self.done_count = self.done_count + 1
+        finally:
+            self.lock.release()
+        self.slots.release()
+
+    async def do_work(self, work):
+        """
+        执行工作，文件夹交给线程池拆散成单个文件的工作，文件按RETRY_POLICY重试上传或者下载
+        :param work: 工作对象
+        :return: 无返回
+        """
+
+        def status_func(file, status, done):
+            report_work_status(self.main_client, work, file, status, done)
+
+        try:
+            if work.is_download:
+                file = await self.get_file(work.id)
+                if self.main_client.is_folder(file):
+                    await self.loop.run_in_executor(self.folder_executor, self.do_folder_work, work, status_func)
+                    return
+                print('开始下载', file['name'], file['id'])
+                await RETRY_POLICY.run_async(lambda: self.download_file(file, work, status_func), work, file['name'])
+                print('下载完成', file['name'], file['id'])
             else:
-                if not main_client.create_and_add_wait_work(True, save_folder_path + '/' + folder['name'], file['id']):
-                    print('下载任务已在队列中', file['name'], file['id'], save_folder_path + '/' + folder['name'])
-                else:
-                    print('添加下载队列', file['name'], file['id'], save_folder_path + '/' + folder['name'])
+                if os.path.isdir(work.path):
+                    await self.loop.run_in_executor(self.folder_executor, self.do_folder_work, work, status_func)
+                    return
+                print('开始上传', work.path)
+                await RETRY_POLICY.run_async(lambda: self.upload_file(work), work, work.path)
+                print('上传完成', work.path)
+        except Exception as e:
+            print(e)
+            work.error = str(e)
+            print('下载失败' if work.is_download else '上传失败', work.id, work.path)
 
-                    # API start ---------------------------------------------------------------
+    def do_folder_work(self, work, status_func):
+        worker = getattr(self.folder_workers, 'worker', None)
+        if worker is None:
+            worker = GoogleDiverWorker(self.main_client)
+            self.folder_workers.worker = worker
+        worker.do_work(self.main_client, work, status_func)
 
-    def upload(self, path, folder_id=None):
-        """
-        添加上传任务
-        :param path: 上传的本地路径
-        :param folder_id: 保存到文件夹的id
-        :return: 任务添加是否成功
-        """
-        if not os.path.exists(path):
-            print('目录不存在', path)
-            return False
-        if self.create_and_add_wait_work(False, path, folder_id):
-            print('添加上传任务', path, folder_id)
-            return True
-        else:
-            print('上传任务已经在队列中', path, folder_id)
-            return False
+    async def get_access_token(self):
+        credentials = self.main_client.service_pool.credentials
+        if not credentials:
+            return None
+        if credentials.access_token_expired:
+            await self.loop.run_in_executor(None, self.main_client.service_pool.refresh_credentials)
+        return credentials.access_token
 
-    def download(self, id, save_folder_path):
+    async def request(self, method, url, headers=None, **kwargs):
         """
-        添加下载任务
-        :param id: 下载的文件夹或者文件的id
-        :param save_folder_path: 保存到本地目录
-        :return: 任务添加是否成功
+        发出请求，除了数据块请求先从全局令牌桶取令牌，出错时抛出和googleapiclient一样的HttpError，以便沿用重试策略
+        :param method: 请求方法
+        :param url: 相对api根地址的路径或者完整地址
+        :param headers: 请求头
+        :return: (响应, 响应内容)
         """
-        if self.create_and_add_wait_work(True, save_folder_path, id):
-            print('添加下载队列', id, save_folder_path)
-            return True
-        else:
-            print('下载任务已在队列中', id, save_folder_path)
-            return False
+        params = kwargs.get('params') or {}
+        if params.get('alt') != 'media' and not is_media_request(url):
+            await asyncio.sleep(RATE_GOVERNOR.reserve())
+        headers = dict(headers or {})
+        access_token = await self.get_access_token()
+        if access_token:
+            headers['Authorization'] = 'Bearer ' + access_token
+        if not url.startswith('http'):
+            url = self.api_url + url
+        async with self.session.request(method, url, headers=headers, **kwargs) as response:
+            content = await response.read()
+            if response.status >= 400:
+                info = dict((name.lower(), value) for name, value in response.headers.items())
+                info['status'] = response.status
+                raise HttpError(httplib2.Response(info), content, uri=url)
+            return response, content
 
-    def delete_wait_work(self, is_download, path, id):
+    async def get_file(self, file_id):
         """
-        从等待队列中取消任务
-        :param is_download: 任务是下载还是上传
-        :param path: 本地路径
-        :param id: 文件或者文件夹id
-        :return: 取消是否成功
+        通过id获取文件对象，优先从元数据缓存获取
         """
-        return self.remove_wait_work(is_download, path, id)
+        file = self.main_client.get_cached_file(file_id)
+        if file is not None:
+            return file
+        response, content = await self.request('GET', 'drive/v3/files/' + file_id, params={'fields': FILE_INFO})
+        file = json.loads(content.decode('utf-8'))
+        self.main_client.metadata_cache.put(('file', file_id), file)
+        return file
 
-    def delete_done_work(self, is_download, path, id):
+    async def get_file_list(self, folder_id):
         """
-        从完成队列中删除任务
-        :param is_download: 任务是下载还是上传
-        :param path: 本地路径
-        :param id: 文件或者文件夹id
-        :return: 删除是否成功
+        获取文件夹下全部文件序列，优先从元数据同步或者元数据缓存获取。
+        同一个文件夹同时只列出一次，往同一个文件夹上传的工作共用列出的结果
         """
-        return self.remove_done_work(is_download, path, id)
+        if self.main_client.metadata_sync:
+            return await self.loop.run_in_executor(None, self.main_client.metadata_sync.get_file_list, folder_id)
+        files = self.main_client.metadata_cache.get(('list', folder_id))
+        if files is not None:
+            return files
+        task = self.list_tasks.get(folder_id)
+        if task is None:
+            task = self.loop.create_task(self.list_folder(folder_id))
+            self.list_tasks[folder_id] = task
+            task.add_done_callback(lambda t: self.list_tasks.pop(folder_id, None))
+        return await task
 
-    def get_now_file_list(self):
-        """
-        返回当前文件夹的文件列表json
-        :return: 前文件夹的文件列表json
-        """
-        return self.get_file_list(self.now_id)
+    async def list_folder(self, folder_id):
+        files = []
+        params = {'q': "'" + folder_id + "' in parents and trashed = false",
+                  'fields': 'nextPageToken, files(' + FILE_INFO + ')'}
+        while True:
+            response, content = await self.request('GET', 'drive/v3/files', params=params)
+            response = json.loads(content.decode('utf-8'))
+            for file in response.get('files', []):
+                files.append(file)
+                self.main_client.metadata_cache.put(('file', file['id']), file)
+            if 'nextPageToken' not in response:
+                break
+            params['pageToken'] = response['nextPageToken']
+        self.main_client.metadata_cache.put(('list', folder_id), files)
+        return files
 
-    def goto_parent_folder(self):
+    async def upload_file(self, work):
         """
-        返回父目录
-        :return: 父目录下全部文件夹和文件json
+        上传文件，和GoogleDiverAPI.upload_file一样跳过内容相同的同名文件，小于MULTIPART_UPLOAD_THRESHOLD的文件用multipart上传，
+        其他文件可续传上传，并用上传日志在重试或者重启后继续上传
+        :param work: 上传工作
+        :return: 上传的文件对象，跳过时返回已有的文件对象
         """
-        print('self.now_id', self.now_id)
-        self.now_id = self.get_parent_folder(self.now_id)
-        return self.get_file_list(self.now_id)
+        file_path = work.path
+        folder_id = work.id or self.main_client.root_id
+        file_name = os.path.basename(file_path)
+        remote_files = await self.get_file_list(folder_id)
+        same_file = (await self.loop.run_in_executor(None, self.main_client.find_same_files, [file_path],
+                                                     folder_id, [file_name], remote_files))[0]
+        if same_file:
+            print('文件没有变化，跳过上传', file_path)
+            return same_file
+        size = os.path.getsize(file_path)
+        file = None
+        upload = self.main_client.upload_journal.get_upload(file_path, folder_id, file_name)
+        if not upload and size < MULTIPART_UPLOAD_THRESHOLD:
+            file = await self.upload_multipart(file_path, folder_id, file_name)
+            wait_seconds = BANDWIDTH_LIMITER.consume(False, size, work)
+            if wait_seconds > 0:
+                await asyncio.sleep(wait_seconds)
+            self.main_client.cache_file(file, [folder_id])
+            return file
+        if upload:
+            print('继续上传', file_path, upload['offset'])
+            resumable_uri = upload['resumable_uri']
+            try:
+                offset, file = await self.put_chunk(resumable_uri, None, 0, size)
+            except HttpError as e:
+                if e.resp.status not in (404, 410):
+                    raise
+                print('上传会话已失效，重新上传', file_path)
+                self.main_client.upload_journal.remove_upload(file_path, folder_id, file_name)
+                upload = None
+        if not upload:
+            response, content = await self.request('POST', 'upload/drive/v3/files',
+                                                   params={'uploadType': 'resumable', 'fields': FILE_INFO},
+                                                   headers={'X-Upload-Content-Length': str(size),
+                                                            'X-Upload-Content-Type': get_mime_type(file_path)},
+                                                   json={'name': file_name, 'parents': [folder_id]})
+            resumable_uri = response.headers['Location']
+            offset = 0
+        chunk_sizer = work.get_chunk_sizer()
+        with open(file_path, 'rb') as upload_file:
+            def read(start, chunk_size):
+                upload_file.seek(start)
+                return upload_file.read(chunk_size)
 
-    def goto_child_folder(self, child_folder_id):
+            while file is None:
+                data = await self.loop.run_in_executor(None, read, offset, chunk_sizer.chunk_size)
+                start_time = time()
+                next_offset, file = await self.put_chunk(resumable_uri, data, offset, size)
+                sent = (size if file else next_offset) - offset
+                chunk_sizer.record(sent, time() - start_time)
+                wait_seconds = BANDWIDTH_LIMITER.consume(False, sent, work)
+                offset = next_offset
+                if file is None:
+                    self.main_client.upload_journal.put_upload(file_path, folder_id, file_name, resumable_uri, offset)
+                if wait_seconds > 0:
+                    await asyncio.sleep(wait_seconds)
+        self.main_client.upload_journal.remove_upload(file_path, folder_id, file_name)
+        self.main_client.cache_file(file, [folder_id])
+        return file
+
+    async def upload_multipart(self, file_path, folder_id, file_name):
         """
-        进入子目录
-        :param child_folder_id: 子目录的id
-        :return: 子目录下全部文件夹和文件json
+        用一次multipart/related请求上传元数据和文件内容
+        :return: 上传的文件对象
         """
-        self.now_id = child_folder_id
-        return self.get_file_list(self.now_id)
 
-    def get_json_wait_works(self):
+        def read():
+            with open(file_path, 'rb') as upload_file:
+                return upload_file.read()
+
+        content = await self.loop.run_in_executor(None, read)
+        mime_type = get_mime_type(file_path)
+        boundary = 'pythonGoogleDrive%016x' % random.getrandbits(64)
+        body = b''.join([('--%s\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n' % boundary).encode(),
+                         json.dumps({'name': file_name, 'parents': [folder_id]}).encode('utf-8'),
+                         ('\r\n--%s\r\nContent-Type: %s\r\n\r\n' % (boundary, mime_type)).encode(),
+                         content, ('\r\n--%s--' % boundary).encode()])
+        response, content = await self.request('POST', 'upload/drive/v3/files',
+                                               params={'uploadType': 'multipart', 'fields': FILE_INFO},
+                                               headers={'Content-Type': 'multipart/related; boundary=' + boundary},
+                                               data=body)
+        return json.loads(content.decode('utf-8'))
+
+    async def put_chunk(self, resumable_uri, data, offset, size):
         """
-        获取wait_works的json
-        :return: wait_works的json
+        上传一块数据
+        :param data: 数据，None时只查询服务器已经收到的字节数
+        :param offset: 数据在文件中的位置
+        :param size: 文件大小
+        :return: (服务器已经收到的字节数, 上传完成时的文件对象否则None)
         """
-        list = []
-        self.wait_works_lock.acquire()
-        try:
-            for work in self.wait_works:
-                list.append(work.to_map())
-            return json.dumps(list)
-        finally:
-            self.wait_works_lock.release()
+        if data:
+            content_range = 'bytes %d-%d/%d' % (offset, offset + len(data) - 1, size)
+        else:
+            content_range = 'bytes */%d' % size
+        response, content = await self.request('PUT', resumable_uri, headers={'Content-Range': content_range},
+                                               data=data or b'', allow_redirects=False)
+        if response.status == 308:
+            received = response.headers.get('Range')
+            return int(received.split('-')[-1]) + 1 if received else 0, None
+        return size, json.loads(content.decode('utf-8'))
 
-    def get_json_doing_works(self):
+    async def download_file(self, file, work, status_func):
         """
-        获取doing_works的json
-        :return: doing_works的json
+        分段下载文件，和GoogleDiverAPI.download_file一样写.part文件和检查点，大文件的各段是同时进行的协程
+        :param file: 下载文件的对象
+        :param work: 下载工作
+        :param status_func: 下载状态调用方法
+        :return: 无返回
         """
-        list = []
-        self.doing_works_lock.acquire()
+        save_folder_path = work.path
+        size = get_download_size(file)
+        chunk_sizer = work.get_chunk_sizer()
+        if not os.path.exists(save_folder_path):
+            os.makedirs(save_folder_path)
+        if (await self.loop.run_in_executor(None, self.main_client.find_same_local_files, [file], save_folder_path,
+                                            work.download_policy))[0]:
+            print('本地文件没有变化，跳过下载', save_folder_path + '/' + file['name'])
+            status_func(file, MediaDownloadProgress(size, size), True)
+            return
+        streams = PARALLEL_DOWNLOAD_STREAMS if size >= PARALLEL_DOWNLOAD_THRESHOLD else 1
+        checkpoint = DownloadCheckpoint(save_folder_path + '/' + file['name'], file)
+        checkpoint.load(streams)
+        progress = [checkpoint.get_downloaded_size()]
+        if progress[0] > 0:
+            print('继续下载', file['name'], progress[0])
+
+        def write(save_file, index, start, content):
+            save_file.seek(start)
+            save_file.write(content)
+            checkpoint.update(index, start + len(content), save_file)
+
+        async def download_range(index, start, end):
+            with open(checkpoint.part_path, 'r+b') as save_file:
+                while start <= end:
+                    request_end = min(start + chunk_sizer.chunk_size - 1, end)
+                    start_time = time()
+                    response, content = await self.request(
+                        'GET', 'drive/v3/files/' + file['id'], params={'alt': 'media'},
+                        headers={'Range': 'bytes=%d-%d' % (start, request_end)})
+                    chunk_sizer.record(len(content), time() - start_time)
+                    check_range_response(file['id'], response.status, response.headers.get('Content-Range'), start,
+                                         request_end, len(content))
+                    if not content:
+                        raise IOError('分段下载没有返回数据 %s bytes=%d-%d' % (file['id'], start, end))
+                    await self.loop.run_in_executor(None, write, save_file, index, start, content)
+                    start = start + len(content)
+                    progress[0] = progress[0] + len(content)
+                    status_func(file, MediaDownloadProgress(progress[0], checkpoint.size), False)
+                    wait_seconds = BANDWIDTH_LIMITER.consume(True, len(content), work)
+                    if wait_seconds > 0:
+                        await asyncio.sleep(wait_seconds)
+
+        await asyncio.gather(*[download_range(index, start, end)
+                               for index, (start, end) in enumerate(checkpoint.ranges) if start <= end])
+        status_func(file, MediaDownloadProgress(checkpoint.size, checkpoint.size), True)
+        checkpoint.commit()
+
+    def get_stats(self):
+        self.lock.acquire()
         try:
-            for work in self.doing_works:
-                list.append(work.to_map())
-            return json.dumps(list)
+            return {'engine': 'asyncio', 'doing_works': self.doing_count, 'max_doing_works': self.max_doing_count,
+                    'done_works': self.done_count, 'max_works': self.max_works, 'connections': self.connections}
         finally:
-            self.doing_works_lock.release()
+            self.lock.release()
 
-    def get_json_done_works(self):
+
+class RpcExecutor(object):
+    """
+    执行需要访问谷歌硬盘的rpc方法的有界线程池，最多RPC_DRIVE_QUEUE_SIZE个调用在执行或者排队，超过时直接返回繁忙。
+    每个方法按RPC_METHOD_TIMEOUTS等待结果，超时返回错误，调用本身会在线程池里继续执行完
+    """
+
+    def __init__(self, threads=RPC_DRIVE_THREADS, queue_size=RPC_DRIVE_QUEUE_SIZE):
+        self.executor = ThreadPoolExecutor(threads)
+        self.semaphore = threading.BoundedSemaphore(queue_size)
+        self.lock = threading.Lock()
+        self.call_count = 0
+        self.busy_count = 0
+        self.timeout_count = 0
+
+    def wrap(self, name, func):
         """
-        获取done_works的json
-        :return: done_works的json
+        :param name: rpc方法名，用于查找超时时间
+        :param func: 方法
+        :return: 在线程池执行方法的包装方法
         """
-        list = []
-        self.done_works_lock.acquire()
-        try:
-            for work in self.done_works:
-                list.append(work.to_map())
-            return json.dumps(list)
-        finally:
-            self.done_works_lock.release()
 
+        def method(*args, **kwargs):
+            return self.call(name, func, args, kwargs)
 
-# API end ---------------------------------------------------------------
+        return method
 
+    def call(self, name, func, args, kwargs):
+        if not self.semaphore.acquire(False):
+            self.count('busy_count')
+            raise RuntimeError('服务繁忙 %s' % name)
+        try:
+            future = self.executor.submit(func, *args, **kwargs)
+        except Exception:
+            self.semaphore.release()
+            raise
+        future.add_done_callback(lambda f: self.semaphore.release())
+        self.count('call_count')
+        try:
+            return future.result(RPC_METHOD_TIMEOUTS.get(name, RPC_TIMEOUT))
+        except FutureTimeoutError:
+            self.count('timeout_count')
+            raise RuntimeError('执行超时 %s' % name)
 
-class Work(object):
-    def __init__(self, is_download, path, id):
-        self.is_download = is_download
-        self.path = path
-        self.id = id
-        self.progress = 0
-        self.done = False
-        self.file_name = None
+    def count(self, name):
+        self.lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + 1)
+        finally:
+            self.lock.release()
 
-    def to_map(self):
-        return {'is_download': self.is_download, 'path': self.path, 'id': self.id, 'progress': self.progress,
-                'done': self.done, 'file_name': self.file_name}
+    def get_stats(self):
+        self.lock.acquire()
+        try:
+            return {'calls': self.call_count, 'busy': self.busy_count, 'timeouts': self.timeout_count}
+        finally:
+            self.lock.release()
 
 
-class WorkThread(threading.Thread):
-    def __init__(self, main_client):
-        threading.Thread.__init__(self)
-        self.main_client = main_client
-        self.thread_client = GoogleDiverClient()
-        self.work = None
+class RpcStats(object):
+    """
+    每个rpc方法最近RPC_LATENCY_SAMPLES次调用的耗时，用于计算p50和p99
+    """
 
-    def run(self):
-        none_count = 0
-        while none_count < 10:
-            work = self.main_client.poll_wait_work()
-            if not work:
-                none_count = none_count + 1
-                self.work = None
-                sleep(1)
-            else:
-                self.work = work
-                none_count = 0
-                self.main_client.add_doing_work(work)
-                self.thread_client.do_work(self.main_client, work, self.status_func)
-                self.main_client.remove_doing_work(work)
-                self.main_client.add_done_work(work)
-        self.main_client.remove_thread(self)
+    def __init__(self, size=RPC_LATENCY_SAMPLES):
+        self.size = size
+        self.samples = {}
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
 
-    def status_func(self, file, status, done):
-        if self.work:
-            self.work.progress = int(status.progress() * 100)
-            self.work.done = done
-            self.work.file_name = file['name']
-            print(file['name'], "%d%%." % int(status.progress() * 100), done)
+    def record(self, method, seconds):
+        self.lock.acquire()
+        try:
+            if method not in self.samples:
+                self.samples[method] = collections.deque(maxlen=self.size)
+            self.samples[method].append(seconds)
+            self.counts[method] = self.counts[method] + 1
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        """
+        :return: {方法名: {'count': 调用次数, 'p50_ms': 毫秒, 'p99_ms': 毫秒}}
+        """
+        self.lock.acquire()
+        try:
+            samples = dict((method, sorted(seconds)) for method, seconds in self.samples.items())
+            counts = dict(self.counts)
+        finally:
+            self.lock.release()
+        stats = {}
+        for method, seconds in samples.items():
+            stats[method] = {'count': counts[method],
+                             'p50_ms': round(seconds[int(0.5 * (len(seconds) - 1))] * 1000, 3),
+                             'p99_ms': round(seconds[int(0.99 * (len(seconds) - 1))] * 1000, 3)}
+        return stats
 
 
 class GoogleDiverClientDaemon(object):
     def __init__(self):
         self.googleDiverClient = GoogleDiverClient()
+        if METADATA_SYNC:
+            STARTUP_TIMER.measure('metadata_sync', self.googleDiverClient.start_metadata_sync)
         self.manager = JSONRPCResponseManager()
+        self.rpc_executor = RpcExecutor()
+        self.batch_executor = ThreadPoolExecutor(RPC_BATCH_THREADS)
+        self.rpc_stats = RpcStats()
 
-    def upload(self, path):
+    def upload(self, path, chunk_config=None, priority=0, bandwidth_limit=0):
         print('上传文件', path)
-        return self.googleDiverClient.upload(path=path, folder_id=self.googleDiverClient.now_id)
+        return self.googleDiverClient.upload(path=path, folder_id=self.googleDiverClient.now_id,
+                                             chunk_config=chunk_config, priority=priority,
+                                             bandwidth_limit=bandwidth_limit)
 
     def download(self, **map):
         print('下载', map['id'], map['save_folder_path'])
-        return self.googleDiverClient.download(id=map['id'], save_folder_path=map['save_folder_path'])
+        return self.googleDiverClient.download(id=map['id'], save_folder_path=map['save_folder_path'],
+                                               chunk_config=map.get('chunk_config'),
+                                               download_policy=map.get('download_policy'),
+                                               priority=map.get('priority', 0),
+                                               bandwidth_limit=map.get('bandwidth_limit', 0))
+
+    def set_work_priority(self, **map):
+        print('优先级', map['is_download'], map['path'], map['id'], map['priority'])
+        return self.googleDiverClient.set_work_priority(is_download=map['is_download'], path=map['path'],
+                                                        id=map['id'], priority=map['priority'])
+
+    def set_schedule_policy(self, policy):
+        print('调度策略', policy)
+        return self.googleDiverClient.set_schedule_policy(policy=policy)
+
+    def upload_stream(self, path, file_name=None):
+        print('流式上传', path)
+        return self.googleDiverClient.upload_pipe(path=path, folder_id=self.googleDiverClient.now_id,
+                                                  file_name=file_name)
+
+    def set_work_bandwidth_limit(self, **map):
+        print('工作带宽上限', map['is_download'], map['path'], map['id'], map['bandwidth_limit'])
+        return self.googleDiverClient.set_work_bandwidth_limit(is_download=map['is_download'], path=map['path'],
+                                                               id=map['id'], bandwidth_limit=map['bandwidth_limit'])
+
+    def get_bandwidth_limits(self):
+        return self.googleDiverClient.get_bandwidth_limits()
+
+    def set_bandwidth_limits(self, upload=None, download=None, schedule=None):
+        print('带宽上限', upload, download, schedule)
+        return self.googleDiverClient.set_bandwidth_limits(upload=upload, download=download, schedule=schedule)
 
     def delete_wait_work(self, **map):
         print('取消wait', map['is_download'], map['path'], map['id'])
@@ -787,6 +4116,12 @@ class GoogleDiverClientDaemon(object):
         print('子文件夹', child_folder_id)
         return self.googleDiverClient.goto_child_folder(child_folder_id=child_folder_id)
 
+    def list_works(self, **map):
+        return self.googleDiverClient.list_works(state=map.get('state'), is_download=map.get('is_download'),
+                                                 path_prefix=map.get('path_prefix'), offset=map.get('offset', 0),
+                                                 limit=map.get('limit', LIST_WORKS_LIMIT),
+                                                 since_version=map.get('since_version'))
+
     def get_json_wait_works(self):
         print('wait_works')
         return self.googleDiverClient.get_json_wait_works()
@@ -799,29 +4134,151 @@ class GoogleDiverClientDaemon(object):
         print('done_works')
         return self.googleDiverClient.get_json_done_works()
 
+    def set_thread_pool_size(self, thread_pool_size):
+        print('线程池大小', thread_pool_size)
+        return self.googleDiverClient.set_thread_pool_size(thread_pool_size=thread_pool_size)
+
+    def get_scheduler_stats(self):
+        print('scheduler_stats')
+        return self.googleDiverClient.get_scheduler_stats()
+
+    def get_metadata_cache_stats(self):
+        print('metadata_cache_stats')
+        return self.googleDiverClient.get_metadata_cache_stats()
+
+    def get_metadata_sync_stats(self):
+        print('metadata_sync_stats')
+        return self.googleDiverClient.get_metadata_sync_stats()
+
+    def get_service_pool_stats(self):
+        print('service_pool_stats')
+        return self.googleDiverClient.get_service_pool_stats()
+
+    def get_hash_cache_stats(self):
+        print('hash_cache_stats')
+        return self.googleDiverClient.get_hash_cache_stats()
+
+    def get_rate_governor_stats(self):
+        print('rate_governor_stats')
+        return self.googleDiverClient.get_rate_governor_stats()
+
+    def set_request_rate(self, rate, burst=None):
+        print('每秒请求数', rate, burst)
+        return self.googleDiverClient.set_request_rate(rate=rate, burst=burst)
+
+    def get_rpc_stats(self):
+        return {'latency': self.rpc_stats.get_stats(), 'executor': self.rpc_executor.get_stats()}
+
+    def event_stream(self):
+        """
+        Server-Sent Events事件流，每个事件的data是{'type': 事件类型, 'work': 工作map}，
+        工作map是发送时的最新状态，客户端按工作的serial和version更新；
+        长时间没有事件时发送注释行保持连接，连接断开时取消订阅
+        :return: 事件流的生成器
+        """
+        subscriber = self.googleDiverClient.event_bus.subscribe()
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                events = subscriber.get()
+                if not events:
+                    yield ': ping\n\n'
+                    continue
+                lines = []
+                for event, work in events:
+                    lines.append('data: ' + json.dumps({'type': event, 'work': work.to_map() if work else None}))
+                    lines.append('\n\n')
+                yield ''.join(lines)
+        finally:
+            self.googleDiverClient.event_bus.unsubscribe(subscriber)
+
+    def handle_rpc(self, rpc_request):
+        """
+        处理一个jsonrpc请求并记录耗时
+        :param rpc_request: 解析后的请求
+        :return: 响应map，通知请求返回None
+        """
+        start_time = time()
+        response = self.manager.handle(json.dumps(rpc_request), dispatcher)
+        method = rpc_request.get('method') if isinstance(rpc_request, dict) else None
+        if not isinstance(method, str) or method not in dispatcher:
+            method = 'invalid'
+        self.rpc_stats.record(method, time() - start_time)
+        return response.data if response else None
+
     @Request.application
     def application(self, request):
-        response = self.manager.handle(request.get_data(cache=False, as_text=True), dispatcher)
-        # print(response.json)
-        # print()
-        if 'code": -32700' in response.json:
+        if request.path == '/events':
+            return Response(self.event_stream(), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        try:
+            rpc_request = json.loads(request.get_data(cache=False, as_text=True))
+        except ValueError:
             return Response(INDEX_HTML, mimetype='text/html')
-        else:
-            return Response(response.json, mimetype='application/json')
+        if isinstance(rpc_request, list) and rpc_request:
+            responses = [response for response in self.batch_executor.map(self.handle_rpc, rpc_request) if response]
+            if not responses:
+                return Response(status=204)
+            return Response(json.dumps(responses), mimetype='application/json')
+        response = self.handle_rpc(rpc_request)
+        if response is None:
+            return Response(status=204)
+        return Response(json.dumps(response), mimetype='application/json')
 
-    def daemon(self):
+    def register_methods(self):
+        """
+        注册rpc方法，会访问谷歌硬盘的方法交给有界线程池执行
+        :return:
+        """
         dispatcher['upload'] = self.upload
+        dispatcher['upload_stream'] = self.upload_stream
         dispatcher['download'] = self.download
         dispatcher['delete_wait_work'] = self.delete_wait_work
         dispatcher['delete_done_work'] = self.delete_done_work
-        dispatcher['get_now_file_list'] = self.get_now_file_list
-        dispatcher['goto_parent_folder'] = self.goto_parent_folder
-        dispatcher['goto_child_folder'] = self.goto_child_folder
+        dispatcher['set_work_priority'] = self.set_work_priority
+        dispatcher['set_schedule_policy'] = self.set_schedule_policy
+        dispatcher['set_work_bandwidth_limit'] = self.set_work_bandwidth_limit
+        dispatcher['get_bandwidth_limits'] = self.get_bandwidth_limits
+        dispatcher['set_bandwidth_limits'] = self.set_bandwidth_limits
+        dispatcher['get_now_file_list'] = self.rpc_executor.wrap('get_now_file_list', self.get_now_file_list)
+        dispatcher['goto_parent_folder'] = self.rpc_executor.wrap('goto_parent_folder', self.goto_parent_folder)
+        dispatcher['goto_child_folder'] = self.rpc_executor.wrap('goto_child_folder', self.goto_child_folder)
         dispatcher['get_json_wait_works'] = self.get_json_wait_works
         dispatcher['get_json_doing_works'] = self.get_json_doing_works
         dispatcher['get_json_done_works'] = self.get_json_done_works
+        dispatcher['list_works'] = self.list_works
+        dispatcher['set_thread_pool_size'] = self.set_thread_pool_size
+        dispatcher['get_scheduler_stats'] = self.get_scheduler_stats
+        dispatcher['get_metadata_cache_stats'] = self.get_metadata_cache_stats
+        dispatcher['get_metadata_sync_stats'] = self.get_metadata_sync_stats
+        dispatcher['get_service_pool_stats'] = self.get_service_pool_stats
+        dispatcher['get_hash_cache_stats'] = self.get_hash_cache_stats
+        dispatcher['get_rate_governor_stats'] = self.get_rate_governor_stats
+        dispatcher['set_request_rate'] = self.set_request_rate
+        dispatcher['get_rpc_stats'] = self.get_rpc_stats
+
+    def daemon(self):
+        """
+        用多线程的http服务运行，每个连接一个线程，访问谷歌硬盘的方法在有界线程池里执行
+        :return:
+        """
+        self.register_methods()
         print('监控地址', 'http://' + JSON_RPC_HOST + ':' + str(JSON_RPC_PORT) + '/jsonrpc')
-        run_simple(JSON_RPC_HOST, JSON_RPC_PORT, self.application)
+        if STARTUP_TIMING:
+            STARTUP_TIMER.print_report()
+        else:
+            STARTUP_TIMER.finish()
+        make_server(JSON_RPC_HOST, JSON_RPC_PORT, self.application, threaded=True).serve_forever()
+
+
+def create_wsgi_application():
+    """
+    创建wsgi应用，用于在其他wsgi服务器里运行，例如 waitress-serve --call googleDrive:create_wsgi_application
+    :return: wsgi应用
+    """
+    client_daemon = GoogleDiverClientDaemon()
+    client_daemon.register_methods()
+    return client_daemon.application
 
 
 INDEX_HTML = """
@@ -875,7 +4332,7 @@ INDEX_HTML = """
 <table>
     <tr>
         <td>正在下载</td>
-        <td><button onclick="doing()">flush-doing</button></td>
+        <td><button onclick="load_works(\'doing\')">flush-doing</button></td>
     </tr>
 </table>
 <table id="doing_list" style="text-align: center;width: 100%">
@@ -894,7 +4351,7 @@ INDEX_HTML = """
 <table>
     <tr>
         <td>下载完成</td>
-        <td><button onclick="done()">flush-done</button></td>
+        <td><button onclick="load_works(\'done\')">flush-done</button></td>
     </tr>
 </table>
 <table id="done_list" style="text-align: center;width: 100%">
@@ -914,7 +4371,7 @@ INDEX_HTML = """
 <table>
     <tr>
         <td>等待下载</td>
-        <td><button onclick="wait()">flush-wait</button></td>
+        <td><button onclick="load_works(\'wait\')">flush-wait</button></td>
     </tr>
 </table>
 <table id="wait_list" style="text-align: center;width: 100%">
@@ -1005,7 +4462,7 @@ function delete_wait(is_download,path,id){
     $.ajax({
         url: '',
         type: 'post',
-        data: '{"method": "delete_wait_work","params": {"is_download": '+is_download+', "path": "'+path+'", "id": "'+id+'"},"jsonrpc": "2.0","id": 2}',
+        data: JSON.stringify({"method": "delete_wait_work", "params": {"is_download": is_download, "path": path, "id": id}, "jsonrpc": "2.0", "id": 2}),
         contentType: "application/x-www-form-urlencoded",
         dataType: "json",
 
@@ -1036,7 +4493,7 @@ function delete_done(is_download,path,id){
     $.ajax({
         url: '',
         type: 'post',
-        data: '{"method": "delete_done_work","params": {"is_download": '+is_download+', "path": "'+path+'", "id": "'+id+'"},"jsonrpc": "2.0","id": 3}',
+        data: JSON.stringify({"method": "delete_done_work", "params": {"is_download": is_download, "path": path, "id": id}, "jsonrpc": "2.0", "id": 3}),
         contentType: "application/x-www-form-urlencoded",
         dataType: "json",
 
@@ -1204,166 +4661,110 @@ function child(child_folder_id) {
         }
     })
 }
-function wait() {
-    html=''
-    html+='<tr>'
-    html+='<td>upload/download</td>'
-    html+='<td>path</td>'
-    html+='<td>id</td>'
-    html+='<td>progress</td>'
-    html+='<td>done</td>'
-    html+='<td>file_name</td>'
-    html+='<td>delete</td>'
-    html+='</tr>'
-    $('#wait_list').html(html)
-    $.ajax({
-        url: '',
-        type: 'post',
-        data: '{"method": "get_json_wait_works","jsonrpc": "2.0","id": 7}',
-        contentType: "application/x-www-form-urlencoded",
-        dataType: "json",
-
-        error: function () {
-            $('#wait_list').html(html+'<tr><td>网络错误!</td></tr>')
-        },
-        success: function (data) {
-            if('result' in data){
-                array = JSON.parse(data['result'])
-                for (var i in array) {
-                    html+='<tr>'
-                    if(array[i]['is_download']){
-                        html+='<td>download</td>'
-                    }else{
-                        html+='<td>upload</td>'
-                    }
-                    html+='<td>'+array[i]['path']+'</td>'
-                    html+='<td>'+array[i]['id']+'</td>'
-                    html+='<td>'+array[i]['progress']+'%</td>'
-                    html+='<td>'+array[i]['done']+'</td>'
-                    html+='<td>'+array[i]['file_name']+'</td>'
-                    html+='<td><button onclick="delete_wait(\\\''+array[i]['is_download']+'\\\',\\\''+array[i]['path']+'\\\',\\\''+array[i]['id']+'\\\')">delete</button></td>'
-                    html+='</tr>'
-                }
-                $('#wait_list').html(html)
-                return
-            }
-            if('error' in data){
-                $('#wait_list').html(html+'<tr><td>刷新失败</td><td>'+JSON.stringify(data)+'</td></tr>')
-                return
-            }
-            $('#wait_list').html(html+'<tr><td>未知响应</td><td>'+JSON.stringify(data)+'</td></tr>')
-        }
-    })
+function work_row(work) {
+    // 路径和错误信息可能带引号、尖括号，用text和attr填进去，不拼接html
+    var row=$('<tr>').attr('id', 'work_'+work['serial'])
+    row.append($('<td>').text(work['is_download'] ? 'download' : 'upload'))
+    row.append($('<td>').text(''+work['path']))
+    row.append($('<td>').text(''+work['id']))
+    if(work['error']){
+        row.append($('<td>').attr('title', work['error']).text(work['progress']+'% 失败'))
+    }else{
+        row.append($('<td>').text(work['progress']+'%'))
+    }
+    row.append($('<td>').text(''+work['done']))
+    row.append($('<td>').text(''+work['file_name']))
+    if(work['state']=='wait' || work['state']=='done'){
+        var delete_work=work['state']=='wait' ? delete_wait : delete_done
+        row.append($('<td>').append($('<button>').text('delete').click(function () {
+            delete_work(work['is_download'], work['path'], work['id'])
+        })))
+    }
+    return row
 }
-function doing() {
-    html=''
-    html+='<tr>'
-    html+='<td>upload/download</td>'
-    html+='<td>path</td>'
-    html+='<td>id</td>'
-    html+='<td>progress</td>'
-    html+='<td>done</td>'
-    html+='<td>file_name</td>'
-    html+='</tr>'
-    $('#doing_list').html(html)
+var works={}
+function apply_work(work) {
+    old=works[work['serial']]
+    if(old && old['version']>work['version']){
+        return
+    }
+    works[work['serial']]=work
+    row=$('#work_'+work['serial'])
+    if(old && old['state']==work['state'] && row.length){
+        row.replaceWith(work_row(work))
+        return
+    }
+    row.remove()
+    if(work['state']!='removed'){
+        $('#'+work['state']+'_list').append(work_row(work))
+    }
+}
+function load_works(state) {
+    $('#'+state+'_list tr:gt(0)').remove()
+    for (var serial in works) {
+        if(works[serial]['state']==state){
+            delete works[serial]
+        }
+    }
     $.ajax({
         url: '',
         type: 'post',
-        data: '{"method": "get_json_doing_works","jsonrpc": "2.0","id": 8}',
+        data: '{"method": "list_works","params": {"state": "'+state+'", "limit": """ + str(CONSOLE_WORKS_LIMIT) + """},"jsonrpc": "2.0","id": 7}',
         contentType: "application/x-www-form-urlencoded",
         dataType: "json",
 
         error: function () {
-            $('#doing_list').html(html+'<tr><td>网络错误!</td></tr>')
+            $('#'+state+'_list').append('<tr><td>网络错误!</td></tr>')
         },
         success: function (data) {
             if('result' in data){
-                array = JSON.parse(data['result'])
+                array = data['result']['works']
                 for (var i in array) {
-                    html+='<tr>'
-                    if(array[i]['is_download']){
-                        html+='<td>download</td>'
-                    }else{
-                        html+='<td>upload</td>'
-                    }
-                    html+='<td>'+array[i]['path']+'</td>'
-                    html+='<td>'+array[i]['id']+'</td>'
-                    html+='<td>'+array[i]['progress']+'%</td>'
-                    html+='<td>'+array[i]['done']+'</td>'
-                    html+='<td>'+array[i]['file_name']+'</td>'
-                    html+='</tr>'
+                    apply_work(array[i])
                 }
-                $('#doing_list').html(html)
                 return
             }
             if('error' in data){
-                $('#doing_list').html(html+'<tr><td>刷新失败</td><td>'+JSON.stringify(data)+'</td></tr>')
+                $('#'+state+'_list').append('<tr><td>刷新失败</td><td>'+JSON.stringify(data)+'</td></tr>')
                 return
             }
-            $('#doing_list').html(html+'<tr><td>未知响应</td><td>'+JSON.stringify(data)+'</td></tr>')
+            $('#'+state+'_list').append('<tr><td>未知响应</td><td>'+JSON.stringify(data)+'</td></tr>')
         }
     })
 }
-function done() {
-    html=''
-    html+='<tr>'
-    html+='<td>upload/download</td>'
-    html+='<td>path</td>'
-    html+='<td>id</td>'
-    html+='<td>progress</td>'
-    html+='<td>done</td>'
-    html+='<td>file_name</td>'
-    html+='<td>delete</td>'
-    html+='</tr>'
-    $('#done_list').html(html)
-    $.ajax({
-        url: '',
-        type: 'post',
-        data: '{"method": "get_json_done_works","jsonrpc": "2.0","id": 8}',
-        contentType: "application/x-www-form-urlencoded",
-        dataType: "json",
-
-        error: function () {
-            $('#done_list').html(html+'<tr><td>网络错误!</td></tr>')
-        },
-        success: function (data) {
-            if('result' in data){
-                array = JSON.parse(data['result'])
-                for (var i in array) {
-                    html+='<tr>'
-                    if(array[i]['is_download']){
-                        html+='<td>download</td>'
-                    }else{
-                        html+='<td>upload</td>'
-                    }
-                    html+='<td>'+array[i]['path']+'</td>'
-                    html+='<td>'+array[i]['id']+'</td>'
-                    html+='<td>'+array[i]['progress']+'%</td>'
-                    html+='<td>'+array[i]['done']+'</td>'
-                    html+='<td>'+array[i]['file_name']+'</td>'
-                    html+='<td><button onclick="delete_done(\\\''+array[i]['is_download']+'\\\',\\\''+array[i]['path']+'\\\',\\\''+array[i]['id']+'\\\')">delete</button></td>'
-                    html+='</tr>'
-                }
-                $('#done_list').html(html)
-                return
-            }
-            if('error' in data){
-                $('#done_list').html(html+'<tr><td>刷新失败</td><td>'+JSON.stringify(data)+'</td></tr>')
-                return
-            }
-            $('#done_list').html(html+'<tr><td>未知响应</td><td>'+JSON.stringify(data)+'</td></tr>')
+function load_all_works() {
+    load_works('wait')
+    load_works('doing')
+    load_works('done')
+}
+function listen() {
+    events=new EventSource('/events')
+    events.onopen=function () {
+        load_all_works()
+    }
+    events.onmessage=function (message) {
+        data=JSON.parse(message.data)
+        if(data['type']=='reset'){
+            load_all_works()
+            return
         }
-    })
+        apply_work(data['work'])
+    }
 }
 </script>
 
 
     <script type="text/javascript">
         flush();
-        setInterval('wait()', 7890);
-        setInterval('doing()', 3456);
-        setInterval('done()', 5678);
+        listen();
     </script>
 
 </html>
 """
+
+
+if __name__ == '__main__':
+    if flags and flags.upload_stream:
+        GoogleDiverAPI().upload_stream(sys.stdin.buffer, flags.upload_stream, flags.folder_id)
+    else:
+        GoogleDiverClientDaemon().daemon()